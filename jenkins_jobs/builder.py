@@ -261,8 +261,10 @@ class JenkinsManager(object):
                     existing_only=None, config_xml=False):
         orig = time.time()
 
-        logger.info("Number of jobs generated:  %d", len(xml_jobs))
-        xml_jobs.sort(key=AlphanumSort)
+        if output:
+            # the jobs are written out in order, which needs all of them
+            xml_jobs = sorted(xml_jobs, key=AlphanumSort)
+            logger.info("Number of jobs generated:  %d", len(xml_jobs))
 
         if (output and not hasattr(output, 'write') and
                 not os.path.isdir(output)):
@@ -301,14 +303,21 @@ class JenkinsManager(object):
                     f.write(job.output().decode('utf-8'))
             return xml_jobs, len(xml_jobs)
 
-        # Filter out the jobs that did not change
-        logging.debug('Filtering %d jobs for changed jobs',
-                      len(xml_jobs))
+        # Filter out the jobs that did not change. xml_jobs may be an
+        # iterator generating the jobs one at a time, in which case only the
+        # changed jobs are kept in memory.
+        logging.debug('Filtering jobs for changed jobs')
         step = time.time()
-        jobs = [job for job in xml_jobs
-                if self.changed(job)]
-        logging.debug("Filtered for changed jobs in %ss",
-                      (time.time() - step))
+        n_generated = 0
+        jobs = []
+        for job in xml_jobs:
+            n_generated += 1
+            if self.changed(job):
+                jobs.append(job)
+        logger.info("Number of jobs generated:  %d", n_generated)
+        logging.debug("Filtered %d jobs for changed jobs in %ss",
+                      n_generated, (time.time() - step))
+        jobs.sort(key=AlphanumSort)
 
         if existing_only:
             # Filter out the jobs not already in the cache
@@ -21,15 +21,56 @@ import logging
 import os
 import re
 import tempfile
+import time
 
 import fasteners
+import jinja2
+from six.moves import cPickle as pickle
 import yaml
 
 from jenkins_jobs import errors
+from jenkins_jobs.local_yaml import includes_unchanged
+from jenkins_jobs.utils import file_signature
 
 logger = logging.getLogger(__name__)
 
 
+def _make_cache_dir(name):
+    """Return the path of the ``name`` directory of the cache directory,
+    created if needed."""
+    path = os.path.join(JobCache.get_cache_dir(), name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as ose:
+            if ose.errno != errno.EEXIST:
+                raise
+    return path
+
+
+def _write_pickles(filename, objects):
+    """Pickle ``objects`` one after the other to ``filename``."""
+    # write to a temporary file and rename it so that concurrent runs
+    # never see a partially written entry
+    tfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(filename),
+                                        delete=False)
+    try:
+        for obj in objects:
+            pickle.dump(obj, tfile, protocol=2)
+        tfile.close()
+        try:
+            os.rename(tfile.name, filename)
+        except OSError:
+            # On Windows, rename fails if the destination exists
+            os.remove(filename)
+            os.rename(tfile.name, filename)
+    except Exception:
+        tfile.close()
+        if os.path.exists(tfile.name):
+            os.remove(tfile.name)
+        raise
+
+
 class JobCache(object):
     # ensure each instance of the class has a reference to the required
     # modules so that they are available to be used when the destructor
@@ -138,3 +179,148 @@ class JobCache(object):
                 self._logger.error("Failed to write to cache file '%s' on "
                                    "exit: %s" % (self.cachefilename, e))
         self._unlock()
+
+
+class Jinja2BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """On disk cache of the bytecode of the Jinja2 templates, stored in the
+    ``jinja2`` directory of :meth:`JobCache.get_cache_dir`. Jinja2 checks
+    the source of a template and its own version before using an entry."""
+
+    def __init__(self):
+        super(Jinja2BytecodeCache, self).__init__(_make_cache_dir('jinja2'))
+
+    def __reduce__(self):
+        # the templates loaded from the YAML cache use the cache of the
+        # current user
+        return (Jinja2BytecodeCache, ())
+
+
+class ExpansionCache(object):
+    """On disk cache of the jobs and views expanded from projects, stored
+    in the ``expansion`` directory of :meth:`JobCache.get_cache_dir` with
+    one file per key. The keys are worked out by the caller and must change
+    whenever anything affecting the expansion changes.
+
+    Each entry holds the kinds and names of the items and the messages
+    logged about duplicates first, so that they can be read without loading
+    the expanded items themselves. Entries are touched whenever used, those
+    not used for ``max_age`` seconds are removed when the cache is created.
+    """
+
+    # a week
+    max_age = 7 * 24 * 60 * 60
+
+    def __init__(self):
+        self.path = _make_cache_dir('expansion')
+        self.prune()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def prune(self, max_age=None):
+        """Remove the entries not used for ``max_age`` seconds, the
+        ``max_age`` attribute by default, along with whatever was left
+        behind by interrupted writes."""
+        if max_age is None:
+            max_age = self.max_age
+        limit = time.time() - max_age
+        try:
+            names = os.listdir(self.path)
+        except OSError as e:
+            logger.debug("Not pruning the expansion cache: %s", e)
+            return
+        for name in names:
+            filename = os.path.join(self.path, name)
+            try:
+                if os.stat(filename).st_mtime < limit:
+                    os.remove(filename)
+            except OSError:
+                # already removed by a concurrent run
+                pass
+
+    def _load(self, key, with_items):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                names = pickle.load(f)
+                if not with_items:
+                    # mark the entry as used, its items are only loaded
+                    # after its names were read
+                    os.utime(filename, None)
+                    return names
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            # an interrupted or incompatible write, expand again
+            logger.debug("Ignoring expansion cache entry '%s': %s", key, e)
+            return None
+
+    def get_names(self, key):
+        """Return the list of ``(kind, name)`` stored for ``key`` along with
+        the list of the messages logged about duplicates when expanding the
+        items, None if there isn't any entry for it."""
+        return self._load(key, with_items=False)
+
+    def get(self, key):
+        """Return the list of expanded items stored for ``key``, in the same
+        order as their names, None if there isn't any entry for it."""
+        return self._load(key, with_items=True)
+
+    def set(self, key, items, messages=()):
+        """Store the ``(kind, name, item)`` tuples in ``items`` for
+        ``key``, along with the ``messages`` logged about duplicates when
+        expanding them."""
+        _write_pickles(self._filename(key),
+                       [([(kind, name) for kind, name, _ in items],
+                         list(messages)),
+                        [item for _, _, item in items]])
+
+
+class YamlCache(object):
+    """On disk cache of the data loaded from YAML files, stored in the
+    ``yaml`` directory of :meth:`JobCache.get_cache_dir` with one file per
+    key. The keys are worked out by the caller from the path of the file
+    and the options used to load it.
+
+    Each entry also holds the signature of the file and of the files it
+    includes, along with how these were found in the search path, and is
+    only used as long as none of them changed.
+    """
+
+    def __init__(self):
+        self.path = _make_cache_dir('yaml')
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    @staticmethod
+    def _unchanged(path, signature, includes, current=None):
+        if current is None:
+            current = file_signature(path)
+        return current == signature and includes_unchanged(includes)
+
+    def get(self, key, signature=None):
+        """Return the data stored for ``key``, None if there isn't any
+        entry for it or if any of its files changed. ``signature`` is the
+        current one of the file, when already known."""
+        try:
+            with open(self._filename(key), 'rb') as f:
+                path, stored, includes = pickle.load(f)
+                if not self._unchanged(path, stored, includes, signature):
+                    return None
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            # an interrupted or incompatible write, load the file again
+            logger.debug("Ignoring YAML cache entry '%s': %s", key, e)
+            return None
+
+    def set(self, key, path, signature, includes, data):
+        """Store ``data`` loaded from the file at ``path`` for ``key``.
+        ``signature`` is the one of the file before it was read and
+        ``includes`` the files included, as listed by
+        :class:`jenkins_jobs.local_yaml.LocalLoader`."""
+        _write_pickles(self._filename(key),
+                       [(path, signature, includes), data])
@@ -131,7 +131,9 @@ class JenkinsJobs(object):
                 paths = []
                 for path in self.options.path:
                     if do_recurse and os.path.isdir(path):
-                        paths.extend(utils.recurse_path(path, excludes))
+                        paths.extend(utils.recurse_path(
+                            path, excludes, n_workers=self.jjb_config
+                            .yamlparser['recursive_workers']))
                     else:
                         paths.append(path)
                 self.options.path = paths
@@ -58,14 +58,17 @@ class DeleteSubCommand(base.BaseSubCommand):
                 '"--views-only" and "--jobs-only" cannot be used together.')
 
         fn = options.path
-        registry = ModuleRegistry(jjb_config, builder.plugins_list)
-        parser = YamlParser(jjb_config)
 
         if fn:
+            # only the names are needed, neither the plugins information
+            # nor expanding the jobs and views
+            registry = ModuleRegistry(jjb_config)
+            parser = YamlParser(jjb_config)
             parser.load_files(fn)
-            parser.expandYaml(registry, options.name)
-            jobs = [j['name'] for j in parser.jobs]
-            views = [v['name'] for v in parser.views]
+            job_handles, view_handles = parser.getHandles(registry,
+                                                          options.name)
+            jobs = [job.name for job in job_handles]
+            views = [view.name for view in view_handles]
         else:
             jobs = options.name
             views = options.name
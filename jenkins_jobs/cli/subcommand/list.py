@@ -42,7 +42,10 @@ class ListSubCommand(base.BaseSubCommand):
 
     def execute(self, options, jjb_config):
         self.jjb_config = jjb_config
-        self.jenkins = builder.JenkinsManager(jjb_config)
+        # the jobs are only read from Jenkins when no path is given
+        self.jenkins = None
+        if not options.path:
+            self.jenkins = builder.JenkinsManager(jjb_config)
 
         jobs = self.get_jobs(options.names, options.path)
 
@@ -54,12 +57,12 @@ class ListSubCommand(base.BaseSubCommand):
 
     def get_jobs(self, jobs_glob=None, fn=None):
         if fn:
-            r = registry.ModuleRegistry(self.jjb_config,
-                                      self.jenkins.plugins_list)
+            # only the names are needed, neither the plugins information
+            # nor expanding the jobs
+            r = registry.ModuleRegistry(self.jjb_config)
             p = parser.YamlParser(self.jjb_config)
             p.load_files(fn)
-            p.expandYaml(r, jobs_glob)
-            jobs = [j['name'] for j in p.jobs]
+            jobs = [job.name for job in p.getJobHandles(r, jobs_glob)]
         else:
             jobs = [j['name'] for j in self.jenkins.get_jobs()
                     if not jobs_glob or parser.matches(j['name'], jobs_glob)]
@@ -93,22 +93,30 @@ class UpdateSubCommand(base.BaseSubCommand):
             const='views',
             help='update only views')
 
-    def _generate_xmljobs(self, options, jjb_config=None):
+    def _load_files(self, options, jjb_config=None):
+        """Return the builder, the parser with the files of ``options``
+        loaded, and the registry with the data of the parser."""
         builder = JenkinsManager(jjb_config)
 
         logger.info("Updating jobs in {0} ({1})".format(
             options.path, options.names))
-        orig = time.time()
 
-        # Generate XML
         parser = YamlParser(jjb_config)
         registry = ModuleRegistry(jjb_config, builder.plugins_list)
-        xml_job_generator = XmlJobGenerator(registry)
-        xml_view_generator = XmlViewGenerator(registry)
 
         parser.load_files(options.path)
         registry.set_parser_data(parser.data)
 
+        return builder, parser, registry
+
+    def _generate_xmljobs(self, options, jjb_config=None):
+        orig = time.time()
+
+        # Generate XML
+        builder, parser, registry = self._load_files(options, jjb_config)
+        xml_job_generator = XmlJobGenerator(registry)
+        xml_view_generator = XmlViewGenerator(registry)
+
         job_data_list, view_data_list = parser.expandYaml(
             registry, options.names)
 
@@ -122,12 +130,32 @@ class UpdateSubCommand(base.BaseSubCommand):
 
         return builder, xml_jobs, xml_views
 
+    def _stream_xmljobs(self, options, jjb_config=None):
+        """Same as _generate_xmljobs() except that the XML jobs are returned
+        as an iterator, each job being expanded and its XML generated only
+        when it is reached, so that the unchanged jobs don't need to be kept
+        in memory while updating. The index of the jobs by name, with the
+        names of the jobs to keep, is returned as well."""
+        builder, parser, registry = self._load_files(options, jjb_config)
+        xml_job_generator = XmlJobGenerator(registry)
+        xml_view_generator = XmlViewGenerator(registry)
+
+        # the data is handled and the projects walked only once for both
+        job_handles, view_handles = parser.getHandles(registry,
+                                                      options.names)
+        xml_jobs = xml_job_generator.iterXML(
+            parser.expandHandles(job_handles))
+        xml_views = xml_view_generator.generateXML(
+            parser.expandHandles(view_handles))
+
+        return builder, xml_jobs, parser.jobs_index, xml_views
+
     def execute(self, options, jjb_config):
         if options.n_workers < 0:
             raise JenkinsJobsException(
                 'Number of workers must be equal or greater than 0')
 
-        builder, xml_jobs, xml_views = self._generate_xmljobs(
+        builder, xml_jobs, keep_jobs, xml_views = self._stream_xmljobs(
             options, jjb_config)
 
         if options.update == 'jobs':
@@ -150,7 +178,6 @@ class UpdateSubCommand(base.BaseSubCommand):
                 existing_only=options.existing_only)
             logger.info("Number of views updated: %d", num_updated_views)
 
-        keep_jobs = [job.name for job in xml_jobs]
         if options.delete_old:
             n = builder.delete_old_managed(keep=keep_jobs)
             logger.info("Number of jobs deleted: %d", n)
@@ -313,6 +313,85 @@ class JJBConfig(object):
                                                'retain_anchors')
         self.yamlparser['retain_anchors'] = retain_anchors
 
+        # number of processes to use when expanding projects
+        expansion_workers = 1
+        if config and config.has_option('job_builder', 'expansion_workers'):
+            try:
+                expansion_workers = config.getint('job_builder',
+                                                  'expansion_workers')
+            except ValueError:
+                raise JenkinsJobsException(
+                    "expansion_workers config is invalid")
+            if expansion_workers < 0:
+                raise JenkinsJobsException(
+                    "expansion_workers must be equal or greater than 0")
+        self.yamlparser['expansion_workers'] = expansion_workers
+
+        # number of processes to use when parsing the yaml files
+        parsing_workers = 1
+        if config and config.has_option('job_builder', 'parsing_workers'):
+            try:
+                parsing_workers = config.getint('job_builder',
+                                                'parsing_workers')
+            except ValueError:
+                raise JenkinsJobsException(
+                    "parsing_workers config is invalid")
+            if parsing_workers < 0:
+                raise JenkinsJobsException(
+                    "parsing_workers must be equal or greater than 0")
+        self.yamlparser['parsing_workers'] = parsing_workers
+
+        # number of threads listing the directories with recursive
+        recursive_workers = 1
+        if config and config.has_option('job_builder', 'recursive_workers'):
+            try:
+                recursive_workers = config.getint('job_builder',
+                                                  'recursive_workers')
+            except ValueError:
+                raise JenkinsJobsException(
+                    "recursive_workers config is invalid")
+            if recursive_workers < 0:
+                raise JenkinsJobsException(
+                    "recursive_workers must be equal or greater than 0")
+        self.yamlparser['recursive_workers'] = recursive_workers
+
+        # seconds after which the files found in the include path are
+        # looked for again if their directories changed
+        include_poll_interval = None
+        if config and config.has_option('job_builder',
+                                        'include_poll_interval'):
+            try:
+                include_poll_interval = config.getfloat(
+                    'job_builder', 'include_poll_interval')
+            except ValueError:
+                raise JenkinsJobsException(
+                    "include_poll_interval config is invalid")
+            if include_poll_interval < 0:
+                raise JenkinsJobsException(
+                    "include_poll_interval must be equal or greater than 0")
+        self.yamlparser['include_poll_interval'] = include_poll_interval
+
+        # cache the expansion of projects on disk?
+        expansion_cache = False
+        if config and config.has_option('job_builder', 'expansion_cache'):
+            expansion_cache = config.getboolean('job_builder',
+                                                'expansion_cache')
+        self.yamlparser['expansion_cache'] = expansion_cache
+
+        # keep the bytecode of the jinja2 templates on disk?
+        jinja2_bytecode_cache = False
+        if config and config.has_option('job_builder',
+                                        'jinja2_bytecode_cache'):
+            jinja2_bytecode_cache = config.getboolean(
+                'job_builder', 'jinja2_bytecode_cache')
+        self.yamlparser['jinja2_bytecode_cache'] = jinja2_bytecode_cache
+
+        # cache the data loaded from the YAML files on disk?
+        yaml_cache = False
+        if config and config.has_option('job_builder', 'yaml_cache'):
+            yaml_cache = config.getboolean('job_builder', 'yaml_cache')
+        self.yamlparser['yaml_cache'] = yaml_cache
+
         update = None
         if (config and config.has_section('job_builder') and
                 config.has_option('job_builder', 'update')):
@@ -15,58 +15,56 @@
 
 # Manage interpolation of JJB variables into template strings.
 
+from collections import OrderedDict
 import logging
 from pprint import pformat
 import re
 from string import Formatter
+import sys
+import threading
+
+import six
 
 from jenkins_jobs.errors import JenkinsJobsException
 from jenkins_jobs.local_yaml import CustomLoader
+from jenkins_jobs.local_yaml import Jinja2Loader
+from jenkins_jobs.local_yaml import LazyLoader
 
 logger = logging.getLogger(__name__)
 
 
-def deep_format(obj, paramdict, allow_empty=False):
-    """Apply the paramdict via str.format() to all string objects found within
-       the supplied obj. Lists and dicts are traversed recursively."""
-    # YAML serialisation was originally used to achieve this, but that places
-    # limitations on the values in paramdict - the post-format result must
-    # still be valid YAML (so substituting-in a string containing quotes, for
-    # example, is problematic).
+def _has_fields(value):
+    return '{' in value or '}' in value
+
+
+def _missing_parameter(exc, obj, paramdict):
+    missing_key = exc.args[0]
+    desc = "%s parameter missing to format %s\nGiven:\n%s" % (
+        missing_key, obj, pformat(paramdict))
+    return JenkinsJobsException(desc)
+
+
+def _log_failure(obj, paramdict, allow_empty):
+    logging.error("Problem formatting with args:\nallow_empty:"
+                  "%s\nobj: %s\nparamdict: %s" %
+                  (allow_empty, obj, paramdict))
+
+
+def _format_value(obj, paramdict, allow_empty):
+    """Format anything but a list or a dict, returning ``obj`` itself when
+    formatting leaves it unchanged."""
+    if isinstance(obj, six.string_types) and not _has_fields(obj):
+        return obj
     if hasattr(obj, 'format'):
         try:
-            ret = CustomFormatter(allow_empty).format(obj, **paramdict)
+            ret = _formatters[allow_empty].vformat(obj, (), paramdict)
         except KeyError as exc:
-            missing_key = exc.args[0]
-            desc = "%s parameter missing to format %s\nGiven:\n%s" % (
-                missing_key, obj, pformat(paramdict))
-            raise JenkinsJobsException(desc)
+            raise _missing_parameter(exc, obj, paramdict)
         except Exception:
-            logging.error("Problem formatting with args:\nallow_empty:"
-                          "%s\nobj: %s\nparamdict: %s" %
-                          (allow_empty, obj, paramdict))
+            _log_failure(obj, paramdict, allow_empty)
             raise
-
-    elif isinstance(obj, list):
-        ret = type(obj)()
-        for item in obj:
-            ret.append(deep_format(item, paramdict, allow_empty))
-    elif isinstance(obj, dict):
-        ret = type(obj)()
-        for item in obj:
-            try:
-                ret[CustomFormatter(allow_empty).format(item, **paramdict)] = \
-                    deep_format(obj[item], paramdict, allow_empty)
-            except KeyError as exc:
-                missing_key = exc.args[0]
-                desc = "%s parameter missing to format %s\nGiven:\n%s" % (
-                    missing_key, obj, pformat(paramdict))
-                raise JenkinsJobsException(desc)
-            except Exception:
-                logging.error("Problem formatting with args:\nallow_empty:"
-                              "%s\nobj: %s\nparamdict: %s" %
-                              (allow_empty, obj, paramdict))
-                raise
+        if type(ret) is type(obj) and ret == obj:
+            return obj
     else:
         ret = obj
     if isinstance(ret, CustomLoader):
@@ -76,6 +74,521 @@ def deep_format(obj, paramdict, allow_empty=False):
     return ret
 
 
+class _Frame(object):
+    """A list or dict being formatted by deep_format()."""
+
+    __slots__ = ('obj', 'is_dict', 'items', 'formatted', 'changed', 'key')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.is_dict = isinstance(obj, dict)
+        self.items = iter(obj.items()) if self.is_dict else iter(obj)
+        # the formatted (key, value) pairs of a dict, or values of a list
+        self.formatted = []
+        self.changed = False
+        # key of the dict value being formatted in a frame of its own
+        self.key = None
+
+    def add(self, key, value):
+        if self.is_dict:
+            self.formatted.append((key, value))
+        else:
+            self.formatted.append(value)
+
+    def result(self):
+        if not self.changed:
+            return self.obj
+        ret = type(self.obj)()
+        if self.is_dict:
+            for key, value in self.formatted:
+                ret[key] = value
+        else:
+            ret.extend(self.formatted)
+        return ret
+
+
+def deep_format(obj, paramdict, allow_empty=False, static=()):
+    """Apply the paramdict via str.format() to all string objects found within
+       the supplied obj. Lists and dicts are traversed, without recursion.
+       The paramdict may be any mapping, it is never copied.
+
+       Whatever formatting leaves unchanged is returned as it is rather than
+       copied, such as strings without any field, the lists and dicts whose
+       ids are in ``static`` as found by find_static() and any list or dict
+       all of whose items are unchanged. The result may then share parts
+       with ``obj`` and has to be copied before being modified."""
+    # YAML serialisation was originally used to achieve this, but that places
+    # limitations on the values in paramdict - the post-format result must
+    # still be valid YAML (so substituting-in a string containing quotes, for
+    # example, is problematic).
+    if id(obj) in static:
+        return obj
+    if not isinstance(obj, (list, dict)):
+        return _format_value(obj, paramdict, allow_empty)
+
+    stack = [_Frame(obj)]
+    # ids of the lists and dicts of the stack, which can't contain themselves
+    active = set([id(obj)])
+    # whether the dict of the innermost frame has already reported the
+    # failure, as it does when one of its keys fails to format
+    reported = False
+    try:
+        while True:
+            frame = stack[-1]
+            for item in frame.items:
+                key = None
+                if frame.is_dict:
+                    key, item = item
+                    if (not isinstance(key, six.string_types) or
+                            _has_fields(key)):
+                        try:
+                            new_key = _formatters[allow_empty].vformat(
+                                key, (), paramdict)
+                        except KeyError as exc:
+                            reported = True
+                            raise _missing_parameter(exc, frame.obj,
+                                                     paramdict)
+                        if new_key != key or type(new_key) is not type(key):
+                            frame.changed = True
+                            key = new_key
+                if isinstance(item, (list, dict)) and id(item) not in static:
+                    if id(item) in active:
+                        raise JenkinsJobsException(
+                            "Cannot format %s, it contains itself" % (item,))
+                    frame.key = key
+                    stack.append(_Frame(item))
+                    active.add(id(item))
+                    break
+                value = _format_value(item, paramdict, allow_empty)
+                if value is not item:
+                    frame.changed = True
+                frame.add(key, value)
+            else:
+                ret = stack.pop().result()
+                active.discard(id(frame.obj))
+                if not stack:
+                    return ret
+                parent = stack[-1]
+                if ret is not frame.obj:
+                    parent.changed = True
+                parent.add(parent.key, ret)
+    except Exception:
+        # each dict the failure happened within reports it
+        for frame in reversed(stack):
+            if frame.is_dict:
+                if not reported:
+                    _log_failure(frame.obj, paramdict, allow_empty)
+                reported = False
+        raise
+
+
+def _is_static(value, static):
+    if isinstance(value, six.string_types):
+        return not _has_fields(value)
+    if isinstance(value, (list, dict)):
+        return id(value) in static
+    return not hasattr(value, 'format') and not isinstance(value, CustomLoader)
+
+
+def find_static(obj, static, seen):
+    """Add to the set ``static`` the ids of the lists and dicts within ``obj``
+    which deep_format() leaves unchanged whatever the parameters, as none of
+    their strings has a field and they hold no custom objects. ``seen`` maps
+    the ids of the lists and dicts already looked at to them, it has to be
+    kept with ``static`` so that these ids stay valid, and is what makes
+    looking at the same data again cheap."""
+    if not isinstance(obj, (list, dict)) or id(obj) in seen:
+        return
+    # walk the tree depth first, deciding for each list or dict once all
+    # the ones it contains have been
+    stack = [(obj, False)]
+    while stack:
+        node, visited = stack.pop()
+        if isinstance(node, dict):
+            children = list(node.values())
+        else:
+            children = node
+        if visited:
+            if (all(_is_static(child, static) for child in children) and
+                    (not isinstance(node, dict) or
+                     all(isinstance(key, six.string_types) and
+                         not _has_fields(key) for key in node))):
+                static.add(id(node))
+            continue
+        if id(node) in seen:
+            continue
+        seen[id(node)] = node
+        stack.append((node, True))
+        stack.extend((child, False) for child in children
+                     if isinstance(child, (list, dict)) and
+                     id(child) not in seen)
+
+
+# deepest lists and dicts compiled into nodes of a RenderPlan, the ones
+# nested deeper are left to deep_format()
+_MAX_PLAN_DEPTH = 100
+
+
+class _StaticNode(object):
+    """Data with nothing to format, rendered as it is."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def render(self, paramdict, formatter):
+        return self.value
+
+    def describe(self):
+        if isinstance(self.value, (list, dict)):
+            return 'static %s of %d items' % (type(self.value).__name__,
+                                              len(self.value))
+        return 'static %r' % (self.value,)
+
+    def children(self):
+        return []
+
+
+class _StringNode(object):
+    """A string with fields, parsed once."""
+
+    __slots__ = ('value', 'compiled')
+
+    def __init__(self, value):
+        self.value = value
+        self.compiled = _CompiledFormat(value, _formatters[False])
+
+    def render(self, paramdict, formatter):
+        ret = formatter.vformat_compiled(self.compiled, (), paramdict)
+        if type(ret) is type(self.value) and ret == self.value:
+            return self.value
+        if isinstance(ret, CustomLoader):
+            ret = deep_format(ret, paramdict, formatter.allow_empty)
+        return ret
+
+    def describe(self):
+        return 'format %r' % (self.value,)
+
+    def children(self):
+        return []
+
+
+class _CustomNode(object):
+    """An object formatting itself, such as the custom objects of the YAML
+    tags."""
+
+    __slots__ = ('value',)
+    kind = 'custom'
+
+    def __init__(self, value):
+        self.value = value
+
+    def render(self, paramdict, formatter):
+        ret = formatter.vformat(self.value, (), paramdict)
+        if type(ret) is type(self.value) and ret == self.value:
+            return self.value
+        if isinstance(ret, CustomLoader):
+            ret = deep_format(ret, paramdict, formatter.allow_empty)
+        return ret
+
+    def describe(self):
+        return '%s %r' % (self.kind, self.value)
+
+    def children(self):
+        return []
+
+
+class _LazyIncludeNode(_CustomNode):
+    """A file included with a path depending on the parameters."""
+
+    __slots__ = ()
+    kind = 'lazy include'
+
+
+class _JinjaNode(_CustomNode):
+    """A Jinja2 template."""
+
+    __slots__ = ()
+    kind = 'jinja'
+
+
+class _DeepFormatNode(object):
+    """A list or dict nested too deep to compile, left to deep_format()."""
+
+    __slots__ = ('value', 'static')
+
+    def __init__(self, value, static):
+        self.value = value
+        self.static = static
+
+    def render(self, paramdict, formatter):
+        return deep_format(self.value, paramdict, formatter.allow_empty,
+                           self.static)
+
+    def describe(self):
+        return 'deep_format %s' % type(self.value).__name__
+
+    def children(self):
+        return []
+
+
+class _ListNode(object):
+    """A list with some items to format."""
+
+    __slots__ = ('value', 'nodes')
+
+    def __init__(self, value, nodes):
+        self.value = value
+        self.nodes = nodes
+
+    def render(self, paramdict, formatter):
+        items = [node.render(paramdict, formatter) for node in self.nodes]
+        for item, original in zip(items, self.value):
+            if item is not original:
+                ret = type(self.value)()
+                ret.extend(items)
+                return ret
+        return self.value
+
+    def describe(self):
+        return type(self.value).__name__
+
+    def children(self):
+        return [('-', node) for node in self.nodes]
+
+
+class _DictNode(object):
+    """A dict with some keys or values to format."""
+
+    __slots__ = ('value', 'entries')
+
+    def __init__(self, value, entries):
+        self.value = value
+        # (key, node of the key or None if there's nothing to format in it,
+        # value, node of the value)
+        self.entries = entries
+
+    def render(self, paramdict, formatter):
+        changed = False
+        items = []
+        for key, key_node, value, node in self.entries:
+            if key_node is not None:
+                new_key = key_node.render(paramdict, formatter)
+                if new_key != key or type(new_key) is not type(key):
+                    changed = True
+                    key = new_key
+            new_value = node.render(paramdict, formatter)
+            if new_value is not value:
+                changed = True
+            items.append((key, new_value))
+        if not changed:
+            return self.value
+        ret = type(self.value)()
+        for key, value in items:
+            ret[key] = value
+        return ret
+
+    def describe(self):
+        return type(self.value).__name__
+
+    def children(self):
+        return [(repr(key) + ':', node)
+                for key, _, _, node in self.entries]
+
+
+def _compile_node(obj, static, depth=0):
+    if isinstance(obj, six.string_types):
+        if _has_fields(obj):
+            return _StringNode(obj)
+        return _StaticNode(obj)
+    if id(obj) in static:
+        return _StaticNode(obj)
+    if isinstance(obj, (list, dict)):
+        if depth >= _MAX_PLAN_DEPTH:
+            return _DeepFormatNode(obj, static)
+        if isinstance(obj, list):
+            nodes = [_compile_node(item, static, depth + 1) for item in obj]
+            if all(isinstance(node, _StaticNode) for node in nodes):
+                return _StaticNode(obj)
+            return _ListNode(obj, nodes)
+        entries = []
+        for key, value in obj.items():
+            if not isinstance(key, six.string_types):
+                # let deep_format() deal with what it can't format
+                return _DeepFormatNode(obj, static)
+            key_node = _StringNode(key) if _has_fields(key) else None
+            entries.append((key, key_node, value,
+                            _compile_node(value, static, depth + 1)))
+        if all(key_node is None and isinstance(node, _StaticNode)
+               for _, key_node, _, node in entries):
+            return _StaticNode(obj)
+        return _DictNode(obj, entries)
+    if isinstance(obj, LazyLoader):
+        return _LazyIncludeNode(obj)
+    if isinstance(obj, Jinja2Loader):
+        return _JinjaNode(obj)
+    if hasattr(obj, 'format') or isinstance(obj, CustomLoader):
+        return _CustomNode(obj)
+    return _StaticNode(obj)
+
+
+class RenderPlan(object):
+    """
+    Data compiled once to be formatted by :meth:`render` with many sets of
+    parameters, giving the same result as :func:`deep_format` without
+    having to look at the whole data every time.
+
+    The plan is a tree of nodes: the parts of the data with nothing to
+    format, the strings with fields, the custom objects such as the lazily
+    included files and Jinja2 templates, and the lists and dicts holding
+    them. :meth:`dump` shows it.
+    """
+
+    def __init__(self, obj, static=()):
+        self.obj = obj
+        self.static = static
+        self.root = _compile_node(obj, static)
+
+    def render(self, paramdict, allow_empty=False):
+        try:
+            return self.root.render(paramdict, _formatters[allow_empty])
+        except Exception:
+            exc_info = sys.exc_info()
+            # report the failure the same way deep_format() does
+            deep_format(self.obj, paramdict, allow_empty, self.static)
+            six.reraise(*exc_info)
+
+    def dump(self):
+        """Return a description of the nodes of the plan, one per line."""
+        lines = []
+        stack = [(0, '', self.root)]
+        while stack:
+            indent, prefix, node = stack.pop()
+            lines.append('%s%s%s' % ('  ' * indent,
+                                     prefix + ' ' if prefix else '',
+                                     node.describe()))
+            stack.extend((indent + 1, child_prefix, child) for
+                         child_prefix, child in reversed(node.children()))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.root.describe())
+
+
+class _LRUCache(object):
+    """A mapping keeping at most ``maxsize`` entries, dropping the least
+    recently used one to make room for a new one. It may be shared between
+    threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# field names CustomFormatter.get_value() is called with as they are, not
+# positional arguments nor attribute or item lookups
+_SIMPLE_FIELD = re.compile(r'(?!\d)[\w-]+\Z', re.UNICODE)
+
+
+class _CompiledFormat(object):
+    """
+    A format string parsed once for :class:`CustomFormatter`: the key of the
+    parameter it is made of if it's a single field, the segments of the
+    string around the ``{key|default}`` fields, and the fields of the
+    string passed on to :class:`string.Formatter` for each combination of
+    those defaults being used or not.
+    """
+
+    __slots__ = ('whole_key', 'segments', 'defaults', '_fields')
+
+    def __init__(self, format_string, formatter):
+        result = formatter._whole_matcher.match(format_string)
+        self.whole_key = result.group('key') if result is not None else None
+
+        # the matches without a default are kept as they are
+        self.segments = []
+        self.defaults = []
+        literal = []
+        end = 0
+        for match in formatter._matcher.finditer(format_string):
+            literal.append(format_string[end:match.start()])
+            end = match.end()
+            if match.group('default') is None:
+                literal.append(match.group(0))
+                continue
+            self.segments.append(''.join(literal))
+            self.segments.append(match)
+            self.defaults.append(match.group('key'))
+            literal = []
+        literal.append(format_string[end:])
+        self.segments.append(''.join(literal))
+        self._fields = {}
+
+    def substitute(self, kwargs):
+        """Return the string with its ``{key|default}`` fields replaced as
+        needed for ``kwargs``, and the key to its parsed fields."""
+        if not self.defaults:
+            return self.segments[0], ()
+        used = tuple(key not in kwargs for key in self.defaults)
+        parts = []
+        for segment in self.segments:
+            if isinstance(segment, six.string_types):
+                parts.append(segment)
+            elif segment.group('key') not in kwargs:
+                parts.append(segment.group('default'))
+            else:
+                parts.append("{%s}" % segment.group('key'))
+        return ''.join(parts), used
+
+    def fields(self, format_string, used, formatter):
+        """Return the parsed fields of the substituted ``format_string``, or
+        None if they are not all simple ones, in which case it has to go
+        through :meth:`string.Formatter.vformat`."""
+        try:
+            return self._fields[used]
+        except KeyError:
+            pass
+        try:
+            fields = list(formatter.parse(format_string))
+        except ValueError:
+            fields = None
+        else:
+            for _, field_name, format_spec, _ in fields:
+                if field_name is None:
+                    continue
+                if (not _SIMPLE_FIELD.match(field_name) or
+                        (format_spec and '{' in format_spec)):
+                    fields = None
+                    break
+        self._fields[used] = fields
+        return fields
+
+
 class CustomFormatter(Formatter):
     """
     Custom formatter to allow non-existing key references when formatting a
@@ -89,40 +602,54 @@ class CustomFormatter(Formatter):
         }(}})*(?!})                 # non-pair closing }
     """
 
+    _matcher = re.compile(_expr, re.VERBOSE)
+    _whole_matcher = re.compile('^%s$' % _expr, re.VERBOSE)
+
+    # format strings parsed so far, shared by all the instances
+    _compiled = _LRUCache(8192)
+
     def __init__(self, allow_empty=False):
         super(CustomFormatter, self).__init__()
         self.allow_empty = allow_empty
 
     def vformat(self, format_string, args, kwargs):
-        matcher = re.compile(self._expr, re.VERBOSE)
+        if not isinstance(format_string, six.string_types):
+            return format_string.format(**kwargs)
+
+        cache_key = (type(format_string), format_string)
+        compiled = self._compiled.get(cache_key)
+        if compiled is None:
+            compiled = _CompiledFormat(format_string, self)
+            self._compiled.put(cache_key, compiled)
+        return self.vformat_compiled(compiled, args, kwargs)
 
+    def vformat_compiled(self, compiled, args, kwargs):
+        """Same as :meth:`vformat` for a format string already parsed into
+        a _CompiledFormat."""
         # special case of returning the object if the entire string
         # matches a single parameter
-        try:
-            result = re.match('^%s$' % self._expr, format_string, re.VERBOSE)
-        except TypeError:
-            return format_string.format(**kwargs)
-        if result is not None:
+        if compiled.whole_key is not None:
             try:
-                return kwargs[result.group("key")]
+                return kwargs[compiled.whole_key]
             except KeyError:
                 pass
 
-        # handle multiple fields within string via a callback to re.sub()
-        def re_replace(match):
-            key = match.group("key")
-            default = match.group("default")
+        # handle the fields with a default fallback
+        format_string, used = compiled.substitute(kwargs)
 
-            if default is not None:
-                if key not in kwargs:
-                    return default
-                else:
-                    return "{%s}" % key
-            return match.group(0)
-
-        format_string = matcher.sub(re_replace, format_string)
-
-        return Formatter.vformat(self, format_string, args, kwargs)
+        fields = compiled.fields(format_string, used, self)
+        if fields is None:
+            return Formatter.vformat(self, format_string, args, kwargs)
+        # same as Formatter.vformat() for the simple fields
+        result = []
+        for literal_text, field_name, format_spec, conversion in fields:
+            if literal_text:
+                result.append(literal_text)
+            if field_name is not None:
+                obj = self.get_value(field_name, args, kwargs)
+                obj = self.convert_field(obj, conversion)
+                result.append(self.format_field(obj, format_spec))
+        return ''.join(result)
 
     def get_value(self, key, args, kwargs):
         try:
@@ -135,3 +662,9 @@ class CustomFormatter(Formatter):
                 )
                 return ''
             raise
+
+
+_formatters = {
+    False: CustomFormatter(allow_empty=False),
+    True: CustomFormatter(allow_empty=True),
+}
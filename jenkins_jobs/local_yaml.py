@@ -196,22 +196,46 @@ construct.
 Examples:
 
     .. literalinclude:: /../../tests/yamlparser/fixtures/jinja-string01.yaml
+
+
+JSON Input
+^^^^^^^^^^
+
+The files with a ``.json`` extension are loaded with the JSON parser of
+Python, or the one of ``simplejson`` when installed, which is much faster
+than loading them as YAML. As JSON has no tags, an object with a single
+key naming one of the tags above, including the ``:``, stands for the tag
+applied to the value of the key, which must be a string or a list of
+strings as in YAML. For example ``{"!include-raw:": "script.sh"}`` or
+``{"!join:": [" ", ["make", "all"]]}``. Objects with any other single key
+are kept as they are.
 """
 
 import functools
+import hashlib
 import io
 import logging
 import os
 import re
+import threading
+import time
 
 import jinja2
+import six
 import yaml
+try:
+    import simplejson as json
+except ImportError:
+    import json
 from yaml.constructor import BaseConstructor
 from yaml.representer import BaseRepresenter
 from yaml import YAMLObject
 
 from collections import OrderedDict
 
+from jenkins_jobs.utils import copy_tree
+from jenkins_jobs.utils import file_signature
+
 
 logger = logging.getLogger(__name__)
 
@@ -229,7 +253,6 @@ class OrderedConstructor(BaseConstructor):
     def construct_yaml_map(self, node):
         data = OrderedDict()
         yield data
-        value = self.construct_mapping(node)
 
         if isinstance(node, yaml.MappingNode):
             self.flatten_mapping(node)
@@ -239,7 +262,7 @@ class OrderedConstructor(BaseConstructor):
                 'expected a mapping node, but found %s' % node.id,
                 node.start_mark)
 
-        mapping = OrderedDict()
+        # construct the keys and values once, straight into the mapping
         for key_node, value_node in node.value:
             key = self.construct_object(key_node, deep=False)
             try:
@@ -248,9 +271,7 @@ class OrderedConstructor(BaseConstructor):
                 raise yaml.constructor.ConstructorError(
                     'while constructing a mapping', node.start_mark,
                     'found unacceptable key (%s)' % exc, key_node.start_mark)
-            value = self.construct_object(value_node, deep=False)
-            mapping[key] = value
-        data.update(mapping)
+            data[key] = self.construct_object(value_node, deep=False)
 
 
 class OrderedRepresenter(BaseRepresenter):
@@ -264,6 +285,9 @@ class OrderedRepresenter(BaseRepresenter):
 class LocalAnchorLoader(yaml.Loader):
     """Subclass for yaml.Loader which keeps Alias between calls"""
     anchors = {}
+    # whether the document has any anchors or aliases, making its data
+    # depend on the other documents loaded
+    uses_anchors = False
 
     def __init__(self, *args, **kwargs):
         super(LocalAnchorLoader, self).__init__(*args, **kwargs)
@@ -273,6 +297,11 @@ class LocalAnchorLoader(yaml.Loader):
     def reset_anchors(cls):
         cls.anchors = {}
 
+    def compose_node(self, parent, index):
+        if self.peek_event().anchor is not None:
+            self.uses_anchors = True
+        return super(LocalAnchorLoader, self).compose_node(parent, index)
+
     # override the default composer to skip resetting the anchors at the
     # end of the current document
     def compose_document(self):
@@ -285,7 +314,54 @@ class LocalAnchorLoader(yaml.Loader):
         return node
 
 
-class LocalLoader(OrderedConstructor, LocalAnchorLoader):
+class LocalConstructor(OrderedConstructor):
+    """Handles the settings of the loaders used by the custom YAML objects,
+    see :class:`LocalLoader`."""
+
+    def __init__(self, stream, *args, **kwargs):
+        # make sure to pop off any local settings before passing to
+        # the parent constructor as any unknown args may cause errors.
+        self.search_path = list()
+        if 'search_path' in kwargs:
+            for p in kwargs.pop('search_path'):
+                logger.debug("Adding '{0}' to search path for include tags"
+                             .format(p))
+                self.search_path.append(os.path.normpath(p))
+
+        if 'escape_callback' in kwargs:
+            self.escape_callback = kwargs.pop('escape_callback')
+        else:
+            self.escape_callback = self._escape
+
+        # jinja2.BytecodeCache for the templates of the jinja2 tags
+        self.jinja2_bytecode_cache = kwargs.pop('jinja2_bytecode_cache',
+                                                None)
+
+        # list the files included while loading are added to, as tuples of
+        # the name given to the tag, the search path, the file found and
+        # its signature
+        self.dependencies = kwargs.pop('dependencies', None)
+
+        super(LocalConstructor, self).__init__(stream, *args, **kwargs)
+
+        # constructor to preserve order of maps and ensure that the order of
+        # keys returned is consistent across multiple python versions
+        self.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+                             type(self).construct_yaml_map)
+
+        # a directory already in the search path would never match first
+        if hasattr(stream, 'name'):
+            stream_dir = os.path.normpath(os.path.dirname(stream.name))
+            if stream_dir not in self.search_path:
+                self.search_path.append(stream_dir)
+        if os.path.curdir not in self.search_path:
+            self.search_path.append(os.path.curdir)
+
+    def _escape(self, data):
+        return re.sub(r'({|})', r'\1\1', data)
+
+
+class LocalLoader(LocalConstructor, LocalAnchorLoader):
     """Subclass for yaml.Loader which handles storing the search_path and
     escape_callback functions for use by the custom YAML objects to find files
     and escape the content where required.
@@ -315,35 +391,20 @@ class LocalLoader(OrderedConstructor, LocalAnchorLoader):
 
     """
 
-    def __init__(self, *args, **kwargs):
-        # make sure to pop off any local settings before passing to
-        # the parent constructor as any unknown args may cause errors.
-        self.search_path = list()
-        if 'search_path' in kwargs:
-            for p in kwargs.pop('search_path'):
-                logger.debug("Adding '{0}' to search path for include tags"
-                             .format(p))
-                self.search_path.append(os.path.normpath(p))
+    # the constructors of the custom YAML objects, shared with LocalCLoader
+    yaml_constructors = LocalAnchorLoader.yaml_constructors.copy()
 
-        if 'escape_callback' in kwargs:
-            self.escape_callback = kwargs.pop('escape_callback')
-        else:
-            self.escape_callback = self._escape
 
-        super(LocalLoader, self).__init__(*args, **kwargs)
+if hasattr(yaml, 'CLoader'):
+    class LocalCLoader(LocalConstructor, yaml.CLoader):
+        """Same as :class:`LocalLoader` on the parser of libyaml, which is a
+        lot faster. It doesn't keep the anchors between documents, so the
+        documents using the anchors of others are loaded by LocalLoader, see
+        :func:`load`."""
 
-        # constructor to preserve order of maps and ensure that the order of
-        # keys returned is consistent across multiple python versions
-        self.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-                             type(self).construct_yaml_map)
-
-        if hasattr(self.stream, 'name'):
-            self.search_path.append(os.path.normpath(
-                os.path.dirname(self.stream.name)))
-        self.search_path.append(os.path.normpath(os.path.curdir))
-
-    def _escape(self, data):
-        return re.sub(r'({|})', r'\1\1', data)
+        yaml_constructors = LocalLoader.yaml_constructors
+else:
+    LocalCLoader = None
 
 
 class LocalDumper(OrderedRepresenter, yaml.Dumper):
@@ -370,7 +431,8 @@ class J2String(BaseYAMLObject):
 
     @classmethod
     def from_yaml(cls, loader, node):
-        return Jinja2Loader(node.value, loader.search_path)
+        return Jinja2Loader(node.value, loader.search_path,
+                            loader.jinja2_bytecode_cache)
 
 
 class YamlListJoin(BaseYAMLObject):
@@ -392,9 +454,82 @@ class YamlListJoin(BaseYAMLObject):
                 node.start_mark)
 
 
+class _SearchPathIndex(object):
+    """The files found in a search path by the names given to the include
+    tags, along with the names not found, see :meth:`YamlInclude._find`.
+
+    With a ``poll_interval``, the directories looked in are checked at most
+    once every ``poll_interval`` seconds and the index is emptied once any
+    of them changed.
+    """
+
+    def __init__(self, search_path, poll_interval=None):
+        self.search_path = search_path
+        self.poll_interval = poll_interval
+        # name -> (file, directory of the search path) or None
+        self._found = {}
+        # directory -> modification time, None if missing
+        self._dirs = {}
+        self._checked = time.time()
+
+    @staticmethod
+    def _mtime(dirname):
+        try:
+            return os.stat(dirname).st_mtime
+        except OSError:
+            return None
+
+    def _poll(self):
+        now = time.time()
+        if now - self._checked < self.poll_interval:
+            return
+        self._checked = now
+        if any(self._mtime(dirname) != mtime
+               for dirname, mtime in list(self._dirs.items())):
+            self._found = {}
+            self._dirs = {}
+
+    def find(self, filename):
+        if self.poll_interval is not None:
+            self._poll()
+        try:
+            return self._found[filename]
+        except KeyError:
+            pass
+        found = None
+        for dirname in self.search_path:
+            candidate = os.path.expanduser(os.path.join(dirname, filename))
+            if self.poll_interval is not None:
+                parent = os.path.dirname(candidate)
+                if parent not in self._dirs:
+                    self._dirs[parent] = self._mtime(parent)
+            if os.path.isfile(candidate):
+                found = (candidate, dirname)
+                break
+        self._found[filename] = found
+        return found
+
+
 class YamlInclude(BaseYAMLObject):
     yaml_tag = u'!include:'
 
+    # _SearchPathIndex of each search path, shared by all the loaders of the
+    # process until reset_search_indexes() is called, which also bumps the
+    # generation to drop what LazyLoader included before
+    _search_indexes = {}
+    _generation = 0
+    # if set, the number of seconds after which the indexes check whether
+    # the files found changed, see reset_search_indexes()
+    search_index_poll_interval = None
+
+    # contents of the included files by path, along with their signature to
+    # only be used while the files are unchanged, and data loaded from the
+    # contents by the settings of the loader, shared by all the loaders of
+    # the process
+    _contents = {}
+    _data = {}
+    _lock = threading.Lock()
+
     @classmethod
     def _find_file(cls, filename, search_path):
         for dirname in search_path:
@@ -405,6 +540,35 @@ class YamlInclude(BaseYAMLObject):
                 return candidate
         return filename
 
+    @classmethod
+    def _find(cls, filename, search_path):
+        """Same as :meth:`_find_file` using the index of ``search_path``."""
+        key = tuple(search_path)
+        with cls._lock:
+            try:
+                index = cls._search_indexes[key]
+            except KeyError:
+                index = _SearchPathIndex(key, cls.search_index_poll_interval)
+                cls._search_indexes[key] = index
+        found = index.find(filename)
+        if found is None:
+            return filename
+        logger.debug("Including file '%s' from path '%s'",
+                     filename, found[1])
+        return found[0]
+
+    @classmethod
+    def reset_search_indexes(cls, poll_interval=None):
+        """Forget the files found in the search paths, to look for them
+        again on their next use. With a ``poll_interval``, the new indexes
+        check at most every ``poll_interval`` seconds whether the
+        directories they looked in changed, and then look for the files
+        again."""
+        with cls._lock:
+            cls._search_indexes = {}
+            cls.search_index_poll_interval = poll_interval
+            YamlInclude._generation += 1
+
     @classmethod
     def _open_file(cls, loader, node):
         node_str = loader.construct_yaml_str(node)
@@ -413,25 +577,69 @@ class YamlInclude(BaseYAMLObject):
         except KeyError:
             return cls._lazy_load(loader, cls.yaml_tag, node)
 
-        filename = cls._find_file(node_str, loader.search_path)
+        filename = cls._find(node_str, loader.search_path)
         try:
-            with io.open(filename, 'r', encoding='utf-8') as f:
-                return f.read()
+            signature = file_signature(filename)
+            if loader.dependencies is not None:
+                loader.dependencies.append(
+                    (node_str, tuple(loader.search_path), filename,
+                     signature))
+            return cls._read_file(filename, signature)
         except Exception:
             logger.error("Failed to include file using search path: '{0}'"
                          .format(':'.join(loader.search_path)))
             raise
 
+    @classmethod
+    def _read_file(cls, filename, signature):
+        with cls._lock:
+            cached = cls._contents.get(filename)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            contents = f.read()
+        with cls._lock:
+            cls._contents[filename] = (signature, contents)
+        return contents
+
     @classmethod
     def _from_file(cls, loader, node):
         contents = cls._open_file(loader, node)
         if isinstance(contents, LazyLoader):
             return contents
-
-        data = yaml.load(contents,
-                         functools.partial(cls.yaml_loader,
-                                           search_path=loader.search_path))
-        return data
+        if LocalCLoader is not None and isinstance(loader, LocalCLoader):
+            raise _IncludeNeedsLocalLoader()
+
+        # the data is parsed once for all the includes of the same contents,
+        # which are loaded the same way, and each include gets its own copy
+        # as modules may change it in place
+        key = (contents, type(loader), tuple(loader.search_path),
+               loader.jinja2_bytecode_cache)
+        with cls._lock:
+            cached = cls._data.get(key)
+        if cached is not None and includes_unchanged(cached[1]):
+            data, includes = cached
+        else:
+            # included with the loader used for the including file
+            includes = []
+            included_loader = type(loader)(
+                contents, search_path=loader.search_path,
+                jinja2_bytecode_cache=loader.jinja2_bytecode_cache,
+                dependencies=includes)
+            try:
+                data = included_loader.get_single_data()
+            finally:
+                included_loader.dispose()
+            # the data of documents using anchors depends on the ones of
+            # the including document
+            if included_loader.uses_anchors:
+                loader.uses_anchors = True
+            else:
+                with cls._lock:
+                    cls._data[key] = (data, includes)
+        if loader.dependencies is not None:
+            loader.dependencies.extend(includes)
+        return copy_tree(data)
 
     @classmethod
     def _lazy_load(cls, loader, tag, node_str):
@@ -456,6 +664,11 @@ class YamlInclude(BaseYAMLObject):
                 "found %s" % node.id, node.start_mark)
 
 
+class _IncludeNeedsLocalLoader(yaml.YAMLError):
+    """Raised by LocalCLoader to load the files including others with
+    LocalLoader instead, for them to share their anchors."""
+
+
 class YamlIncludeRaw(YamlInclude):
     yaml_tag = u'!include-raw:'
 
@@ -488,7 +701,8 @@ class YamlIncludeJinja2(YamlIncludeRaw):
         contents = cls._open_file(loader, node)
         if isinstance(contents, LazyLoader):
             return contents
-        return Jinja2Loader(contents, loader.search_path)
+        return Jinja2Loader(contents, loader.search_path,
+                            loader.jinja2_bytecode_cache)
 
 
 class DeprecatedTag(BaseYAMLObject):
@@ -515,6 +729,21 @@ class YamlIncludeRawEscapeDeprecated(DeprecatedTag):
     _new = YamlIncludeRawEscape
 
 
+def includes_unchanged(includes):
+    """Return whether the files in ``includes``, as listed by the
+    ``dependencies`` of :class:`LocalLoader`, are unchanged and would be
+    found at the same place in the search path again."""
+    for name, search_path, found, signature in includes:
+        if YamlInclude._find(name, search_path) != found:
+            return False
+        try:
+            if file_signature(found) != signature:
+                return False
+        except OSError:
+            return False
+    return True
+
+
 class CustomLoader(object):
     """Parent class for non-standard loaders."""
 
@@ -522,11 +751,68 @@ class CustomLoader(object):
 class Jinja2Loader(CustomLoader):
     """A loader for Jinja2-templated files."""
 
-    def __init__(self, contents, search_path):
-        self._template = jinja2.Template(contents)
-        self._template.environment.undefined = jinja2.StrictUndefined
-        self._template.environment.loader = jinja2.FileSystemLoader(
-            search_path)
+    # one environment per search path and bytecode cache directory, each
+    # with the templates compiled from their source, shared by all the
+    # loaders of the process
+    _environments = {}
+    _lock = threading.Lock()
+
+    def __init__(self, contents, search_path, bytecode_cache=None):
+        self._contents = contents
+        self._search_path = search_path
+        self._bytecode_cache = bytecode_cache
+        self._template = self._get_template(contents, search_path,
+                                            bytecode_cache)
+
+    def __getstate__(self):
+        # the template is compiled again when unpickled
+        return (self._contents, self._search_path, self._bytecode_cache)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @classmethod
+    def _get_template(cls, contents, search_path, bytecode_cache):
+        key = (tuple(search_path),
+               getattr(bytecode_cache, 'directory', bytecode_cache))
+        with cls._lock:
+            try:
+                environment, templates = cls._environments[key]
+            except KeyError:
+                environment = jinja2.Environment(
+                    undefined=jinja2.StrictUndefined,
+                    loader=jinja2.FileSystemLoader(search_path),
+                    bytecode_cache=bytecode_cache)
+                templates = {}
+                cls._environments[key] = (environment, templates)
+            try:
+                return templates[contents]
+            except KeyError:
+                template = cls._compile(environment, contents)
+                templates[contents] = template
+                return template
+
+    @staticmethod
+    def _compile(environment, contents):
+        bytecode_cache = environment.bytecode_cache
+        if bytecode_cache is None:
+            return environment.from_string(contents)
+
+        # jinja2 only caches the templates of its loader, so do the same
+        # for the ones given as strings, named by the hash of their source
+        name = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+        bucket = bytecode_cache.get_bucket(environment, name, None, contents)
+        code = bucket.code
+        if code is None:
+            code = environment.compile(contents)
+            bucket.code = code
+            try:
+                bytecode_cache.set_bucket(bucket)
+            except (IOError, OSError) as e:
+                logger.warning("Failed to write to the jinja2 bytecode "
+                               "cache: %s", e)
+        return environment.template_class.from_code(
+            environment, code, environment.make_globals(None))
 
     def format(self, **kwargs):
         return self._template.render(kwargs)
@@ -544,12 +830,23 @@ class CustomLoaderCollection(object):
 class LazyLoader(CustomLoader):
     """Helper class to provide lazy loading of files included using !include*
     tags where the path to the given file contains unresolved placeholders.
+
+    What is included for each path is kept and shared by all the uses of
+    the same path, until the search paths are reset, see
+    :meth:`YamlInclude.reset_search_indexes`. As with aliases, it must not be
+    changed.
     """
 
     def __init__(self, data):
         # str subclasses can only have one argument, so assume it is a tuple
         # being passed and unpack as needed
         self._cls, self._loader, self._node = data
+        # formatted path -> (generation of YamlInclude, what was included)
+        self._included = {}
+        if LocalCLoader is not None and isinstance(self._loader,
+                                                   LocalCLoader):
+            # the files are included by LocalLoader once loading is done
+            self._loader = self._local_loader(*self._loader_settings())
 
     def __str__(self):
         return "%s %s" % (self._cls.yaml_tag, self._node.value)
@@ -557,18 +854,122 @@ class LazyLoader(CustomLoader):
     def __repr__(self):
         return "%s %s" % (self._cls.yaml_tag, self._node.value)
 
+    def _loader_settings(self):
+        escape_callback = self._loader.escape_callback
+        if getattr(escape_callback, '__self__', None) is self._loader:
+            escape_callback = None
+        return (list(self._loader.search_path), escape_callback,
+                self._loader.jinja2_bytecode_cache)
+
+    @staticmethod
+    def _local_loader(search_path, escape_callback, jinja2_bytecode_cache):
+        kwargs = {'jinja2_bytecode_cache': jinja2_bytecode_cache}
+        if escape_callback is not None:
+            kwargs['escape_callback'] = escape_callback
+        loader = LocalLoader(u'', **kwargs)
+        loader.search_path = search_path
+        return loader
+
+    def __getstate__(self):
+        # keep the settings of the loader rather than the loader itself,
+        # which holds the whole stream it was reading
+        return ((self._cls,) + self._loader_settings() +
+                (self._node.tag, self._node.value))
+
+    def __setstate__(self, state):
+        self._cls = state[0]
+        self._loader = self._local_loader(*state[1:4])
+        self._node = yaml.ScalarNode(tag=state[4], value=state[5])
+        self._included = {}
+
     def format(self, *args, **kwargs):
-        node = yaml.ScalarNode(
-            tag=self._node.tag,
-            value=self._node.value.format(*args, **kwargs))
-        return self._cls.from_yaml(self._loader, node)
+        value = self._node.value.format(*args, **kwargs)
+        generation = YamlInclude._generation
+        try:
+            included_generation, included = self._included[value]
+            if included_generation == generation:
+                return included
+        except KeyError:
+            pass
+        node = yaml.ScalarNode(tag=self._node.tag, value=value)
+        included = self._cls.from_yaml(self._loader, node)
+        self._included[value] = (generation, included)
+        return included
 
 
 def load(stream, retain_anchors=False, **kwargs):
     if not retain_anchors:
         LocalAnchorLoader.reset_anchors()
+        position = _stream_position(stream)
+        if LocalCLoader is not None and position is not None:
+            try:
+                return yaml.load(stream,
+                                 functools.partial(LocalCLoader, **kwargs))
+            except yaml.YAMLError:
+                # load it again with LocalLoader, which knows about the
+                # anchors of the including files and gives errors pointing
+                # at the problem in the document
+                if hasattr(stream, 'seek'):
+                    stream.seek(position)
     return yaml.load(stream, functools.partial(LocalLoader, **kwargs))
 
 
+def load_json(stream, **kwargs):
+    """Load the JSON document in ``stream`` into the same data as
+    :func:`load` would, taking the same keyword arguments. See the JSON
+    Input section above for the objects standing for the tags."""
+    loader = []
+
+    def get_loader():
+        # created only once a tag is found
+        if not loader:
+            search_path = list(kwargs.pop('search_path', []))
+            if hasattr(stream, 'name'):
+                search_path.append(os.path.dirname(stream.name))
+            loader.append(LocalLoader(u'', search_path=search_path,
+                                      **kwargs))
+        return loader[0]
+
+    def construct(pairs):
+        if len(pairs) == 1:
+            tag, value = pairs[0]
+            if isinstance(tag, six.string_types) and tag.startswith('!'):
+                constructor = LocalLoader.yaml_constructors.get(tag)
+                if constructor is not None:
+                    return constructor(get_loader(), _json_node(tag, value))
+        return OrderedDict(pairs)
+
+    content = stream.read()
+    if isinstance(content, six.binary_type):
+        content = content.decode('utf-8')
+    return json.loads(content, object_pairs_hook=construct)
+
+
+def _json_node(tag, value):
+    """Return the YAML node of the value of a JSON object standing for
+    ``tag``."""
+    if isinstance(value, six.string_types):
+        return yaml.ScalarNode(tag, value)
+    if isinstance(value, list):
+        return yaml.SequenceNode(tag, [
+            _json_node(u'tag:yaml.org,2002:seq' if isinstance(item, list)
+                       else u'tag:yaml.org,2002:str', item)
+            for item in value])
+    raise yaml.constructor.ConstructorError(
+        None, None, "expected a string or a list of strings for %s, but "
+        "found %s" % (tag, type(value).__name__))
+
+
+def _stream_position(stream):
+    """Return the position of ``stream`` to load it again from there, None
+    if it can't be."""
+    if isinstance(stream, (six.text_type, six.binary_type)):
+        return 0
+    try:
+        return stream.tell()
+    except (AttributeError, IOError, OSError):
+        return None
+
+
 def dump(data, stream=None, **kwargs):
     return yaml.dump(data, stream, Dumper=LocalDumper, **kwargs)
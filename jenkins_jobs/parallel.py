@@ -17,7 +17,9 @@
 
 from functools import wraps
 import logging
+import multiprocessing
 from multiprocessing import cpu_count
+import os
 import threading
 import traceback
 
@@ -149,3 +151,120 @@ def concurrent(func):
         logging.debug("Concurrent task finished")
         return results
     return concurrentized
+
+
+# function being mapped by process_map(), inherited by the forked workers
+_forked_func = None
+
+
+def _call_forked(item):
+    return _forked_func(item)
+
+
+def _fork_context():
+    if not hasattr(os, 'fork'):
+        return None
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:
+        # python 2 always forks on platforms supporting it
+        return multiprocessing
+
+
+def process_map(func, items, n_workers=0):
+    """
+    Run ``func`` for each element of ``items`` in a pool of worker processes
+    and return the results in the same order as ``items``, just like the
+    builtin ``map``. Intended for CPU bound work that can't benefit from the
+    thread based :func:`concurrent` decorator.
+
+    The workers are forked from the current process, so ``func`` and any
+    state it references (such as a parser with all the loaded yaml) are
+    inherited instead of being pickled, only the elements of ``items`` and
+    the results need to be picklable. Exceptions raised by ``func`` are
+    re-raised in the calling process.
+
+    :arg callable func: function to call with each element of ``items``
+    :arg list items: arguments to pass to each of the calls
+    :arg int n_workers: number of worker processes to use, if '0' passed
+    will autodetect the number of cores. If '1' passed, or the platform
+    does not support forking, everything is run in the current process.
+    """
+    global _forked_func
+
+    items = list(items)
+    if not n_workers:
+        n_workers = cpu_count()
+    n_workers = min(n_workers, len(items))
+    context = _fork_context() if n_workers > 1 else None
+    if context is None:
+        return [func(item) for item in items]
+
+    logger.debug("Running %d items on %d worker processes",
+                 len(items), n_workers)
+    _forked_func = func
+    pool = context.Pool(n_workers)
+    try:
+        return pool.map(_call_forked, items, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        _forked_func = None
+
+
+def process_imap(func, items, n_workers=0, chunksize=1, window=1000):
+    """
+    Same as :func:`process_map` but returning an iterator over the results,
+    still in the same order as ``items``, with a single pool of worker
+    processes used for all of them. The results are handed out as they are
+    ready, and at most ``window`` items are given to the workers ahead of
+    the results taken from the iterator, so that the results don't pile up
+    in memory when they are consumed slower than they are computed.
+
+    :arg callable func: function to call with each element of ``items``
+    :arg list items: arguments to pass to each of the calls
+    :arg int n_workers: number of worker processes to use, see
+        :func:`process_map`
+    :arg int chunksize: number of items sent to a worker at once
+    :arg int window: most items given to the workers ahead of the results
+        taken, at least ``chunksize``
+    """
+    global _forked_func
+
+    items = list(items)
+    if not n_workers:
+        n_workers = cpu_count()
+    n_workers = min(n_workers, len(items))
+    context = _fork_context() if n_workers > 1 else None
+    if context is None:
+        for item in items:
+            yield func(item)
+        return
+
+    logger.debug("Running %d items on %d worker processes",
+                 len(items), n_workers)
+    ahead = threading.Semaphore(max(window, chunksize))
+    stopped = []
+
+    def throttled():
+        # iterated by the task handler thread of the pool, which only
+        # hands an item out when one of the window is free
+        for item in items:
+            ahead.acquire()
+            if stopped:
+                return
+            yield item
+
+    _forked_func = func
+    pool = context.Pool(n_workers)
+    try:
+        for result in pool.imap(_call_forked, throttled(), chunksize):
+            ahead.release()
+            yield result
+    finally:
+        # let the task handler thread go if it waits for the window
+        stopped.append(True)
+        ahead.release()
+        pool.terminate()
+        pool.join()
+        _forked_func = None
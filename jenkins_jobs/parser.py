@@ -15,19 +15,43 @@
 
 # Manage JJB yaml feature implementation
 
+from collections import deque
+from collections import OrderedDict
 import copy
 import fnmatch
+import functools
+import hashlib
 import io
 import itertools
 import logging
 import re
 import os
-
+import string
+import sys
+
+import six
+from six.moves import cPickle as pickle
+
+try:
+    from collections.abc import Mapping
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import Mapping
+    from collections import MutableMapping
+
+from jenkins_jobs.cache import ExpansionCache
+from jenkins_jobs.cache import Jinja2BytecodeCache
+from jenkins_jobs.cache import YamlCache
 from jenkins_jobs.constants import MAGIC_MANAGE_STRING
 from jenkins_jobs.errors import JenkinsJobsException
 from jenkins_jobs.formatter import deep_format
+from jenkins_jobs.formatter import find_static
+from jenkins_jobs.formatter import RenderPlan
 import jenkins_jobs.local_yaml as local_yaml
+from jenkins_jobs.parallel import process_imap
+from jenkins_jobs.parallel import process_map
 from jenkins_jobs import utils
+from jenkins_jobs.version import version_info
 
 __all__ = [
     "YamlParser"
@@ -35,6 +59,12 @@ __all__ = [
 
 logger = logging.getLogger(__name__)
 
+# most jobs or views expanded by the worker processes of
+# YamlParser.expandHandles() ahead of the ones taken from it, and how many
+# of them are sent to a worker at once
+_EXPANSION_WINDOW = 500
+_EXPANSION_CHUNK_SIZE = 10
+
 
 def matches(what, glob_patterns):
     """
@@ -64,19 +94,570 @@ def combination_matches(combination, match_combinations):
     (key1=2, key2=2)
     """
     for cmatch in match_combinations:
-        for key, val in combination.items():
-            if cmatch.get(key, val) != val:
+        for key, val in cmatch.items():
+            if key in combination and combination[key] != val:
                 break
         else:
             return True
     return False
 
 
+# marks a dimension value that can only be compared once formatted
+_UNKNOWN = object()
+
+
+def _dimension_value(value):
+    """
+    Returns the value a dimension entry sets its own key to once expanded
+    and formatted, or ``_UNKNOWN`` if that can't be told without formatting.
+    """
+    if isinstance(value, dict):
+        value = next(iter(value))
+    if isinstance(value, six.string_types):
+        if '{' in value or '}' in value:
+            return _UNKNOWN
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return _UNKNOWN
+
+
+def _prunable_excludes(dimensions, excludes):
+    """
+    Returns the exclude entries that only refer to dimension keys, grouped
+    by the position of the last dimension they refer to.
+    """
+    positions = {}
+    overridden = set()
+    for position, dimension in enumerate(dimensions):
+        for key, value in dimension:
+            positions[key] = position
+            if isinstance(value, dict):
+                inner = value[next(iter(value))] if value else None
+                if not isinstance(inner, dict):
+                    # leave it to the expansion to report the bad input
+                    return {}
+                # keys set by dict values override those of other dimensions
+                overridden.update(inner)
+
+    by_position = {}
+    for cmatch in excludes:
+        if not isinstance(cmatch, dict) or not cmatch:
+            continue
+        if any(key not in positions or key in overridden for key in cmatch):
+            continue
+        position = max(positions[key] for key in cmatch)
+        by_position.setdefault(position, []).append(cmatch)
+    return by_position
+
+
+def expand_combinations(dimensions, excludes):
+    """
+    Generates the same combinations, in the same order, as
+    ``itertools.product(*dimensions)``, where each dimension is a list of
+    ``(key, value)`` pairs, but skips those matching any of the exclude
+    entries without building them. The product is built one dimension at a
+    time and a partial combination is dropped, along with everything that
+    would extend it, as soon as it matches an entry.
+
+    Only entries referring exclusively to dimension keys, against values
+    not needing any formatting, can be decided this way. The remaining
+    ones are left to :func:`combination_matches` on the formatted
+    parameters.
+    """
+    dimensions = [list(dimension) for dimension in dimensions]
+    prunable = _prunable_excludes(dimensions, excludes)
+    if not prunable:
+        return itertools.product(*dimensions)
+
+    values = {}
+
+    def is_excluded(position):
+        for cmatch in prunable.get(position, []):
+            for key, val in cmatch.items():
+                if values[key] is _UNKNOWN or values[key] != val:
+                    break
+            else:
+                return True
+        return False
+
+    def product(position, prefix):
+        if position == len(dimensions):
+            yield tuple(prefix)
+            return
+        for pair in dimensions[position]:
+            values[pair[0]] = _dimension_value(pair[1])
+            prefix.append(pair)
+            if is_excluded(position):
+                logger.debug('Excluding combinations starting with %s',
+                             prefix)
+            else:
+                for combination in product(position + 1, prefix):
+                    yield combination
+            prefix.pop()
+
+    return product(0, [])
+
+
+class FrozenDefaults(Mapping):
+    """
+    Read only snapshot of a defaults set, resolved once and then shared by
+    all the jobs and templates using it instead of each getting a copy. The
+    values are shared as well and must not be modified.
+    """
+
+    def __init__(self, defaults):
+        self._data = OrderedDict(defaults)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(dict(self._data))
+
+
+# bumped whenever the expansion changes in a way which makes the entries of
+# the expansion cache obsolete
+_EXPANSION_CACHE_VERSION = 4
+# version of the data stored in the YAML cache, to be bumped whenever the
+# data loaded from the files changes
+_YAML_CACHE_VERSION = 1
+
+
+def _contains_custom_loader(data):
+    if isinstance(data, (local_yaml.CustomLoader,
+                         local_yaml.CustomLoaderCollection)):
+        return True
+    if isinstance(data, dict):
+        return any(_contains_custom_loader(key) or
+                   _contains_custom_loader(value)
+                   for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return any(_contains_custom_loader(item) for item in data)
+    return False
+
+
+def _identity(value):
+    return value
+
+
+class LazyExpansion(object):
+    """
+    A job or view whose name is known but which is only expanded when
+    :meth:`expand` is called, as returned by
+    :meth:`YamlParser.getJobHandles`.
+    """
+
+    __slots__ = ('kind', 'name', '_expand')
+
+    def __init__(self, kind, name, expand):
+        #: either 'job' or 'view'
+        self.kind = kind
+        #: the full name of the job or view
+        self.name = name
+        self._expand = expand
+
+    def expand(self):
+        """Return the expanded definition, the same as would be returned by
+        :meth:`YamlParser.expandYaml`. It is only expanded once, and not
+        kept by the handle."""
+        if self._expand is None:
+            raise JenkinsJobsException(
+                "{0} '{1}' was already expanded".format(self.kind, self.name))
+        expand, self._expand = self._expand, None
+        return expand()
+
+    def __repr__(self):
+        return '<{0} {1} {2!r}>'.format(type(self).__name__, self.kind,
+                                        self.name)
+
+
+class _LogRecorder(logging.Handler):
+    """Keeps the records logged while loading a file or expanding a project
+    in a worker process, for the parser to log them in the order of the
+    files or projects."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # the records are sent back to the parser, with their arguments
+        # merged into the message as these may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    def __enter__(self):
+        root = logging.getLogger()
+        self._handlers = root.handlers
+        root.handlers = [self]
+        return self
+
+    def __exit__(self, *exc_info):
+        logging.getLogger().handlers = self._handlers
+
+    @staticmethod
+    def replay(records):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+class _CachedExpansion(object):
+    """The expanded items of a project in the expansion cache, loaded from
+    disk when the first of them is needed and handed out only once."""
+
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        self._items = None
+
+    def take(self, index):
+        if self._items is None:
+            self._items = self._cache.get(self._key)
+            if self._items is None:
+                raise JenkinsJobsException(
+                    "Expansion cache entry '{0}' is missing, it was "
+                    "probably removed while in use".format(self._key))
+        item, self._items[index] = self._items[index], None
+        return item
+
+
+# marks a key removed from the lower layers of a LayeredParams
+_DELETED = object()
+
+
+class LayeredParams(MutableMapping):
+    """
+    Read-through view of a stack of parameter mappings, the first of which
+    takes precedence, giving the same result as updating a dict with each
+    of them in turn starting from the last one, without copying any of
+    them. All the changes are written to the first mapping, the others are
+    never modified, so many combinations can share the same lower layers.
+    Iteration follows the order keys first appear in, from the last layer.
+    """
+
+    def __init__(self, *maps):
+        self.maps = list(maps) or [{}]
+
+    def new_child(self, mapping=None):
+        """Return a new view with ``mapping`` on top of this one."""
+        return type(self)({} if mapping is None else mapping, self)
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                value = mapping[key]
+                if value is _DELETED:
+                    break
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key] is not _DELETED
+        return False
+
+    def __setitem__(self, key, value):
+        self.maps[0][key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.maps[0][key] = _DELETED
+
+    def __iter__(self):
+        seen = set()
+        for mapping in reversed(self.maps):
+            for key in mapping:
+                if key not in seen:
+                    seen.add(key)
+                    if key in self:
+                        yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def _may_need_format(value):
+    if isinstance(value, six.string_types):
+        return '{' in value or '}' in value
+    return isinstance(value, (list, dict)) or hasattr(value, 'format')
+
+
+_formatter = string.Formatter()
+
+
+def _string_references(value, references):
+    try:
+        fields = list(_formatter.parse(value))
+    except ValueError:
+        # not a valid format string, let formatting report it
+        return
+    for _, field_name, format_spec, _ in fields:
+        if field_name is None:
+            continue
+        if field_name == 'obj' and format_spec:
+            # '{obj:key}' returns the value of key itself
+            field_name, format_spec = format_spec, None
+        # the name is followed by any attribute or item lookup, or by the
+        # fallback of '{key|default}'
+        name = re.match(r'[^.\[|]*', field_name).group(0)
+        if name:
+            references.add(name)
+        if format_spec and '{' in format_spec:
+            _string_references(format_spec, references)
+
+
+def _param_references(key, value):
+    """Return the set of the names of the parameters used by a parameter, or
+    None if they can't be known, as for custom objects formatting themselves.
+    """
+    references = set()
+    stack = [key, value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, six.string_types):
+            if '{' in item or '}' in item:
+                _string_references(item, references)
+        elif isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif hasattr(item, 'format'):
+            return None
+    return references
+
+
+def _resolution_order(references):
+    """Return the order in which to format the parameters in ``references``,
+    a mapping of their names to the set of the names they use as returned by
+    _param_references(). The parameters using no other come first, then the
+    others with each after the ones it uses, then the ones using unknown
+    parameters. Raise JenkinsJobsException on circular references.
+    """
+    dependent = dict((key, refs) for key, refs in references.items() if refs)
+    order = [key for key, refs in references.items()
+             if refs is not None and not refs]
+
+    done = set()
+    for root in dependent:
+        if root in done:
+            continue
+        # depth first walk, the path being the parameters being resolved
+        path = [root]
+        stack = [iter(dependent[root])]
+        while stack:
+            for ref in stack[-1]:
+                if ref not in dependent or ref in done:
+                    continue
+                if ref in path:
+                    cycle = path[path.index(ref):] + [ref]
+                    raise JenkinsJobsException(
+                        "Circular reference between parameters: {0}"
+                        .format(" -> ".join(cycle)))
+                path.append(ref)
+                stack.append(iter(dependent[ref]))
+                break
+            else:
+                stack.pop()
+                key = path.pop()
+                done.add(key)
+                order.append(key)
+
+    order.extend(key for key, refs in references.items() if refs is None)
+    return order
+
+
+def _required_params(references, roots):
+    """Return the names in ``roots`` and of all the parameters they use,
+    directly or not, as found in ``references``. Return None if that can't
+    be known."""
+    required = set()
+    pending = list(roots)
+    while pending:
+        key = pending.pop()
+        if key in required:
+            continue
+        required.add(key)
+        refs = references.get(key, ())
+        if refs is None:
+            return None
+        pending.extend(refs)
+    return required
+
+
+class _ParamsResolver(object):
+    """Order in which to format the parameters shared by all the
+    combinations of a template, worked out only once and reused for every
+    combination not adding references of its own.
+
+    When ``needed`` is given, only these parameters and the ones they use
+    are formatted right away, see :meth:`orderFor`.
+    """
+
+    def __init__(self, params, needed=None):
+        self.needed = needed
+        self.references = OrderedDict(
+            (key, _param_references(key, value))
+            for key, value in params.items()
+            if _may_need_format(key) or _may_need_format(value))
+        try:
+            self.order = self._split(self.references,
+                                     _resolution_order(self.references))
+        except JenkinsJobsException:
+            # the combinations may replace some of the parameters involved
+            self.order = None
+
+    def _split(self, references, order):
+        if self.needed is None:
+            return order, []
+        # parameters with a name to format are renamed, which has to be
+        # done before anything else looks them up
+        roots = set(self.needed)
+        roots.update(key for key in references if _may_need_format(key))
+        required = _required_params(references, roots)
+        if required is None:
+            return order, []
+        return ([key for key in order if key in required],
+                [key for key in order if key not in required])
+
+    def orderFor(self, values):
+        """Return the order in which to format the shared parameters with
+        ``values`` layered on top of them, as two lists: the parameters to
+        format right away and the ones which can be formatted afterwards,
+        when the combination is actually expanded."""
+        changed = self.order is None
+        new_references = {}
+        for key, value in values.items():
+            if _may_need_format(key) or _may_need_format(value):
+                refs = _param_references(key, value)
+                new_references[key] = refs
+                if refs != set() or key not in self.references:
+                    changed = True
+        if not changed:
+            return self.order
+
+        references = self.references.copy()
+        for key in values:
+            references.pop(key, None)
+        references.update(new_references)
+        return self._split(references, _resolution_order(references))
+
+
+# most renders kept for any key of a template, past which the renders of the
+# key are assumed to differ for every combination and are no longer kept
+_RENDERS_PER_KEY = 32
+
+_MISSING = object()
+
+# types of the parameter values renders are kept by, the render of anything
+# else, such as the loaders of !include-raw: and !j2: tags formatted with the
+# other parameters, may differ for the same value
+_PLAIN_TYPES = six.string_types + six.integer_types + (
+    float, bool, type(None))
+
+
+class _TemplateRenders(object):
+    """
+    Formats a template for the combinations of a project, one top level key
+    at a time with the RenderPlan of each key. The parameters used by each
+    key are found once, and its render is kept by the values of these
+    parameters, to be shared by the combinations with the same values
+    instead of being formatted again.
+    """
+
+    def __init__(self, template, allow_empty, plans):
+        self.template = template
+        self.allow_empty = allow_empty
+        self.plans = plans
+        # names of the parameters used by each key, None when unknown
+        self.references = dict(
+            (key, sorted(refs) if refs is not None else None)
+            for key, refs in ((key, _param_references(key, value))
+                              for key, value in template.items()))
+        self.renders = dict((key, {}) for key in template)
+
+    def _renderKey(self, params, key):
+        refs = self.references[key]
+        if refs is None:
+            return None
+        values = []
+        for ref in refs:
+            value = params.get(ref, _MISSING)
+            if value is not _MISSING and not isinstance(value, _PLAIN_TYPES):
+                return None
+            values.append((ref, type(value), value))
+        return tuple(values)
+
+    def render(self, params):
+        expanded = {}
+        for key, value in self.template.items():
+            renders = self.renders[key]
+            render_key = None
+            if renders is not None:
+                render_key = self._renderKey(params, key)
+            if render_key is not None and render_key in renders:
+                expanded.update(renders[render_key])
+                continue
+
+            formatted = self.plans[key].render(params, self.allow_empty)
+            expanded.update(formatted)
+            if render_key is not None:
+                if len(renders) < _RENDERS_PER_KEY:
+                    renders[render_key] = formatted
+                else:
+                    self.renders[key] = None
+        return expanded
+
+
 class YamlParser(object):
     def __init__(self, jjb_config=None):
         self.data = {}
         self.jobs = []
         self.views = []
+        # generated jobs and views by name, populated by expandYaml(), or
+        # their LazyExpansion by getHandles(), getJobHandles() and
+        # getViewHandles()
+        self.jobs_index = OrderedDict()
+        self.views_index = OrderedDict()
+        # defaults sets resolved by _getDefaultsSet()
+        self._defaults_sets = {}
+        # ids of the lists and dicts without anything to format, and all
+        # the ones looked at by _findStatic()
+        self._static = set()
+        self._static_seen = {}
+        # RenderPlan of the keys of the templates, by key and id of value
+        self._render_plans = {}
+        # ExpansionCache, created when first needed
+        self._expansion_cache = None
+        # messages about duplicates recorded for the expansion cache
+        self._dups_messages = None
+        # Jinja2BytecodeCache, created when first needed
+        self._jinja2_bytecode_cache = None
+        # YamlCache, created when first needed
+        self._yaml_cache = None
+        #: utils.FileEntry of the files loaded by load_files(), by real path,
+        #: with their size and modification time when found
+        self.manifest = OrderedDict()
 
         self.jjb_config = jjb_config
         self.keep_desc = jjb_config.yamlparser['keep_descriptions']
@@ -97,28 +678,44 @@ class YamlParser(object):
         files_to_process = []
         for path in fn:
             if not hasattr(path, 'read') and os.path.isdir(path):
-                files_to_process.extend([os.path.join(path, f)
-                                         for f in sorted(os.listdir(path))
-                                         if (f.endswith('.yml') or
-                                             f.endswith('.yaml'))])
+                files_to_process.extend(utils.list_files(path,
+                                                         ('.yml', '.yaml')))
             else:
                 files_to_process.append(path)
 
         # symlinks used to allow loading of sub-dirs can result in duplicate
         # definitions of macros and templates when loading all from top-level
         unique_files = []
+        seen = set()
         for f in files_to_process:
             if hasattr(f, 'read'):
                 unique_files.append(f)
                 continue
+            entry = None
+            if isinstance(f, utils.FileEntry):
+                entry, f = f, f.path
             rpf = os.path.realpath(f)
-            if rpf not in unique_files:
-                unique_files.append(rpf)
-            else:
+            if rpf in seen:
                 logger.warning("File '%s' already added as '%s', ignoring "
                                "reference to avoid duplicating yaml "
                                "definitions." % (f, rpf))
+                continue
+            seen.add(rpf)
+            unique_files.append(rpf)
+            if entry is None:
+                try:
+                    entry = utils.FileEntry(rpf, *utils.file_signature(rpf))
+                except OSError:
+                    continue
+            if entry.size is not None:
+                self.manifest[rpf] = entry._replace(path=rpf)
+
+        # look for the included files again, in case any were added or
+        # removed since the last files were loaded
+        local_yaml.YamlInclude.reset_search_indexes(
+            self.jjb_config.yamlparser['include_poll_interval'])
 
+        loaded = self._loadInParallel(unique_files)
         for in_file in unique_files:
             # use of ask-for-permissions instead of ask-for-forgiveness
             # performs better when low use cases.
@@ -129,20 +726,65 @@ class YamlParser(object):
             logger.debug("Parsing YAML file {0}".format(fname))
             if hasattr(in_file, 'read'):
                 self._parse_fp(in_file)
+            elif in_file in loaded:
+                data, records = loaded.pop(in_file)
+                _LogRecorder.replay(records)
+                self._addData(data, in_file)
             else:
                 self.parse(in_file)
 
+    def _loadInParallel(self, files):
+        """Return the data of the files in ``files`` given by path, loaded
+        by ``parsing_workers`` processes, by path, along with the records
+        logged while loading them. The files failing to load are left out,
+        to be loaded again in order by the caller and fail the same way as
+        when loading them serially."""
+        n_workers = self.jjb_config.yamlparser['parsing_workers']
+        paths = [f for f in files if not hasattr(f, 'read')]
+        # with retain_anchors each file may use the anchors of the previous
+        # ones, so they can only be loaded one after the other
+        if (n_workers == 1 or len(paths) < 2 or
+                self.jjb_config.yamlparser['retain_anchors']):
+            return {}
+
+        try:
+            results = process_map(self._tryLoadPath, paths, n_workers)
+        except Exception as e:
+            # such as data which can't be sent back by the workers
+            logger.debug("Parsing the YAML files serially: %s", e)
+            return {}
+        return dict((path, (data, records)) for path, (loaded, data, records)
+                    in zip(paths, results) if loaded)
+
+    def _tryLoadPath(self, fn):
+        with _LogRecorder() as recorder:
+            try:
+                return True, self._loadPath(fn), recorder.records
+            except Exception:
+                return False, None, []
+
     def _parse_fp(self, fp):
+        self._addData(self._load(fp), getattr(fp, 'name', fp))
+
+    def _load(self, fp, **kwargs):
+        if self.jjb_config.yamlparser['jinja2_bytecode_cache']:
+            if self._jinja2_bytecode_cache is None:
+                self._jinja2_bytecode_cache = Jinja2BytecodeCache()
+            kwargs['jinja2_bytecode_cache'] = self._jinja2_bytecode_cache
+        name = getattr(fp, 'name', None)
+        if isinstance(name, six.string_types) and name.endswith('.json'):
+            return local_yaml.load_json(fp, search_path=self.path, **kwargs)
         # wrap provided file streams to ensure correct encoding used
-        data = local_yaml.load(utils.wrap_stream(fp),
+        return local_yaml.load(utils.wrap_stream(fp),
                                self.jjb_config.yamlparser['retain_anchors'],
-                               search_path=self.path)
+                               search_path=self.path, **kwargs)
+
+    def _addData(self, data, fname):
         if data:
             if not isinstance(data, list):
                 raise JenkinsJobsException(
                     "The topmost collection in file '{fname}' must be a list,"
-                    " not a {cls}".format(fname=getattr(fp, 'name', fp),
-                                          cls=type(data)))
+                    " not a {cls}".format(fname=fname, cls=type(data)))
             for item in data:
                 cls, dfn = next(iter(item.items()))
                 group = self.data.get(cls, {})
@@ -161,13 +803,58 @@ class YamlParser(object):
                 if _id in group:
                     self._handle_dups(
                         "Duplicate entry found in '{0}: '{1}' already "
-                        "defined".format(fp.name, _id))
+                        "defined".format(fname, _id))
                 group[_id] = dfn
                 self.data[cls] = group
+            self._clearDerivedData()
 
     def parse(self, fn):
+        self._addData(self._loadPath(fn), fn)
+
+    def _loadPath(self, fn):
+        if (self.jjb_config.yamlparser['yaml_cache'] and
+                not self.jjb_config.yamlparser['retain_anchors']):
+            return self._loadCached(fn)
+        with io.open(fn, 'r', encoding='utf-8') as fp:
+            return self._load(fp)
+
+    def _loadCached(self, fn):
+        """Return the data of the file ``fn`` from the YAML cache, loading
+        and storing it there first if needed."""
+        if self._yaml_cache is None:
+            self._yaml_cache = YamlCache()
+        cache = self._yaml_cache
+
+        key = hashlib.sha256(pickle.dumps((
+            _YAML_CACHE_VERSION,
+            version_info.version_string(),
+            sys.version_info[:2],
+            os.path.abspath(fn),
+            self.path,
+            self.jjb_config.yamlparser['jinja2_bytecode_cache'],
+        ), protocol=2)).hexdigest()
+        # taken when the file was found, or else before reading the files,
+        # so that a change made while they are being read is noticed by the
+        # next run
+        entry = self.manifest.get(fn)
+        if entry is not None:
+            signature = entry.signature
+        else:
+            signature = utils.file_signature(fn)
+        if not self.jjb_config.builder['flush_cache']:
+            data = cache.get(key, signature)
+            if data is not None:
+                logger.debug("Using the cached data of '{0}'".format(fn))
+                return data
+
+        includes = []
         with io.open(fn, 'r', encoding='utf-8') as fp:
-            self._parse_fp(fp)
+            data = self._load(fp, dependencies=includes)
+        try:
+            cache.set(key, fn, signature, includes, data)
+        except Exception as e:
+            logger.warning("Failed to write to the YAML cache: %s", e)
+        return data
 
     def _handle_dups(self, message):
 
@@ -176,6 +863,8 @@ class YamlParser(object):
             raise JenkinsJobsException(message)
         else:
             logger.warning(message)
+            if self._dups_messages is not None:
+                self._dups_messages.append(message)
 
     def _getJob(self, name):
         job = self.data.get('job', {}).get(name, None)
@@ -192,20 +881,39 @@ class YamlParser(object):
             return job
         return self._applyDefaults(job)
 
-    def _applyDefaults(self, data, override_dict=None):
-        if override_dict is None:
-            override_dict = {}
+    def _getDefaultsSet(self, whichdefaults):
+        """Return the named defaults set, resolved only once into a read only
+        mapping which is then shared by everything using it."""
+        try:
+            return self._defaults_sets[whichdefaults]
+        except KeyError:
+            pass
 
-        whichdefaults = data.get('defaults', 'global')
-        defaults = copy.deepcopy(self.data.get('defaults',
-                                 {}).get(whichdefaults, {}))
+        defaults = self.data.get('defaults', {}).get(whichdefaults, {})
         if defaults == {} and whichdefaults != 'global':
             raise JenkinsJobsException("Unknown defaults set: '{0}'"
                                        .format(whichdefaults))
+        frozen = FrozenDefaults(defaults)
+        self._defaults_sets[whichdefaults] = frozen
+        return frozen
+
+    def _getDefaults(self, data, override_dict=None):
+        """Return a read only view of the defaults set selected by ``data``
+        with the values of ``override_dict`` for the keys it sets."""
+        if override_dict is None:
+            override_dict = {}
+
+        defaults = self._getDefaultsSet(data.get('defaults', 'global'))
+        overrides = dict((key, override_dict[key])
+                         for key in override_dict.keys() if key in defaults)
+        if not overrides:
+            return defaults
+        return LayeredParams(overrides, defaults)
 
-        for key in override_dict.keys():
-            if key in defaults.keys():
-                defaults[key] = override_dict[key]
+    def _applyDefaults(self, data, override_dict=None, copy_defaults=False):
+        defaults = self._getDefaults(data, override_dict)
+        if copy_defaults:
+            defaults = copy.deepcopy(dict(defaults))
 
         newdata = {}
         newdata.update(defaults)
@@ -227,7 +935,7 @@ class YamlParser(object):
 
         return data['name']
 
-    def expandYaml(self, registry, jobs_glob=None):
+    def _handleData(self, registry):
         changed = True
         while changed:
             changed = False
@@ -235,175 +943,461 @@ class YamlParser(object):
                 if hasattr(module, 'handle_data'):
                     if module.handle_data(self.data):
                         changed = True
+        self._clearDerivedData()
+
+    def _clearDerivedData(self):
+        """Forget what was worked out from the data, once it changes."""
+        self._defaults_sets.clear()
+        self._static.clear()
+        self._static_seen.clear()
+        self._render_plans.clear()
+
+    def _findStatic(self, data):
+        """Look for the values of ``data`` which have nothing to format,
+        and which deep_format() can then skip, see
+        :func:`jenkins_jobs.formatter.find_static`."""
+        for value in data.values():
+            find_static(value, self._static, self._static_seen)
 
-        for job in self.data.get('job', {}).values():
-            job = self._applyDefaults(job)
-            job['name'] = self._getfullname(job)
+    def expandYaml(self, registry, jobs_glob=None):
+        self._handleData(registry)
+
+        for kind, name, expand in self._iterPlainItems(jobs_glob):
+            if kind == 'job':
+                self.jobs.append(expand())
+            else:
+                self.views.append(expand())
+
+        projects = list(self.data.get('project', {}).values())
+        n_workers = self.jjb_config.yamlparser['expansion_workers']
+        if n_workers != 1 and len(projects) > 1:
+            self._expandProjectsParallel(projects, jobs_glob, n_workers)
+        else:
+            for project in projects:
+                self._expandProject(project, jobs_glob)
+
+        # check for duplicate generated jobs and views
+        self.jobs_index = self._removeDuplicates(self.jobs, 'job')
+        self.views_index = self._removeDuplicates(self.views, 'view')
 
-            if jobs_glob and not matches(job['name'], jobs_glob):
-                logger.debug("Ignoring job {0}".format(job['name']))
+        return self.jobs, self.views
+
+    def iterJobs(self, registry, jobs_glob=None):
+        """Return an iterator over the expanded jobs, in the same order and
+        with the same handling of duplicates as :meth:`expandYaml`.
+
+        Only the names of the jobs are worked out by this call, which also
+        reports any duplicate definitions. Each job is then expanded when
+        the iterator reaches it, so that the caller only needs to keep the
+        jobs it is working on in memory. The expanded jobs are not added to
+        :attr:`jobs`.
+        """
+        return self.expandHandles(self.getJobHandles(registry, jobs_glob))
+
+    def iterViews(self, registry, views_glob=None):
+        """Same as :meth:`iterJobs` for views."""
+        return self.expandHandles(self.getViewHandles(registry, views_glob))
+
+    def getJobHandles(self, registry, jobs_glob=None):
+        """Return the list of the :class:`LazyExpansion` of the jobs, in the
+        same order and with the same handling of duplicates as
+        :meth:`expandYaml`, without expanding any of them.
+
+        This is all that is needed when only the names of the jobs matter,
+        and the registry doesn't need any plugins information for it.
+        """
+        return self._getHandles(registry, ('job',), jobs_glob)['job']
+
+    def getViewHandles(self, registry, views_glob=None):
+        """Same as :meth:`getJobHandles` for views."""
+        return self._getHandles(registry, ('view',), views_glob)['view']
+
+    def getHandles(self, registry, jobs_glob=None):
+        """Return the lists returned by :meth:`getJobHandles` and
+        :meth:`getViewHandles`, worked out together from a single pass over
+        the data."""
+        handles = self._getHandles(registry, ('job', 'view'), jobs_glob)
+        return handles['job'], handles['view']
+
+    def _getHandles(self, registry, kinds, glob):
+        self._handleData(registry)
+
+        items = itertools.chain(
+            self._iterPlainItems(glob),
+            *(self._iterProject(project, glob, kinds)
+              for project in self.data.get('project', {}).values()))
+        # index of the names seen so far for each kind, when a name is
+        # repeated the last definition wins and takes the place of the
+        # earlier one
+        handles = dict((kind, OrderedDict()) for kind in kinds)
+        for kind, name, expand in items:
+            if kind not in handles:
                 continue
-            logger.debug("Expanding job '{0}'".format(job['name']))
-            self._formatDescription(job)
-            self.jobs.append(job)
+            if name in handles[kind]:
+                self._handle_dups("Duplicate definitions for {0} '{1}' "
+                                  "specified".format(kind, name))
+                del handles[kind][name]
+            handles[kind][name] = LazyExpansion(kind, name, expand)
+
+        if 'job' in handles:
+            self.jobs_index = handles['job']
+        if 'view' in handles:
+            self.views_index = handles['view']
+        return dict((kind, list(handles[kind].values())) for kind in kinds)
+
+    def expandHandles(self, handles):
+        """Return an iterator expanding each of the ``handles`` returned by
+        :meth:`getJobHandles` or :meth:`getViewHandles` only when reached,
+        using several processes if ``expansion_workers`` is set."""
+        handles = deque(handles)
+        n_workers = self.jjb_config.yamlparser['expansion_workers']
+        if n_workers == 1:
+            while handles:
+                yield handles.popleft().expand()
+            return
+
+        # a single pool of workers, forked with all the handles, expands
+        # them while only a window of expanded items is held at once
+        handles = list(handles)
+        for item in process_imap(lambda index: handles[index].expand(),
+                                 range(len(handles)), n_workers,
+                                 chunksize=_EXPANSION_CHUNK_SIZE,
+                                 window=_EXPANSION_WINDOW):
+            yield item
+
+    def _iterPlainItems(self, jobs_glob=None):
+        """Generate the ``(kind, name, expand)`` tuples of the jobs and views
+        defined directly, ``expand`` being the function returning the
+        expanded definition."""
+        for job in self.data.get('job', {}).values():
+            name = self._getfullname(self._applyDefaults(job))
+            if jobs_glob and not matches(name, jobs_glob):
+                logger.debug("Ignoring job {0}".format(name))
+                continue
+            logger.debug("Expanding job '{0}'".format(name))
+            yield 'job', name, functools.partial(self._expandJob, job)
 
         for view in self.data.get('view', {}).values():
-            view['name'] = self._getfullname(view)
-            logger.debug("Expanding view '{0}'".format(view['name']))
-            self._formatDescription(view)
-            self.views.append(view)
-
-        for project in self.data.get('project', {}).values():
-            logger.debug("Expanding project '{0}'".format(project['name']))
-            # use a set to check for duplicate job references in projects
-            seen = set()
-            for jobspec in project.get('jobs', []):
-                if isinstance(jobspec, dict):
-                    # Singleton dict containing dict of job-specific params
-                    jobname, jobparams = next(iter(jobspec.items()))
-                    if not isinstance(jobparams, dict):
-                        jobparams = {}
+            name = self._getfullname(view)
+            logger.debug("Expanding view '{0}'".format(name))
+            yield 'view', name, functools.partial(self._expandView, view)
+
+    def _expandJob(self, job):
+        # generating the XML may modify the job data, so don't let it
+        # reach the defaults shared with every other job
+        job = self._applyDefaults(job, copy_defaults=True)
+        job['name'] = self._getfullname(job)
+        self._formatDescription(job)
+        return job
+
+    def _expandView(self, view):
+        view['name'] = self._getfullname(view)
+        self._formatDescription(view)
+        return view
+
+    def _removeDuplicates(self, items, kind):
+        """Remove repeated definitions of the same name from the list of
+        generated ``items`` in place, keeping the last definition, and return
+        an ordered index of the remaining items by name."""
+        seen = set()
+        unique = []
+        # walk the list in reverse so that last definition wins
+        for item in reversed(items):
+            if item['name'] in seen:
+                self._handle_dups("Duplicate definitions for {0} '{1}' "
+                                  "specified".format(kind, item['name']))
+                continue
+            seen.add(item['name'])
+            unique.append(item)
+        unique.reverse()
+        items[:] = unique
+        return OrderedDict((item['name'], item) for item in items)
+
+    def _expandProjectsParallel(self, projects, jobs_glob, n_workers):
+        def expand(index):
+            # start each project from a clean slate so that only the jobs
+            # and views generated for it are sent back from the worker,
+            # along with what it logged
+            self.jobs = []
+            self.views = []
+            with _LogRecorder() as recorder:
+                try:
+                    self._expandProject(projects[index], jobs_glob)
+                except Exception:
+                    return False, None, None, []
+                return True, self.jobs, self.views, recorder.records
+
+        jobs, views = self.jobs, self.views
+        try:
+            results = process_map(expand, range(len(projects)), n_workers)
+        finally:
+            self.jobs, self.views = jobs, views
+
+        # merge in project order so the output, the duplicate checks and
+        # the messages logged are the same as when expanding serially
+        for project, (expanded, project_jobs, project_views, records) in \
+                zip(projects, results):
+            if not expanded:
+                # expanded again to raise the error of the first project
+                # failing, and log what leads to it, just as serially
+                self._expandProject(project, jobs_glob)
+                continue
+            _LogRecorder.replay(records)
+            self.jobs.extend(project_jobs)
+            self.views.extend(project_views)
+
+    def _expandProject(self, project, jobs_glob=None):
+        for kind, name, expand in self._iterProject(project, jobs_glob):
+            if kind == 'job':
+                self.jobs.append(expand())
+            else:
+                self.views.append(expand())
+
+    def _iterProject(self, project, jobs_glob=None, kinds=('job', 'view')):
+        """Generate the ``(kind, name, expand)`` tuples of the jobs and views
+        of a project, see :meth:`_iterPlainItems`. Templates of the kinds
+        not in ``kinds`` may be skipped."""
+        key = None
+        if self.jjb_config.yamlparser['expansion_cache']:
+            key = self._expansionCacheKey(project, jobs_glob)
+        if key is None:
+            return self._iterProjectItems(project, jobs_glob, kinds)
+        return self._iterCachedProject(project, jobs_glob, kinds, key)
+
+    def _iterCachedProject(self, project, jobs_glob, kinds, key):
+        if self._expansion_cache is None:
+            self._expansion_cache = ExpansionCache()
+        cache = self._expansion_cache
+
+        entry = None
+        if not self.jjb_config.builder['flush_cache']:
+            entry = cache.get_names(key)
+        if entry is not None:
+            logger.debug("Using the cached expansion of project '{0}'"
+                         .format(project['name']))
+            names, messages = entry
+            # as logged when expanding the project
+            for message in messages:
+                self._handle_dups(message)
+        else:
+            # the cache entry holds both the jobs and views, and what was
+            # logged about duplicates
+            messages = []
+            self._dups_messages = messages
+            try:
+                items = [(kind, name, expand()) for kind, name, expand
+                         in self._iterProjectItems(project, jobs_glob)]
+            finally:
+                self._dups_messages = None
+            try:
+                cache.set(key, items, messages)
+            except (IOError, OSError) as e:
+                logger.warning("Failed to write to the expansion cache: %s",
+                               e)
+                for kind, name, item in items:
+                    if kind in kinds:
+                        yield kind, name, functools.partial(_identity, item)
+                return
+            names = [(kind, name) for kind, name, _ in items]
+            del items
+
+        # the expanded items are only loaded back when needed
+        entry = _CachedExpansion(cache, key)
+        for index, (kind, name) in enumerate(names):
+            if kind in kinds:
+                yield kind, name, functools.partial(entry.take, index)
+
+    def _expansionCacheKey(self, project, jobs_glob):
+        """Return the key of the expansion of ``project`` in the expansion
+        cache, worked out from everything used to expand it, or None if it
+        can't be cached."""
+        defaults = set(['global'])
+        references = []
+
+        def iter_specs(specs):
+            for spec in specs:
+                if isinstance(spec, dict):
+                    name, params = next(iter(spec.items()))
+                    yield name, params
                 else:
-                    jobname = jobspec
-                    jobparams = {}
-                job = self._getJob(jobname)
-                if job:
-                    # Just naming an existing defined job
-                    if jobname in seen:
-                        self._handle_dups("Duplicate job '{0}' specified "
-                                          "for project '{1}'"
-                                          .format(jobname, project['name']))
-                    seen.add(jobname)
+                    yield spec, None
+
+        def add_reference(kind, name, params):
+            if isinstance(params, dict):
+                defaults.add(params.get('defaults', 'global'))
+            group = self.data.get(kind + '-group', {}).get(name)
+            template = self.data.get(kind + '-template', {}).get(name)
+            for data in (group, template):
+                if data is not None:
+                    defaults.add(data.get('defaults', 'global'))
+            references.append((kind, name, name in self.data.get(kind, {}),
+                               group, template))
+            return group
+
+        defaults.add(project.get('defaults', 'global'))
+        for kind, specs_key in (('job', 'jobs'), ('view', 'views')):
+            for name, params in iter_specs(project.get(specs_key, [])):
+                group = add_reference(kind, name, params)
+                if group is None:
                     continue
-                # see if it's a job group
-                group = self._getJobGroup(jobname)
-                if group:
-                    for group_jobspec in group['jobs']:
-                        if isinstance(group_jobspec, dict):
-                            group_jobname, group_jobparams = \
-                                next(iter(group_jobspec.items()))
-                            if not isinstance(group_jobparams, dict):
-                                group_jobparams = {}
-                        else:
-                            group_jobname = group_jobspec
+                for group_name, group_params in iter_specs(
+                        group.get(specs_key, [])):
+                    add_reference(kind, group_name, group_params)
+
+        all_defaults = self.data.get('defaults', {})
+        inputs = (
+            _EXPANSION_CACHE_VERSION,
+            version_info.version_string(),
+            [self.jjb_config.yamlparser[option] for option in (
+                'allow_duplicates', 'allow_empty_variables',
+                'keep_descriptions')],
+            jobs_glob,
+            project,
+            references,
+            [(name, all_defaults.get(name))
+             for name in sorted(defaults, key=str)],
+        )
+        if _contains_custom_loader(inputs):
+            return None
+        try:
+            return hashlib.sha256(pickle.dumps(inputs, protocol=2)).hexdigest()
+        except Exception as e:
+            logger.debug("Not caching the expansion of project '%s': %s",
+                         project.get('name'), e)
+            return None
+
+    def _iterProjectItems(self, project, jobs_glob=None,
+                          kinds=('job', 'view')):
+        logger.debug("Expanding project '{0}'".format(project['name']))
+        # use a set to check for duplicate job references in projects
+        seen = set()
+        for jobspec in project.get('jobs', []):
+            if isinstance(jobspec, dict):
+                # Singleton dict containing dict of job-specific params
+                jobname, jobparams = next(iter(jobspec.items()))
+                if not isinstance(jobparams, dict):
+                    jobparams = {}
+            else:
+                jobname = jobspec
+                jobparams = {}
+            job = self._getJob(jobname)
+            if job:
+                # Just naming an existing defined job
+                if jobname in seen:
+                    self._handle_dups("Duplicate job '{0}' specified "
+                                      "for project '{1}'"
+                                      .format(jobname, project['name']))
+                seen.add(jobname)
+                continue
+            # see if it's a job group
+            group = self._getJobGroup(jobname)
+            if group:
+                for group_jobspec in group['jobs']:
+                    if isinstance(group_jobspec, dict):
+                        group_jobname, group_jobparams = \
+                            next(iter(group_jobspec.items()))
+                        if not isinstance(group_jobparams, dict):
                             group_jobparams = {}
-                        job = self._getJob(group_jobname)
-                        if job:
-                            if group_jobname in seen:
-                                self._handle_dups(
-                                    "Duplicate job '{0}' specified for "
-                                    "project '{1}'".format(group_jobname,
-                                                           project['name']))
-                            seen.add(group_jobname)
-                            continue
-                        template = self._getJobTemplate(group_jobname)
-                        # Allow a group to override parameters set by a project
-                        d = type(project)(project)
-                        d.update(jobparams)
-                        d.update(group)
-                        d.update(group_jobparams)
-                        # Except name, since the group's name is not useful
-                        d['name'] = project['name']
-                        if template:
-                            self._expandYamlForTemplateJob(d, template,
-                                                           jobs_glob)
+                    else:
+                        group_jobname = group_jobspec
+                        group_jobparams = {}
+                    job = self._getJob(group_jobname)
+                    if job:
+                        if group_jobname in seen:
+                            self._handle_dups(
+                                "Duplicate job '{0}' specified for "
+                                "project '{1}'".format(group_jobname,
+                                                       project['name']))
+                        seen.add(group_jobname)
+                        continue
+                    template = self._getJobTemplate(group_jobname)
+                    # Allow a group to override parameters set by a project
+                    # Except name, since the group's name is not useful
+                    d = LayeredParams({'name': project['name']},
+                                      group_jobparams, group, jobparams,
+                                      project)
+                    if template and 'job' in kinds:
+                        for item in self._iterTemplateJob(d, template,
+                                                          jobs_glob):
+                            yield item
+                continue
+            # see if it's a template
+            template = self._getJobTemplate(jobname)
+            if template:
+                if 'job' not in kinds:
                     continue
-                # see if it's a template
-                template = self._getJobTemplate(jobname)
-                if template:
-                    d = type(project)(project)
-                    d.update(jobparams)
-                    self._expandYamlForTemplateJob(d, template, jobs_glob)
-                else:
-                    raise JenkinsJobsException("Failed to find suitable "
-                                               "template named '{0}'"
-                                               .format(jobname))
-
-            for viewspec in project.get('views', []):
-                if isinstance(viewspec, dict):
-                    # Singleton dict containing dict of view-specific params
-                    viewname, viewparams = next(iter(viewspec.items()))
-                    if not isinstance(viewparams, dict):
-                        viewparams = {}
-                else:
-                    viewname = viewspec
+                d = LayeredParams({}, jobparams, project)
+                for item in self._iterTemplateJob(d, template, jobs_glob):
+                    yield item
+            else:
+                raise JenkinsJobsException("Failed to find suitable "
+                                           "template named '{0}'"
+                                           .format(jobname))
+
+        for viewspec in project.get('views', []):
+            if isinstance(viewspec, dict):
+                # Singleton dict containing dict of view-specific params
+                viewname, viewparams = next(iter(viewspec.items()))
+                if not isinstance(viewparams, dict):
                     viewparams = {}
-                view = self._getView(viewname)
-                if view:
-                    # Just naming an existing defined view
-                    if viewname in seen:
-                        self._handle_dups("Duplicate view '{0}' specified "
-                                          "for project '{1}'"
-                                          .format(viewname, project['name']))
-                    seen.add(viewname)
-                    continue
-                # see if it's a view group
-                group = self._getViewGroup(viewname)
-                if group:
-                    for group_viewspec in group['views']:
-                        if isinstance(group_viewspec, dict):
-                            group_viewname, group_viewparams = \
-                                next(iter(group_viewspec.items()))
-                            if not isinstance(group_viewparams, dict):
-                                group_viewparams = {}
-                        else:
-                            group_viewname = group_viewspec
+            else:
+                viewname = viewspec
+                viewparams = {}
+            view = self._getView(viewname)
+            if view:
+                # Just naming an existing defined view
+                if viewname in seen:
+                    self._handle_dups("Duplicate view '{0}' specified "
+                                      "for project '{1}'"
+                                      .format(viewname, project['name']))
+                seen.add(viewname)
+                continue
+            # see if it's a view group
+            group = self._getViewGroup(viewname)
+            if group:
+                for group_viewspec in group['views']:
+                    if isinstance(group_viewspec, dict):
+                        group_viewname, group_viewparams = \
+                            next(iter(group_viewspec.items()))
+                        if not isinstance(group_viewparams, dict):
                             group_viewparams = {}
-                        view = self._getView(group_viewname)
-                        if view:
-                            if group_viewname in seen:
-                                self._handle_dups(
-                                    "Duplicate view '{0}' specified for "
-                                    "project '{1}'".format(group_viewname,
-                                                           project['name']))
-                            seen.add(group_viewname)
-                            continue
-                        template = self._getViewTemplate(group_viewname)
-                        # Allow a group to override parameters set by a project
-                        d = type(project)(project)
-                        d.update(viewparams)
-                        d.update(group)
-                        d.update(group_viewparams)
-                        # Except name, since the group's name is not useful
-                        d['name'] = project['name']
-                        if template:
-                            self._expandYamlForTemplateView(
-                                d, template, jobs_glob)
+                    else:
+                        group_viewname = group_viewspec
+                        group_viewparams = {}
+                    view = self._getView(group_viewname)
+                    if view:
+                        if group_viewname in seen:
+                            self._handle_dups(
+                                "Duplicate view '{0}' specified for "
+                                "project '{1}'".format(group_viewname,
+                                                       project['name']))
+                        seen.add(group_viewname)
+                        continue
+                    template = self._getViewTemplate(group_viewname)
+                    # Allow a group to override parameters set by a project
+                    # Except name, since the group's name is not useful
+                    d = LayeredParams({'name': project['name']},
+                                      group_viewparams, group, viewparams,
+                                      project)
+                    if template and 'view' in kinds:
+                        for item in self._iterTemplateView(d, template,
+                                                           jobs_glob):
+                            yield item
+                continue
+            # see if it's a template
+            template = self._getViewTemplate(viewname)
+            if template:
+                if 'view' not in kinds:
                     continue
-                # see if it's a template
-                template = self._getViewTemplate(viewname)
-                if template:
-                    d = type(project)(project)
-                    d.update(viewparams)
-                    self._expandYamlForTemplateView(d, template, jobs_glob)
-                else:
-                    raise JenkinsJobsException("Failed to find suitable "
-                                               "template named '{0}'"
-                                               .format(viewname))
-
-        # check for duplicate generated jobs
-        seen = set()
-        # walk the list in reverse so that last definition wins
-        for job in self.jobs[::-1]:
-            if job['name'] in seen:
-                self._handle_dups("Duplicate definitions for job '{0}' "
-                                  "specified".format(job['name']))
-                self.jobs.remove(job)
-            seen.add(job['name'])
-
-        # check for duplicate generated views
-        seen_views = set()
-        # walk the list in reverse so that last definition wins
-        for view in self.views[::-1]:
-            if view['name'] in seen_views:
-                self._handle_dups("Duplicate definitions for view '{0}' "
-                                  "specified".format(view['name']))
-                self.views.remove(view)
-            seen_views.add(view['name'])
-
-        return self.jobs, self.views
+                d = LayeredParams({}, viewparams, project)
+                for item in self._iterTemplateView(d, template, jobs_glob):
+                    yield item
+            else:
+                raise JenkinsJobsException("Failed to find suitable "
+                                           "template named '{0}'"
+                                           .format(viewname))
 
-    def _expandYamlForTemplateJob(self, project, template, jobs_glob=None):
+    def _iterTemplateJob(self, project, template, jobs_glob=None):
         dimensions = []
         template_name = template['name']
         # reject keys that are not useful during yaml expansion
@@ -415,17 +1409,24 @@ class YamlParser(object):
             if tmpk not in template_name:
                 continue
             if type(v) == list:
-                dimensions.append(zip([k] * len(v), v))
+                dimensions.append([(k, item) for item in v])
         # XXX somewhat hackish to ensure we actually have a single
         # pass through the loop
         if len(dimensions) == 0:
             dimensions = [(("", ""),)]
 
-        for values in itertools.product(*dimensions):
-            params = copy.deepcopy(project)
-            params = self._applyDefaults(params, template)
-            params['template-name'] = re.sub(r'({|})', r'\1\1', template_name)
-
+        # parameters shared by all the combinations, each one only adding
+        # its own values on top instead of copying them
+        base_params = LayeredParams(
+            {'template-name': re.sub(r'({|})', r'\1\1', template_name)},
+            project, self._getDefaults(project, template))
+        needed = self._namingParams(template, ('name', 'folder'), excludes)
+        self._findStatic(template)
+        self._findStatic(base_params)
+        renders = self._templateRenders(template)
+        resolver = None
+
+        for values in expand_combinations(dimensions, excludes):
             try:
                 expanded_values = {}
                 for (k, v) in values:
@@ -447,12 +1448,16 @@ class YamlParser(object):
                     project_name,
                     "".join(local_yaml.dump({k: v}, default_flow_style=False)
                             for (k, v) in values),
-                    local_yaml.dump(project, default_flow_style=False))
+                    local_yaml.dump(OrderedDict(project),
+                                    default_flow_style=False))
                 raise
 
-            params.update(expanded_values)
+            params = base_params.new_child(expanded_values)
             try:
-                params = deep_format(params, params)
+                if resolver is None:
+                    resolver = _ParamsResolver(base_params, needed)
+                order, deferred = resolver.orderFor(expanded_values)
+                params = self._formatParams(params, order)
             except Exception:
                 logging.error(
                     "Failure formatting params '%s' with itself", params)
@@ -461,27 +1466,111 @@ class YamlParser(object):
                 logger.debug('Excluding combination %s', str(params))
                 continue
 
-            for key in template.keys():
-                if key not in params:
-                    params[key] = template[key]
-
+            filled = dict((key, template[key]) for key in template.keys()
+                          if key not in params)
             try:
-                expanded = deep_format(
-                    template, params,
-                    self.jjb_config.yamlparser['allow_empty_variables'])
+                # only the name is needed up front, the rest of the template
+                # is by far the most expensive to format
+                job_name = self._getfullname(self._formatFields(
+                    template, params.new_child(filled), ('name', 'folder')))
             except Exception:
-                logging.error(
-                    "Failure formatting template '%s', containing '%s' with "
-                    "params '%s'", template_name, template, params)
+                # report the parameters failing to format first, as if they
+                # had all been formatted before the name
+                self._formatDeferredParams(params, filled, deferred)
+                self._logTemplateFailure(template, params.new_child(filled))
                 raise
-            expanded['name'] = self._getfullname(expanded)
-
-            job_name = expanded.get('name')
             if jobs_glob and not matches(job_name, jobs_glob):
                 continue
 
-            self._formatDescription(expanded)
-            self.jobs.append(expanded)
+            yield 'job', job_name, functools.partial(
+                self._expandTemplateJob, renders, params, filled, deferred)
+
+    def _templateRenders(self, template):
+        return _TemplateRenders(
+            template, self.jjb_config.yamlparser['allow_empty_variables'],
+            dict((key, self._renderPlan(key, value))
+                 for key, value in template.items()))
+
+    def _renderPlan(self, key, value):
+        """Return the RenderPlan of a top level key of a template, compiled
+        only once for each value."""
+        try:
+            plan_value, plan = self._render_plans[key, id(value)]
+            if plan_value is value:
+                return plan
+        except KeyError:
+            pass
+        plan = RenderPlan({key: value}, self._static)
+        self._render_plans[key, id(value)] = (value, plan)
+        return plan
+
+    def _expandTemplateJob(self, renders, params, filled, deferred):
+        params = self._formatDeferredParams(params, filled, deferred)
+        try:
+            expanded = renders.render(params)
+        except Exception:
+            self._logTemplateFailure(renders.template, params)
+            raise
+        expanded['name'] = self._getfullname(expanded)
+
+        self._formatDescription(expanded)
+        return expanded
+
+    def _logTemplateFailure(self, template, params):
+        logging.error(
+            "Failure formatting template '%s', containing '%s' with "
+            "params '%s'", template['name'], template, params)
+
+    def _namingParams(self, template, fields, excludes):
+        """Return the names of the parameters used by the given ``fields``
+        of a template and by the ``excludes``, the only ones which have to
+        be formatted to name a combination and tell if it is excluded, or
+        None if they can't be known."""
+        needed = _param_references(
+            '', [template[field] for field in fields if field in template])
+        if needed is not None:
+            for exclude in excludes:
+                needed.update(exclude)
+        return needed
+
+    def _formatDeferredParams(self, params, filled, deferred):
+        """Format the parameters of a combination left out when it was
+        named, then add the ``filled`` in values of the template keys
+        missing from them."""
+        if deferred:
+            try:
+                params = self._formatParams(params, deferred)
+            except Exception:
+                logging.error(
+                    "Failure formatting params '%s' with itself", params)
+                raise
+        return params.new_child(filled)
+
+    def _formatParams(self, params, order):
+        """Format the parameters of a combination with themselves, in
+        ``order`` so that every parameter is formatted with the already
+        formatted values of the ones it uses. Only the values listed in
+        ``order`` are formatted, and stored on a new layer, the rest are
+        shared with ``params``."""
+        formatted = {}
+        resolved = params.new_child(formatted)
+        for key in order:
+            value = params[key]
+            for new_key, new_value in deep_format(
+                    {key: value}, resolved, static=self._static).items():
+                if new_key != key:
+                    formatted[key] = _DELETED
+                formatted[new_key] = new_value
+        return resolved
+
+    def _formatFields(self, template, params, fields):
+        """Format only the given top level ``fields`` of a template, which
+        is enough to work out the name it expands to without formatting
+        the whole template."""
+        return deep_format(
+            dict((field, template[field]) for field in fields
+                 if field in template),
+            params, self.jjb_config.yamlparser['allow_empty_variables'])
 
     def _get_managed_string(self):
         # The \n\n is not hard coded, because they get stripped if the
@@ -505,7 +1594,7 @@ class YamlParser(object):
             return view
         return self._applyDefaults(view)
 
-    def _expandYamlForTemplateView(self, project, template, views_glob=None):
+    def _iterTemplateView(self, project, template, views_glob=None):
         dimensions = []
         template_name = template['name']
         # reject keys that are not useful during yaml expansion
@@ -517,16 +1606,21 @@ class YamlParser(object):
             if tmpk not in template_name:
                 continue
             if type(v) == list:
-                dimensions.append(zip([k] * len(v), v))
+                dimensions.append([(k, item) for item in v])
         # XXX somewhat hackish to ensure we actually have a single
         # pass through the loop
         if len(dimensions) == 0:
             dimensions = [(("", ""),)]
 
-        for values in itertools.product(*dimensions):
-            params = copy.deepcopy(project)
-            params = self._applyDefaults(params, template)
+        base_params = LayeredParams(project,
+                                    self._getDefaults(project, template))
+        needed = self._namingParams(template, ('name',), excludes)
+        self._findStatic(template)
+        self._findStatic(base_params)
+        renders = self._templateRenders(template)
+        resolver = None
 
+        for values in expand_combinations(dimensions, excludes):
             expanded_values = {}
             for (k, v) in values:
                 if isinstance(v, dict):
@@ -536,24 +1630,33 @@ class YamlParser(object):
                 else:
                     expanded_values[k] = v
 
-            params.update(expanded_values)
-            params = deep_format(params, params)
+            if resolver is None:
+                resolver = _ParamsResolver(base_params, needed)
+            order, deferred = resolver.orderFor(expanded_values)
+            params = self._formatParams(
+                base_params.new_child(expanded_values), order)
             if combination_matches(params, excludes):
                 logger.debug('Excluding combination %s', str(params))
                 continue
 
-            for key in template.keys():
-                if key not in params:
-                    params[key] = template[key]
-
-            params['template-name'] = template_name
-            expanded = deep_format(
-                template, params,
-                self.jjb_config.yamlparser['allow_empty_variables'])
-
-            view_name = expanded.get('name')
+            filled = dict((key, template[key]) for key in template.keys()
+                          if key not in params)
+            filled['template-name'] = template_name
+            try:
+                view_name = self._formatFields(
+                    template, params.new_child(filled), ('name',)).get('name')
+            except Exception:
+                self._formatDeferredParams(params, filled, deferred)
+                raise
             if views_glob and not matches(view_name, views_glob):
                 continue
 
-            self._formatDescription(expanded)
-            self.views.append(expanded)
+            yield 'view', view_name, functools.partial(
+                self._expandTemplateView, renders, params, filled, deferred)
+
+    def _expandTemplateView(self, renders, params, filled, deferred):
+        params = self._formatDeferredParams(params, filled, deferred)
+        expanded = renders.render(params)
+
+        self._formatDescription(expanded)
+        return expanded
@@ -24,6 +24,7 @@ import types
 from jenkins_jobs.errors import JenkinsJobsException
 from jenkins_jobs.formatter import deep_format
 from jenkins_jobs.local_yaml import Jinja2Loader
+from jenkins_jobs.utils import copy_tree
 
 __all__ = [
     "ModuleRegistry"
@@ -250,7 +251,10 @@ class ModuleRegistry(object):
                 # Pass component_data in as template data to this function
                 # so that if the macro is invoked with arguments,
                 # the arguments are interpolated into the real defn.
-                self.dispatch(component_type, xml_parent, b, component_data)
+                # The components may modify their data, which deep_format()
+                # shares with the macro where unchanged, so give them a copy.
+                self.dispatch(component_type, xml_parent, copy_tree(b),
+                              component_data)
         elif name in eps:
             func = eps[name].load()
             func(self, xml_parent, component_data)
@@ -16,11 +16,24 @@
 # functions that don't fit in well elsewhere
 
 import codecs
+import collections
 import fnmatch
 import locale
 import os.path
+import re
+
 from six.moves import input
 
+from jenkins_jobs.parallel import concurrent
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
 
 def wrap_stream(stream, encoding='utf-8'):
 
@@ -38,36 +51,216 @@ def wrap_stream(stream, encoding='utf-8'):
     return codecs.EncodedFile(stream, encoding, stream_enc)
 
 
-def recurse_path(root, excludes=None):
-    if excludes is None:
-        excludes = []
+class FileEntry(collections.namedtuple('FileEntry', 'path size mtime')):
+    """A file found by :func:`list_files`, with its size and modification
+    time at the time it was found."""
+
+    __slots__ = ()
+
+    @property
+    def signature(self):
+        """The same as :func:`file_signature` returned for the file when it
+        was found."""
+        return self.size, self.mtime
+
+
+def _list_dir(path):
+    """Return the sorted names of the directories in ``path`` that can be
+    descended into, and of the ones that can't as they are symlinks, like
+    :func:`os.walk` does. Unreadable directories are seen as empty."""
+    dirs = []
+    links = set()
+    try:
+        if _scandir is not None:
+            for entry in _scandir(path):
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+        else:
+            for name in os.listdir(path):
+                subpath = os.path.join(path, name)
+                if os.path.isdir(subpath):
+                    dirs.append(name)
+                    if os.path.islink(subpath):
+                        links.add(name)
+    except OSError:
+        pass
+    dirs.sort()
+    return dirs, links
+
+
+class _ExcludeMatcher(object):
+    """The exclude patterns of :func:`recurse_path`, compiled into a single
+    regular expression for each kind of pattern."""
+
+    def __init__(self, excludes):
+        self.names = self._compile(
+            [e for e in excludes if os.path.sep not in e])
+        self.absolute = self._compile(
+            [e for e in excludes if os.path.isabs(e)])
+        self.relative = self._compile(
+            [e for e in excludes if os.path.sep in e and
+             not os.path.isabs(e)])
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(os.path.normcase(pattern))
+            for pattern in patterns)).match
+
+    def excluded(self, name, path, relpath):
+        """Tell whether the directory ``name``, at the absolute and
+        normalized ``path`` and at ``relpath`` from the current directory,
+        is excluded."""
+        return bool(
+            (self.names and self.names(os.path.normcase(name))) or
+            (self.absolute and self.absolute(os.path.normcase(path))) or
+            (self.relative and self.relative(os.path.normcase(relpath))))
+
+
+@concurrent
+def _scan_dirs(path, relpath, matcher):
+    dirs, links = _list_dir(path)
+    subdirs = []
+    for name in dirs:
+        subpath = os.path.join(path, name)
+        if relpath is None:
+            subrelpath = None
+        elif relpath == os.path.curdir:
+            subrelpath = name
+        else:
+            subrelpath = os.path.join(relpath, name)
+        if not matcher.excluded(name, subpath, subrelpath):
+            subdirs.append((subpath, subrelpath, name in links))
+    return subdirs
+
+
+def recurse_path(root, excludes=None, n_workers=1):
+    """Return ``root`` and all the directories beneath it, except for the
+    ones matching ``excludes`` and the ones beneath them. The directories
+    of each one follow all those of its parent, in alphabetical order, so
+    that the order in which files are found is predictable, which matters
+    for the retain_anchors option. Like :func:`os.walk`, symlinks to
+    directories are listed but not followed.
+
+    :arg str root: directory to search
+    :arg list excludes: directory names, absolute paths and paths relative
+        to the current directory to exclude, as shell patterns
+    :arg int n_workers: number of threads listing the directories of each
+        level of the tree at once, one per CPU core if '0'
+    """
+    matcher = _ExcludeMatcher(excludes or [])
 
     basepath = os.path.realpath(root)
-    pathlist = [basepath]
+    # the relative paths are only worked out when needed, once for the root
+    relpath = os.path.relpath(basepath) if matcher.relative else None
 
-    patterns = [e for e in excludes if os.path.sep not in e]
-    absolute = [e for e in excludes if os.path.isabs(e)]
-    relative = [e for e in excludes if os.path.sep in e and
-                not os.path.isabs(e)]
-    for root, dirs, files in os.walk(basepath, topdown=True):
-        # sort in-place to ensure dirnames are visited in alphabetical order
-        # a predictable order makes it easier to use the retain_anchors option
-        dirs.sort()
-        dirs[:] = [
-            d for d in dirs
-            if not any([fnmatch.fnmatch(d, pattern) for pattern in patterns])
-            if not any([fnmatch.fnmatch(os.path.abspath(os.path.join(root, d)),
-                                        path)
-                        for path in absolute])
-            if not any([fnmatch.fnmatch(os.path.relpath(os.path.join(root, d)),
-                                        path)
-                        for path in relative])
-        ]
-        pathlist.extend([os.path.join(root, path) for path in dirs])
+    # list the tree a level at a time, so that the directories of a level
+    # can be listed by several threads
+    children = {}
+    level = [(basepath, relpath)]
+    while level:
+        if n_workers == 1 or len(level) == 1:
+            found = [_scan_dirs(path, relpath, matcher)
+                     for path, relpath in level]
+        else:
+            found = _scan_dirs(
+                matcher=matcher, n_workers=n_workers,
+                concurrent=[{'path': path, 'relpath': relpath}
+                            for path, relpath in level])
+        next_level = []
+        for (path, _), subdirs in zip(level, found):
+            if isinstance(subdirs, Exception):
+                raise subdirs
+            children[path] = [subdir for subdir, _, _ in subdirs]
+            next_level.extend((subdir, subrelpath)
+                              for subdir, subrelpath, link in subdirs
+                              if not link)
+        level = next_level
 
+    # then put the directories in the order os.walk() finds them in
+    pathlist = [basepath]
+    stack = [basepath]
+    while stack:
+        subdirs = children.get(stack.pop(), [])
+        pathlist.extend(subdirs)
+        stack.extend(reversed(subdirs))
     return pathlist
 
 
+def list_files(path, extensions):
+    """Return a :class:`FileEntry` for each of the files in the directory
+    ``path`` with a name ending with one of ``extensions``, sorted by name.
+    The size and modification time are None for the files that can't be
+    read, such as broken symlinks."""
+    entries = []
+    if _scandir is not None:
+        for entry in _scandir(path):
+            if entry.name.endswith(extensions):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    st = None
+                entries.append((entry.name, entry.path, st))
+    else:
+        for name in os.listdir(path):
+            if name.endswith(extensions):
+                filename = os.path.join(path, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    st = None
+                entries.append((name, filename, st))
+    entries.sort(key=lambda entry: entry[0])
+
+    files = []
+    for _, filename, st in entries:
+        if st is None:
+            files.append(FileEntry(filename, None, None))
+        else:
+            files.append(FileEntry(filename, *_stat_signature(st)))
+    return files
+
+
+def copy_tree(obj):
+    """Return a copy of the lists and dicts of ``obj``, sharing everything
+    else with it. Data which deep_format() may have returned as it was
+    should be copied before being modified."""
+    if not isinstance(obj, (list, dict)):
+        return obj
+    root = type(obj)()
+    stack = [(obj, root)]
+    while stack:
+        source, copied = stack.pop()
+        if isinstance(source, dict):
+            items = source.items()
+        else:
+            items = enumerate(source)
+        for key, value in items:
+            if isinstance(value, (list, dict)):
+                new_value = type(value)()
+                stack.append((value, new_value))
+                value = new_value
+            if isinstance(copied, dict):
+                copied[key] = value
+            else:
+                copied.append(value)
+    return root
+
+
+def file_signature(path):
+    """Return the size and modification time of the file at ``path``, which
+    change whenever the file does."""
+    return _stat_signature(os.stat(path))
+
+
+def _stat_signature(st):
+    return st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
 def confirm(question):
     answer = input('%s (Y/N): ' % question).upper().strip()
     return answer == 'Y'
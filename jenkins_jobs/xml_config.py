@@ -21,6 +21,7 @@ from xml.dom import minidom
 import xml.etree.ElementTree as XML
 
 from jenkins_jobs import errors
+from jenkins_jobs.utils import copy_tree
 
 __all__ = [
     "XmlJobGenerator",
@@ -100,10 +101,14 @@ class XmlGenerator(object):
         self.registry = registry
 
     def generateXML(self, data_list):
-        xml_objs = []
+        return list(self.iterXML(data_list))
+
+    def iterXML(self, data_list):
+        """Generate the XML of each item of ``data_list`` only when it is
+        reached, ``data_list`` may be any iterable, such as the iterator
+        returned by :meth:`YamlParser.iterJobs`."""
         for data in data_list:
-            xml_objs.append(self._getXMLForData(data))
-        return xml_objs
+            yield self._getXMLForData(data)
 
     def _getXMLForData(self, data):
         kind = data.get(self.kind_attribute, self.kind_default)
@@ -112,6 +117,9 @@ class XmlGenerator(object):
                 group=self.entry_point_group, name=kind):
             Mod = ep.load()
             mod = Mod(self.registry)
+            # the modules may modify the data, which can share its unchanged
+            # parts with the templates and the other jobs
+            data = copy_tree(data)
             xml = mod.root_xml(data)
             if "view-type" not in data:
                 self._gen_xml(xml, data)
@@ -13,9 +13,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
+import time
+
+import fixtures
 
 import jenkins_jobs
+from jenkins_jobs import cache
+from jenkins_jobs import parser
+from jenkins_jobs import registry
 from tests import base
 from tests.base import mock
 
@@ -46,3 +53,192 @@ class TestCaseJobCache(base.BaseTestCase):
             with mock.patch('yaml.load'):
                 with mock.patch('jenkins_jobs.builder.JobCache._lock'):
                     jenkins_jobs.builder.JobCache("dummy").data = None
+
+
+class TestCaseExpansionCache(base.BaseTestCase):
+
+    template = u"""
+- job-template:
+    name: '{name}-{branch}'
+    builders:
+      - shell: 'make {target}'
+"""
+    project = u"""
+- project:
+    name: project
+    branch: [master, stable]
+    target: check
+    jobs:
+      - '{name}-{branch}'
+"""
+
+    def setUp(self):
+        super(TestCaseExpansionCache, self).setUp()
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MockPatch(
+            'jenkins_jobs.cache.JobCache.get_cache_dir',
+            return_value=cache_dir))
+        self.conf_filename = None
+        self.config = self._get_config()
+        self.config.yamlparser['expansion_cache'] = True
+
+    def _expand(self, content):
+        yp = parser.YamlParser(self.config)
+        yp.load_files([io.BytesIO(content.encode('utf-8'))])
+        reg = registry.ModuleRegistry(self.config)
+        jobs = list(yp.iterJobs(reg))
+        return jobs, yp
+
+    def test_reuses_expansion(self):
+        jobs, _ = self._expand(self.template + self.project)
+        self.assertEqual(['project-master', 'project-stable'],
+                         [job['name'] for job in jobs])
+
+        with mock.patch.object(parser.YamlParser, '_iterProjectItems') as m:
+            cached_jobs, _ = self._expand(self.template + self.project)
+        self.assertFalse(m.called)
+        self.assertEqual(jobs, cached_jobs)
+
+    def test_template_change_invalidates(self):
+        self._expand(self.template + self.project)
+        jobs, _ = self._expand(self.template.replace('make', 'gmake') +
+                               self.project)
+        self.assertEqual([{'shell': 'gmake check'}], jobs[0]['builders'])
+
+    def test_defaults_change_invalidates(self):
+        defaults = u"""
+- defaults:
+    name: global
+    target: {0}
+"""
+        project = self.project.replace('    target: check\n', '')
+        self._expand(defaults.format('check') + self.template + project)
+        jobs, _ = self._expand(defaults.format('test') + self.template +
+                               project)
+        self.assertEqual([{'shell': 'make test'}], jobs[0]['builders'])
+
+    def test_custom_loaders_not_cached(self):
+        include_dir = self.useFixture(fixtures.TempDir()).path
+        for branch in ('master', 'stable'):
+            with io.open(os.path.join(include_dir, branch + '.sh'), 'w',
+                         encoding='utf-8') as f:
+                f.write(u'test-' + branch)
+        self.config.yamlparser['include_path'] = [include_dir]
+
+        jobs, yp = self._expand(self.template + self.project.replace(
+            "target: check", "target: !include-raw: '{branch}.sh'"))
+        self.assertEqual([{'shell': 'make test-master'}], jobs[0]['builders'])
+        self.assertIsNone(yp._expansion_cache)
+
+    def test_duplicates_logged_from_cache(self):
+        self.config.yamlparser['allow_duplicates'] = True
+        content = u"""
+- job:
+    name: shared
+- project:
+    name: project
+    jobs:
+      - shared
+      - shared
+"""
+        message = "Duplicate job 'shared' specified for project 'project'"
+        for _ in range(2):
+            logger = self.useFixture(fixtures.FakeLogger())
+            jobs, _ = self._expand(content)
+            self.assertEqual(['shared'], [job['name'] for job in jobs])
+            self.assertEqual(1, logger.output.count(message))
+
+    def test_unused_entries_removed(self):
+        _, yp = self._expand(self.template + self.project)
+        path = yp._expansion_cache.path
+        used = os.listdir(path)
+        self.assertEqual(1, len(used))
+        self._expand(self.template.replace('make', 'gmake') + self.project)
+        self.assertEqual(2, len(os.listdir(path)))
+
+        stale = time.time() - cache.ExpansionCache.max_age - 60
+        for name in os.listdir(path):
+            os.utime(os.path.join(path, name), (stale, stale))
+        # using an entry keeps it
+        self._expand(self.template + self.project)
+        self.assertEqual(used, os.listdir(path))
+
+
+class TestCaseYamlCache(base.BaseTestCase):
+
+    jobs = u"""
+- job-template:
+    name: '{name}-{branch}'
+    builders:
+      - shell: !include-raw: '{branch}.sh'
+      - shell: !j2: 'echo {{ branch }}'
+- project:
+    name: project
+    branch: [master, stable]
+    jobs:
+      - '{name}-{branch}'
+- job: !include: job.yaml.inc
+"""
+
+    def setUp(self):
+        super(TestCaseYamlCache, self).setUp()
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.MockPatch(
+            'jenkins_jobs.cache.JobCache.get_cache_dir',
+            return_value=cache_dir))
+        self.conf_filename = None
+        self.config = self._get_config()
+        self.config.yamlparser['yaml_cache'] = True
+        self.files_dir = self.useFixture(fixtures.TempDir()).path
+        self.include_dir = self.useFixture(fixtures.TempDir()).path
+        self.config.yamlparser['include_path'] = [self.include_dir,
+                                                  self.files_dir]
+        self._write(self.files_dir, 'jobs.yaml', self.jobs)
+        self._write(self.files_dir, 'job.yaml.inc', u'name: included\n')
+        for branch in ('master', 'stable'):
+            self._write(self.files_dir, branch + '.sh', u'make ' + branch)
+
+    def _write(self, dirname, filename, content):
+        with io.open(os.path.join(dirname, filename), 'w',
+                     encoding='utf-8') as f:
+            f.write(content)
+
+    def _expand(self):
+        yp = parser.YamlParser(self.config)
+        yp.load_files([os.path.join(self.files_dir, 'jobs.yaml')])
+        reg = registry.ModuleRegistry(self.config)
+        return [(job['name'], job.get('builders')) for job in
+                yp.iterJobs(reg)]
+
+    def test_reuses_data(self):
+        jobs = self._expand()
+        self.assertEqual([
+            ('included', None),
+            ('project-master', [{'shell': 'make master'},
+                                {'shell': 'echo master'}]),
+            ('project-stable', [{'shell': 'make stable'},
+                                {'shell': 'echo stable'}]),
+        ], sorted(jobs))
+
+        with mock.patch('jenkins_jobs.local_yaml.load') as m:
+            cached_jobs = self._expand()
+        self.assertFalse(m.called)
+        self.assertEqual(jobs, cached_jobs)
+
+    def test_include_change_invalidates(self):
+        self._expand()
+        self._write(self.files_dir, 'job.yaml.inc', u'name: changed-job\n')
+        self.assertIn('changed-job', [name for name, _ in self._expand()])
+
+    def test_include_found_elsewhere_invalidates(self):
+        self._expand()
+        self._write(self.include_dir, 'job.yaml.inc', u'name: other\n')
+        self.assertIn('other', [name for name, _ in self._expand()])
+
+    def test_not_used_with_flush_cache(self):
+        self._expand()
+        self.config.builder['flush_cache'] = True
+        with mock.patch('jenkins_jobs.local_yaml.load',
+                        return_value=[]) as m:
+            self._expand()
+        self.assertTrue(m.called)
@@ -20,6 +20,7 @@
 
 import os
 
+from jenkins_jobs.parser import YamlParser
 from tests.base import mock
 from tests.cmd.test_cmd import CmdTestsBase
 
@@ -72,3 +73,24 @@ class DeleteTests(CmdTestsBase):
                          "Jenkins.delete_job() was called '%s' times when "
                          "expected '%s'" % (delete_job_mock.call_count,
                                             len(calls)))
+
+    @mock.patch('jenkins_jobs.builder.JenkinsManager.delete_view')
+    @mock.patch('jenkins_jobs.builder.JenkinsManager.delete_job')
+    def test_delete_using_path_handles_data_once(self, delete_job_mock,
+                                                 delete_view_mock):
+        """
+        Test the jobs and views to delete are worked out from a single pass
+        over the data.
+        """
+
+        args = ['--conf', self.default_config_file,
+                'delete', '--path',
+                os.path.join(self.fixtures_path,
+                             'cmd-002.yaml'),
+                '*bar*']
+        with mock.patch.object(YamlParser, '_handleData', autospec=True,
+                               side_effect=YamlParser._handleData) \
+                as handle_mock:
+            self.execute_jenkins_jobs_with_args(args)
+        self.assertEqual(1, handle_mock.call_count)
+        self.assertEqual(2, delete_job_mock.call_count)
@@ -83,3 +83,17 @@ class ListFromYamlTests(TestWithScenarios, CmdTestsBase):
 
         self.assertEqual(console_out.getvalue().decode('utf-8').rstrip(),
                          ('\n'.join(self.found)))
+
+    @mock.patch('jenkins_jobs.builder.JenkinsManager')
+    def test_list_does_not_use_jenkins(self, jenkins_mock):
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+
+        console_out = io.BytesIO()
+        with mock.patch('sys.stdout', console_out):
+            self.execute_jenkins_jobs_with_args(
+                ['--conf', self.default_config_file, 'list', '-p',
+                 path] + self.globs)
+
+        self.assertFalse(jenkins_mock.called)
+        self.assertEqual(console_out.getvalue().decode('utf-8').rstrip(),
+                         ('\n'.join(self.found)))
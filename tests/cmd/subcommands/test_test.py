@@ -31,6 +31,7 @@ from six.moves import StringIO
 import testtools
 
 from jenkins_jobs.cli import entry
+from jenkins_jobs import utils
 from tests.base import mock
 from tests.cmd.test_cmd import CmdTestsBase
 
@@ -401,6 +402,32 @@ class TestTestsMultiPath(CmdTestsBase):
         self.check_dirs_match(os.path.join(self.fixtures_path,
                                            'multi-path/output_recursive'))
 
+    def test_recursive_multi_path_workers(self):
+        """
+        Run test mode with the directories listed by the number of threads
+        from recursive_workers, regardless of parsing_workers.
+        """
+        args = ['--conf', os.path.join(self.fixtures_path,
+                                       'multi-path/builder-recursive.ini'),
+                'test', '-o', self.output_dir, self.multipath]
+        with mock.patch('jenkins_jobs.utils.recurse_path',
+                        wraps=utils.recurse_path) as recurse_mock:
+            self.execute_jenkins_jobs_with_args(args)
+        for call in recurse_mock.call_args_list:
+            self.assertEqual(1, call[1]['n_workers'])
+
+        shutil.rmtree(self.output_dir)
+        args[1] = os.path.join(self.fixtures_path,
+                               'multi-path/builder-recursive-workers.ini')
+        with mock.patch('jenkins_jobs.utils.recurse_path',
+                        wraps=utils.recurse_path) as recurse_mock:
+            self.execute_jenkins_jobs_with_args(args)
+        self.assertEqual(2, recurse_mock.call_count)
+        for call in recurse_mock.call_args_list:
+            self.assertEqual(3, call[1]['n_workers'])
+        self.check_dirs_match(os.path.join(self.fixtures_path,
+                                           'multi-path/output_recursive'))
+
     def test_recursive_multi_path_with_excludes(self):
         """
         Run test mode and pass multiple paths with recursive path option.
@@ -21,6 +21,7 @@
 import os
 import six
 
+from jenkins_jobs.parser import YamlParser
 from tests.base import mock
 from tests.cmd.test_cmd import CmdTestsBase
 
@@ -116,6 +117,28 @@ class UpdateTests(CmdTestsBase):
         # there were no others, as no API call for assert_has_only_calls
         self.assertEqual(jenkins_delete_job.call_count, len(calls))
 
+    @mock.patch('jenkins_jobs.builder.jenkins.Jenkins.job_exists')
+    @mock.patch('jenkins_jobs.builder.jenkins.Jenkins.get_all_jobs')
+    @mock.patch('jenkins_jobs.builder.jenkins.Jenkins.reconfig_job')
+    def test_update_handles_data_once(self,
+                                      jenkins_reconfig_job,
+                                      jenkins_get_jobs,
+                                      jenkins_job_exists):
+        """
+        Test the jobs and views are worked out from a single pass over the
+        data
+        """
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = ['--conf', self.default_config_file, 'update', path]
+
+        with mock.patch.object(YamlParser, '_handleData', autospec=True,
+                               side_effect=YamlParser._handleData) \
+                as handle_mock:
+            self.execute_jenkins_jobs_with_args(args)
+
+        self.assertEqual(1, handle_mock.call_count)
+        self.assertEqual(4, jenkins_reconfig_job.call_count)
+
     def test_update_timeout_not_set(self):
         """Validate update timeout behavior when timeout not explicitly configured.
         """
@@ -1,28 +1,25 @@
+import io
 import os
 
+import fixtures
 from tests.base import mock
 import testtools
 
 from jenkins_jobs import utils
 
 
-def fake_os_walk(paths):
-    """Helper function for mocking os.walk() where must test that manipulation
-    of the returned dirs variable works as expected
+def make_tree(root, paths):
+    """Helper function creating the directories ``paths``, given relative to
+    ``root`` and using '/' as separator, along with the files named 'file'.
     """
-    paths_dict = dict(paths)
-
-    def os_walk(top, topdown=True):
-        dirs, nondirs = paths_dict[top]
-        yield top, dirs, nondirs
-        for name in dirs:
-            # hard code use of '/' to ensure the test data can be defined as
-            # simple strings otherwise tests using this helper will break on
-            # platforms where os.path.sep is different.
-            new_path = "/".join([top, name])
-            for x in os_walk(new_path, topdown):
-                yield x
-    return os_walk
+    for path in paths:
+        path = os.path.join(root, *path.split('/'))
+        if os.path.basename(path) == 'file':
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            io.open(path, 'w').close()
+        elif not os.path.isdir(path):
+            os.makedirs(path)
 
 
 # Testing the utils module can sometimes result in the JobCache class
@@ -32,8 +29,14 @@ def fake_os_walk(paths):
 @mock.patch('jenkins_jobs.builder.JobCache', mock.MagicMock)
 class CmdRecursePath(testtools.TestCase):
 
-    @mock.patch('jenkins_jobs.utils.os.walk')
-    def test_recursive_path_option_exclude_pattern(self, oswalk_mock):
+    def setUp(self):
+        super(CmdRecursePath, self).setUp()
+        self.root = os.path.realpath(
+            self.useFixture(fixtures.TempDir()).path)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.root)
+
+    def test_recursive_path_option_exclude_pattern(self):
         """
         Test paths returned by the recursive processing when using pattern
         excludes.
@@ -46,24 +49,25 @@ class CmdRecursePath(testtools.TestCase):
             /jjb_configs/test3/bar/
             /jjb_configs/test3/baz/
         """
-
-        os_walk_paths = [
-            ('/jjb_configs', (['dir1', 'dir2', 'dir3', 'test3'], ())),
-            ('/jjb_configs/dir1', (['test1'], ('file'))),
-            ('/jjb_configs/dir2', (['test2'], ())),
-            ('/jjb_configs/dir3', (['bar'], ())),
-            ('/jjb_configs/dir3/bar', ([], ())),
-            ('/jjb_configs/test3/bar', None),
-            ('/jjb_configs/test3/baz', None)
-        ]
-
-        paths = [k for k, v in os_walk_paths if v is not None]
-
-        oswalk_mock.side_effect = fake_os_walk(os_walk_paths)
-        self.assertEqual(paths, utils.recurse_path('/jjb_configs', ['test*']))
-
-    @mock.patch('jenkins_jobs.utils.os.walk')
-    def test_recursive_path_option_exclude_absolute(self, oswalk_mock):
+        make_tree(self.root, ['jjb_configs/dir1/test1',
+                              'jjb_configs/dir1/file',
+                              'jjb_configs/dir2/test2',
+                              'jjb_configs/dir3/bar',
+                              'jjb_configs/test3/bar',
+                              'jjb_configs/test3/baz'])
+
+        paths = [os.path.join(self.root, *p.split('/')) for p in [
+            'jjb_configs',
+            'jjb_configs/dir1',
+            'jjb_configs/dir2',
+            'jjb_configs/dir3',
+            'jjb_configs/dir3/bar',
+        ]]
+
+        self.assertEqual(paths, utils.recurse_path(
+            os.path.join(self.root, 'jjb_configs'), ['test*']))
+
+    def test_recursive_path_option_exclude_absolute(self):
         """
         Test paths returned by the recursive processing when using absolute
         excludes.
@@ -76,28 +80,29 @@ class CmdRecursePath(testtools.TestCase):
             /jjb_configs/test3/bar/
             /jjb_configs/test3/baz/
         """
-
-        os_walk_paths = [
-            ('/jjb_configs', (['dir1', 'dir2', 'dir3', 'test3'], ())),
-            ('/jjb_configs/dir1', None),
-            ('/jjb_configs/dir2', (['test2'], ())),
-            ('/jjb_configs/dir3', (['bar'], ())),
-            ('/jjb_configs/test3', (['bar', 'baz'], ())),
-            ('/jjb_configs/dir2/test2', ([], ())),
-            ('/jjb_configs/dir3/bar', ([], ())),
-            ('/jjb_configs/test3/bar', ([], ())),
-            ('/jjb_configs/test3/baz', ([], ()))
-        ]
-
-        paths = [k for k, v in os_walk_paths if v is not None]
-
-        oswalk_mock.side_effect = fake_os_walk(os_walk_paths)
-
-        self.assertEqual(paths, utils.recurse_path('/jjb_configs',
-                                                   ['/jjb_configs/dir1']))
-
-    @mock.patch('jenkins_jobs.utils.os.walk')
-    def test_recursive_path_option_exclude_relative(self, oswalk_mock):
+        make_tree(self.root, ['jjb_configs/dir1/test1',
+                              'jjb_configs/dir1/file',
+                              'jjb_configs/dir2/test2',
+                              'jjb_configs/dir3/bar',
+                              'jjb_configs/test3/bar',
+                              'jjb_configs/test3/baz'])
+
+        paths = [os.path.join(self.root, *p.split('/')) for p in [
+            'jjb_configs',
+            'jjb_configs/dir2',
+            'jjb_configs/dir3',
+            'jjb_configs/test3',
+            'jjb_configs/dir2/test2',
+            'jjb_configs/dir3/bar',
+            'jjb_configs/test3/bar',
+            'jjb_configs/test3/baz',
+        ]]
+
+        self.assertEqual(paths, utils.recurse_path(
+            os.path.join(self.root, 'jjb_configs'),
+            [os.path.join(self.root, 'jjb_configs', 'dir1')]))
+
+    def test_recursive_path_option_exclude_relative(self):
         """
         Test paths returned by the recursive processing when using relative
         excludes.
@@ -110,27 +115,75 @@ class CmdRecursePath(testtools.TestCase):
             ./jjb_configs/test3/bar/
             ./jjb_configs/test3/baz/
         """
+        make_tree(self.root, ['jjb_configs/dir1/test',
+                              'jjb_configs/dir1/file',
+                              'jjb_configs/dir2/test2',
+                              'jjb_configs/dir3/bar',
+                              'jjb_configs/test3/bar',
+                              'jjb_configs/test3/baz'])
+
+        paths = [os.path.join(self.root, *p.split('/')) for p in [
+            'jjb_configs',
+            'jjb_configs/dir1',
+            'jjb_configs/dir2',
+            'jjb_configs/dir3',
+            'jjb_configs/test3',
+            'jjb_configs/dir1/test',
+            'jjb_configs/dir2/test2',
+            'jjb_configs/dir3/bar',
+            'jjb_configs/test3/baz',
+        ]]
+
+        self.assertEqual(paths, utils.recurse_path(
+            'jjb_configs', [os.path.join('jjb_configs', 'test3', 'bar')]))
+
+    def test_recursive_path_workers(self):
+        """
+        Test the paths are the same, and in the same order, when several
+        threads list the directories.
+        """
+        make_tree(self.root, ['jjb_configs/%s/%s/%s' % (a, b, c)
+                              for a in 'cab' for b in 'yzx' for c in 'ji'])
+
+        self.assertEqual(utils.recurse_path('jjb_configs', ['x']),
+                         utils.recurse_path('jjb_configs', ['x'],
+                                            n_workers=3))
+
+    @testtools.skipUnless(hasattr(os, 'symlink'), "symlinks not supported")
+    def test_recursive_path_symlinks(self):
+        """
+        Test symlinks to directories are listed, but not followed, as with
+        os.walk().
+        """
+        make_tree(self.root, ['jjb_configs/dir1/sub', 'other/sub'])
+        os.symlink(os.path.join(self.root, 'other'),
+                   os.path.join(self.root, 'jjb_configs', 'link'))
+
+        paths = [os.path.join(self.root, *p.split('/')) for p in [
+            'jjb_configs',
+            'jjb_configs/dir1',
+            'jjb_configs/link',
+            'jjb_configs/dir1/sub',
+        ]]
+
+        self.assertEqual(paths, utils.recurse_path('jjb_configs'))
 
-        os_walk_paths = [
-            ('jjb_configs', (['dir1', 'dir2', 'dir3', 'test3'], ())),
-            ('jjb_configs/dir1', (['test'], ('file'))),
-            ('jjb_configs/dir2', (['test2'], ())),
-            ('jjb_configs/dir3', (['bar'], ())),
-            ('jjb_configs/test3', (['bar', 'baz'], ())),
-            ('jjb_configs/dir1/test', ([], ())),
-            ('jjb_configs/dir2/test2', ([], ())),
-            ('jjb_configs/dir3/bar', ([], ())),
-            ('jjb_configs/test3/bar', None),
-            ('jjb_configs/test3/baz', ([], ()))
-        ]
-
-        rel_os_walk_paths = [
-            (os.path.abspath(
-                os.path.join(os.path.curdir, k)), v) for k, v in os_walk_paths]
-
-        paths = [k for k, v in rel_os_walk_paths if v is not None]
-
-        oswalk_mock.side_effect = fake_os_walk(rel_os_walk_paths)
-
-        self.assertEqual(paths, utils.recurse_path('jjb_configs',
-                                                   ['jjb_configs/test3/bar']))
+    def test_list_files(self):
+        """
+        Test the files listed with their size and modification time.
+        """
+        make_tree(self.root, ['jjb_configs/dir.yaml/file'])
+        for name, size in (('a.yml', 3), ('b.yaml', 5), ('c.txt', 1)):
+            with io.open(os.path.join('jjb_configs', name), 'wb') as f:
+                f.write(b'x' * size)
+
+        files = utils.list_files('jjb_configs', ('.yml', '.yaml'))
+
+        self.assertEqual([os.path.join('jjb_configs', 'a.yml'),
+                          os.path.join('jjb_configs', 'b.yaml'),
+                          os.path.join('jjb_configs', 'dir.yaml')],
+                         [entry.path for entry in files])
+        self.assertEqual([3, 5], [entry.size for entry in files[:2]])
+        for entry in files:
+            self.assertEqual(utils.file_signature(entry.path),
+                             entry.signature)
@@ -13,11 +13,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
+import time
 
+import fixtures
 from testtools import ExpectedException
 
 from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs import parser
+from jenkins_jobs import registry
 from tests import base
 from tests.base import mock
 
@@ -34,3 +39,218 @@ class TestCaseModuleDuplicates(base.SingleJobTestCase):
                 super(TestCaseModuleDuplicates, self).test_yaml_snippet()
         else:
             super(TestCaseModuleDuplicates, self).test_yaml_snippet()
+
+
+class TestCaseDuplicatesIndex(base.BaseTestCase):
+    fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+    def test_jobs_index_keeps_last_definition(self):
+        self.conf_filename = os.path.join(self.fixtures_path,
+                                          'allow_duplicates001.conf')
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path, 'allow_projects001.yaml'))
+        jobs, _ = yp.expandYaml(registry.ModuleRegistry(config))
+
+        self.assertEqual(['duplicate-templates-001'], list(yp.jobs_index))
+        self.assertEqual(1, len(jobs))
+        self.assertIs(jobs[0], yp.jobs_index['duplicate-templates-001'])
+        self.assertEqual(['origin/stable-2'],
+                         jobs[0]['scm'][0]['git']['branches'])
+        self.assertIn("Duplicate definitions for job "
+                      "'duplicate-templates-001' specified",
+                      self.logger.output)
+
+    def _expand(self, conf, yaml, iterate=False):
+        self.conf_filename = conf and os.path.join(self.fixtures_path, conf)
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path, yaml))
+        reg = registry.ModuleRegistry(config)
+        if iterate:
+            return list(yp.iterJobs(reg))
+        return yp.expandYaml(reg)[0]
+
+    def test_iter_jobs_same_as_expand_yaml(self):
+        for conf, yaml in [
+                ('allow_duplicates001.conf', 'allow_projects001.yaml'),
+                ('allow_duplicates_parallel001.conf',
+                 'allow_duplicates_parallel001.yaml'),
+                (None, 'duplicates002.yaml')]:
+            self.assertEqual(self._expand(conf, yaml),
+                             self._expand(conf, yaml, iterate=True))
+
+    def test_iter_jobs_reports_duplicates_first(self):
+        self.conf_filename = None
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path,
+                              'exception_projects001.yaml'))
+        with ExpectedException(JenkinsJobsException, "^Duplicate .*"):
+            yp.iterJobs(registry.ModuleRegistry(config))
+
+    def test_handles_from_single_pass(self):
+        self.conf_filename = os.path.join(self.fixtures_path,
+                                          'allow_duplicates001.conf')
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path, 'allow_projects001.yaml'))
+        yp.load_files([io.BytesIO(b"""
+- view:
+    name: all
+    view-type: list
+""")])
+        reg = registry.ModuleRegistry(config)
+        with mock.patch.object(parser.YamlParser, '_handleData',
+                               autospec=True,
+                               side_effect=parser.YamlParser._handleData) \
+                as handle_mock:
+            job_handles, view_handles = yp.getHandles(reg)
+
+        self.assertEqual(1, handle_mock.call_count)
+        self.assertEqual(['duplicate-templates-001'],
+                         [handle.name for handle in job_handles])
+        self.assertEqual(['all'], [handle.name for handle in view_handles])
+        self.assertEqual(['duplicate-templates-001'], list(yp.jobs_index))
+        self.assertIs(job_handles[0],
+                      yp.jobs_index['duplicate-templates-001'])
+        self.assertEqual(['all'], list(yp.views_index))
+        self.assertEqual(1, self.logger.output.count(
+            "Duplicate definitions for job 'duplicate-templates-001'"))
+        self.assertEqual(self._expand('allow_duplicates001.conf',
+                                      'allow_projects001.yaml'),
+                         list(yp.expandHandles(job_handles)))
+
+
+class TestCaseParallelExpansion(base.BaseTestCase):
+
+    projects = b"""
+- job:
+    name: shared
+- project:
+    name: first
+    jobs:
+      - shared
+      - shared
+- project:
+    name: second
+    jobs:
+      - shared
+- project:
+    name: third
+    jobs:
+      - shared
+      - shared
+"""
+
+    def setUp(self):
+        super(TestCaseParallelExpansion, self).setUp()
+        self.conf_filename = None
+
+    def _expand(self, expansion_workers, allow_duplicates=False):
+        config = self._get_config()
+        config.yamlparser['expansion_workers'] = expansion_workers
+        config.yamlparser['allow_duplicates'] = allow_duplicates
+        yp = parser.YamlParser(config)
+        yp.load_files([io.BytesIO(self.projects)])
+        return yp.expandYaml(registry.ModuleRegistry(config))[0]
+
+    def _duplicates_logged(self):
+        return [line for line in self.logger.output.splitlines()
+                if line.startswith("Duplicate job")]
+
+    def test_duplicates_logged_in_order(self):
+        jobs = self._expand(1, allow_duplicates=True)
+        serial = self._duplicates_logged()
+        self.assertEqual(
+            ["Duplicate job 'shared' specified for project 'first'",
+             "Duplicate job 'shared' specified for project 'third'"],
+            serial)
+
+        self.assertEqual(jobs, self._expand(3, allow_duplicates=True))
+        self.assertEqual(serial * 2, self._duplicates_logged())
+
+    def test_first_project_error_raised(self):
+        expand_project = parser.YamlParser._expandProject
+
+        def slow_first(yp, project, jobs_glob=None):
+            # so that a later project fails first when run in parallel
+            if project['name'] == 'first':
+                time.sleep(0.5)
+            return expand_project(yp, project, jobs_glob)
+
+        for workers in (1, 3):
+            with mock.patch.object(parser.YamlParser, '_expandProject',
+                                   autospec=True, side_effect=slow_first):
+                with ExpectedException(JenkinsJobsException,
+                                       "^Duplicate job .* project 'first'$"):
+                    self._expand(workers)
+
+
+class TestCaseParallelParsing(base.BaseTestCase):
+
+    files = [
+        ('a.yaml', u"""
+- job:
+    name: first
+    builders:
+      - shell: !include-raw script.sh
+"""),
+        ('b.yaml', u"""
+- job:
+    name: second
+"""),
+        ('c.yaml', u"""
+- job:
+    name: first
+    description: duplicate
+"""),
+        ('d.yaml', u"""
+- job:
+    name: [broken
+"""),
+    ]
+
+    def setUp(self):
+        super(TestCaseParallelParsing, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        for name, content in self.files:
+            with io.open(os.path.join(self.path, name), 'w',
+                         encoding='utf-8') as f:
+                f.write(content)
+        with io.open(os.path.join(self.path, 'script.sh'), 'w',
+                     encoding='utf-8') as f:
+            f.write(u'make')
+        self.conf_filename = None
+
+    def _load(self, names, parsing_workers, allow_duplicates=False):
+        config = self._get_config()
+        config.yamlparser['parsing_workers'] = parsing_workers
+        config.yamlparser['allow_duplicates'] = allow_duplicates
+        yp = parser.YamlParser(config)
+        yp.load_files([os.path.join(self.path, name) for name in names])
+        return yp.data
+
+    def test_same_data_as_serial(self):
+        names = ['a.yaml', 'b.yaml', 'c.yaml']
+        self.assertEqual(self._load(names, 1, allow_duplicates=True),
+                         self._load(names, 2, allow_duplicates=True))
+        self.assertEqual(2, self.logger.output.count(
+            "tag '!include-raw' is deprecated"))
+
+    def test_duplicates_reported_in_order(self):
+        for workers in (1, 2):
+            with ExpectedException(JenkinsJobsException,
+                                   "^Duplicate entry found in '.*c.yaml: "
+                                   "'first' already defined"):
+                self._load(['a.yaml', 'b.yaml', 'c.yaml', 'd.yaml'],
+                           workers)
+
+    def test_errors_reported_in_order(self):
+        e = self.assertRaises(Exception, self._load,
+                              ['d.yaml', 'c.yaml', 'a.yaml'], 2)
+        self.assertIn('d.yaml', str(e))
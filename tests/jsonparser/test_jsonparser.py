@@ -15,11 +15,64 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
 
+import fixtures
+
+from jenkins_jobs import local_yaml
+from jenkins_jobs import parser
+from jenkins_jobs import registry
 from tests import base
+from tests.base import mock
 
 
 class TestCaseModuleJsonParser(base.SingleJobTestCase):
     fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
     scenarios = base.get_scenarios(fixtures_path, in_ext='json', out_ext='xml')
+
+
+class TestCaseJsonTags(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestCaseJsonTags, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+        with io.open(os.path.join(self.path, 'script.sh'), 'w',
+                     encoding='utf-8') as f:
+            f.write(u'make {target}')
+        self.conf_filename = None
+
+    def _parse(self, content):
+        filename = os.path.join(self.path, 'jobs.json')
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.write(content)
+        yp = parser.YamlParser(self._get_config())
+        with mock.patch.object(local_yaml, 'load') as yaml_load:
+            yp.load_files([filename])
+        self.assertFalse(yaml_load.called)
+        return yp
+
+    def test_tags(self):
+        yp = self._parse(u"""
+[{"job": {"name": "tags",
+          "builders": [{"shell": {"!include-raw-escape:": "script.sh"}},
+                       {"shell": {"!join:": [" ", ["make", "all"]]}}],
+          "description": {"!unknown": "kept"}}}]
+""")
+        self.assertEqual({'name': 'tags',
+                          'builders': [{'shell': 'make {{target}}'},
+                                       {'shell': 'make all'}],
+                          'description': {'!unknown': 'kept'}},
+                         yp.data['job']['tags'])
+        self.assertEqual(['name', 'builders', 'description'],
+                         list(yp.data['job']['tags']))
+
+    def test_lazy_include(self):
+        yp = self._parse(u"""
+[{"job-template": {"name": "{name}-job",
+                   "builders": [{"shell": {"!include-raw:": "{file}"}}]}},
+ {"project": {"name": "lazy", "file": "script.sh", "target": "all",
+              "jobs": ["{name}-job"]}}]
+""")
+        jobs, _ = yp.expandYaml(registry.ModuleRegistry(yp.jjb_config))
+        self.assertEqual([{'shell': 'make {target}'}], jobs[0]['builders'])
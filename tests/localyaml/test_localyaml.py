@@ -14,15 +14,23 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
 import yaml
 
+import fixtures
+import jinja2
+import testtools
 from testtools import ExpectedException
 from yaml.composer import ComposerError
 
 from jenkins_jobs.config import JJBConfig
+from jenkins_jobs import local_yaml
+from jenkins_jobs.local_yaml import Jinja2Loader
 from jenkins_jobs.parser import YamlParser
+from jenkins_jobs import registry
 from tests import base
+from tests.base import mock
 
 
 def _exclude_scenarios(input_filename):
@@ -117,3 +125,256 @@ class TestCaseLocalYamlRetainAnchors(base.BaseTestCase):
         jjb_config.validate()
         j = YamlParser(jjb_config)
         j.load_files([os.path.join(self.fixtures_path, f) for f in files])
+
+
+class TestCaseJinja2Loader(base.BaseTestCase):
+
+    def _make_path(self, content):
+        path = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(path, 'included.j2'), 'w') as f:
+            f.write(content)
+        return [path]
+
+    def test_templates_compiled_once(self):
+        search_path = self._make_path('')
+        first = Jinja2Loader('{{ name }}-job', search_path)
+        second = Jinja2Loader('{{ name }}-job', list(search_path))
+        self.assertIs(first._template, second._template)
+        self.assertEqual('foo-job', second.format(name='foo'))
+        self.assertIsNot(first._template,
+                         Jinja2Loader('{{ name }}', search_path)._template)
+
+    def test_search_paths_are_kept_apart(self):
+        contents = '{% include "included.j2" %}'
+        first = Jinja2Loader(contents, self._make_path('first {{ name }}'))
+        second = Jinja2Loader(contents, self._make_path('second {{ name }}'))
+        self.assertEqual('first foo', first.format(name='foo'))
+        self.assertEqual('second foo', second.format(name='foo'))
+        self.assertRaises(jinja2.UndefinedError, first.format)
+
+    def test_bytecode_cache(self):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        search_path = self._make_path('')
+        with mock.patch.dict(Jinja2Loader._environments, clear=True):
+            Jinja2Loader('{{ name }}-cached', search_path, bytecode_cache)
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+        with mock.patch.dict(Jinja2Loader._environments, clear=True):
+            with mock.patch.object(jinja2.Environment,
+                                   'compile') as compile_mock:
+                loader = Jinja2Loader('{{ name }}-cached', search_path,
+                                      bytecode_cache)
+        self.assertFalse(compile_mock.called)
+        self.assertEqual('foo-cached', loader.format(name='foo'))
+
+
+@testtools.skipIf(local_yaml.LocalCLoader is None, "PyYAML without libyaml")
+class TestCaseLocalCLoader(base.BaseTestCase):
+
+    def test_used_when_possible(self):
+        with mock.patch.object(local_yaml, 'LocalLoader',
+                               side_effect=AssertionError):
+            data = local_yaml.load(u"""
+- job:
+    name: &name test-job
+    description: *name
+    builders:
+      - shell: !join:
+          - ' '
+          - [make, all]
+""")
+        self.assertEqual([{'job': {'name': 'test-job',
+                                   'description': 'test-job',
+                                   'builders': [{'shell': 'make all'}]}}],
+                         data)
+        self.assertIsInstance(data[0]['job'], local_yaml.OrderedDict)
+
+    def test_merged_mappings_keep_order(self):
+        content = u"""
+base: &base {b: 1, a: 2}
+merged:
+  <<: *base
+  c: 3
+  a: 4
+"""
+        for loader in (local_yaml.LocalLoader, local_yaml.LocalCLoader):
+            data = yaml.load(content, loader)
+            self.assertEqual([('b', 1), ('a', 4), ('c', 3)],
+                             list(data['merged'].items()))
+
+    def test_includes_share_anchors(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        with open(os.path.join(path, 'included.yaml'), 'w') as f:
+            f.write('name: *name\n')
+        data = local_yaml.load(u"""
+- name: &name test-job
+- !include: included.yaml
+""", search_path=[path])
+        self.assertEqual([{'name': 'test-job'}, {'name': 'test-job'}], data)
+
+
+class TestCaseIncludeCache(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestCaseIncludeCache, self).setUp()
+        self.useFixture(fixtures.MockPatchObject(
+            local_yaml.YamlInclude, '_contents', {}))
+        self.useFixture(fixtures.MockPatchObject(
+            local_yaml.YamlInclude, '_data', {}))
+        self.useFixture(fixtures.MockPatchObject(
+            local_yaml.YamlInclude, '_search_indexes', {}))
+        # set by the parsers, which reset the indexes
+        self.addCleanup(setattr, local_yaml.YamlInclude,
+                        'search_index_poll_interval',
+                        local_yaml.YamlInclude.search_index_poll_interval)
+        self.path = self.useFixture(fixtures.TempDir()).path
+
+    def _write(self, filename, content):
+        with io.open(os.path.join(self.path, filename), 'w',
+                     encoding='utf-8') as f:
+            f.write(content)
+
+    def _load(self, content):
+        return local_yaml.load(content, search_path=[self.path])
+
+    def test_files_read_once(self):
+        self._write('script.sh', u'make')
+        with mock.patch.object(local_yaml.io, 'open',
+                               side_effect=io.open) as open_mock:
+            data = self._load(u"""
+- !include-raw: script.sh
+- !include-raw: script.sh
+""")
+        self.assertEqual(['make', 'make'], data)
+        self.assertEqual(1, open_mock.call_count)
+
+    def test_changed_files_read_again(self):
+        self._write('script.sh', u'make')
+        self.assertEqual(['make'], self._load(u"- !include-raw: script.sh"))
+        self._write('script.sh', u'make all')
+        self.assertEqual(['make all'],
+                         self._load(u"- !include-raw: script.sh"))
+
+    def test_included_data_shared(self):
+        self._write('job.yaml', u"name: job\nbuilders: [{shell: make}]\n")
+        data = self._load(u"""
+- !include: job.yaml
+- !include: job.yaml
+""")
+        self.assertEqual({'name': 'job', 'builders': [{'shell': 'make'}]},
+                         data[0])
+        self.assertEqual(data[0], data[1])
+        self.assertIsNot(data[0], data[1])
+        self.assertIsNot(data[0]['builders'], data[1]['builders'])
+
+        data[0]['builders'].append({'shell': 'make install'})
+        self.assertEqual(data[1], self._load(u"!include: job.yaml\n"))
+        self.assertEqual([{'shell': 'make'}], data[1]['builders'])
+
+    def test_included_data_changed_by_modules(self):
+        self._write('trig.yaml', u"- zuul\n")
+        self._write('jobs.yaml', u"""
+- job:
+    name: first
+    triggers: !include: trig.yaml
+- job:
+    name: second
+    triggers: !include: trig.yaml
+""")
+        self.conf_filename = None
+        config = self._get_config()
+        # by separate parsers of the same process too
+        for _ in range(2):
+            parser = YamlParser(config)
+            parser.load_files([os.path.join(self.path, 'jobs.yaml')])
+            jobs, _ = parser.expandYaml(registry.ModuleRegistry(config))
+            self.assertEqual([13, 13],
+                             [len(job['parameters']) for job in jobs])
+            self.assertEqual([[], []], [job['triggers'] for job in jobs])
+
+    def test_documents_using_anchors_not_shared(self):
+        self._write('job.yaml', u"name: *name\n")
+        self._write('outer.yaml', u"!include: job.yaml\n")
+        for name in ('first', 'second'):
+            data = self._load(u"""
+- name: &name %s
+- !include: outer.yaml
+""" % name)
+            self.assertEqual({'name': name}, data[1])
+
+    def test_search_path_indexed(self):
+        first = self.useFixture(fixtures.TempDir()).path
+        self._write('script.sh', u'make')
+        search_path = [first, self.path]
+        with mock.patch('os.path.isfile', side_effect=os.path.isfile) as m:
+            for _ in range(3):
+                self.assertEqual(
+                    os.path.join(self.path, 'script.sh'),
+                    local_yaml.YamlInclude._find('script.sh', search_path))
+                self.assertEqual(
+                    'missing.sh',
+                    local_yaml.YamlInclude._find('missing.sh', search_path))
+        self.assertEqual(4, m.call_count)
+
+        # files added are only found once the indexes are reset
+        with io.open(os.path.join(first, 'script.sh'), 'w') as f:
+            f.write(u'make all')
+        self.assertEqual(
+            os.path.join(self.path, 'script.sh'),
+            local_yaml.YamlInclude._find('script.sh', search_path))
+        local_yaml.YamlInclude.reset_search_indexes()
+        self.assertEqual(
+            os.path.join(first, 'script.sh'),
+            local_yaml.YamlInclude._find('script.sh', search_path))
+
+    def test_search_index_polling(self):
+        self.useFixture(fixtures.MockPatchObject(
+            local_yaml.YamlInclude, 'search_index_poll_interval', 0))
+        self.assertEqual('script.sh', local_yaml.YamlInclude._find(
+            'script.sh', [self.path]))
+        self._write('script.sh', u'make')
+        # make sure the directory looks changed on coarse file systems
+        os.utime(self.path, (0, 0))
+        self.assertEqual(
+            os.path.join(self.path, 'script.sh'),
+            local_yaml.YamlInclude._find('script.sh', [self.path]))
+
+    def test_includes_unchanged_indexed(self):
+        first = self.useFixture(fixtures.TempDir()).path
+        self._write('script.sh', u'make')
+        includes = []
+        local_yaml.load(u"- !include-raw: script.sh\n",
+                        search_path=[first, self.path],
+                        dependencies=includes)
+        with mock.patch('os.path.isfile', side_effect=os.path.isfile) as m:
+            for _ in range(3):
+                self.assertTrue(local_yaml.includes_unchanged(includes))
+        self.assertEqual(0, m.call_count)
+
+    def test_search_index_poll_interval_option(self):
+        self.conf_filename = None
+        config = self._get_config()
+        config.yamlparser['include_poll_interval'] = 2.5
+        self._write('jobs.yaml', u"- job:\n    name: job\n")
+        YamlParser(config).load_files([os.path.join(self.path, 'jobs.yaml')])
+        self.assertEqual(2.5,
+                         local_yaml.YamlInclude.search_index_poll_interval)
+        local_yaml.YamlInclude._find('script.sh', [self.path])
+        self.assertEqual(2.5, local_yaml.YamlInclude._search_indexes[
+            (self.path,)].poll_interval)
+
+    def test_lazy_includes_kept_by_path(self):
+        for name in ('master', 'stable'):
+            self._write(name + '.sh', u'make ' + name)
+        lazy = self._load(u"!include-raw: '{branch}.sh'")
+        with mock.patch.object(local_yaml.YamlIncludeRaw, 'from_yaml',
+                               wraps=local_yaml.YamlIncludeRaw.from_yaml) as m:
+            for _ in range(3):
+                self.assertEqual('make master', lazy.format(branch='master'))
+                self.assertEqual('make stable', lazy.format(branch='stable'))
+            self.assertEqual(2, m.call_count)
+
+            local_yaml.YamlInclude.reset_search_indexes()
+            self.assertEqual('make master', lazy.format(branch='master'))
+            self.assertEqual(3, m.call_count)
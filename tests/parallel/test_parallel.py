@@ -12,6 +12,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
 import time
 from multiprocessing import cpu_count
 
@@ -19,6 +20,8 @@ from testtools import matchers
 from testtools import TestCase
 
 from jenkins_jobs.parallel import concurrent
+from jenkins_jobs.parallel import process_imap
+from jenkins_jobs.parallel import process_map
 from tests.base import mock
 
 
@@ -68,3 +71,57 @@ class TestCaseParallel(TestCase):
                                n_workers=0)
         self.assertThat(result, matchers.Equals([True for _ in range(10)]))
         mockCpu_count.assert_called_once_with()
+
+
+class TestCaseProcessMap(TestCase):
+    def test_process_map_correct_order(self):
+        expected = [num * 2 for num in range(10)]
+
+        result = process_map(lambda num: num * 2, range(10), n_workers=4)
+        self.assertThat(result, matchers.Equals(expected))
+
+    def test_process_map_uses_worker_processes(self):
+        result = process_map(lambda _: os.getpid(), range(4), n_workers=2)
+        self.assertThat(result, matchers.Not(matchers.Contains(os.getpid())))
+
+    def test_process_map_single_worker(self):
+        result = process_map(lambda _: os.getpid(), range(4), n_workers=1)
+        self.assertThat(result, matchers.Equals([os.getpid()] * 4))
+
+    def test_process_map_reraises(self):
+        def fail(num):
+            raise ValueError("failed on %d" % num)
+
+        self.assertRaises(ValueError, process_map, fail, range(4),
+                          n_workers=2)
+
+
+class TestCaseProcessImap(TestCase):
+    def test_process_imap_correct_order(self):
+        result = process_imap(lambda num: num * 2, range(50), n_workers=4,
+                              chunksize=3, window=5)
+        self.assertThat(list(result),
+                        matchers.Equals([num * 2 for num in range(50)]))
+
+    def test_process_imap_single_pool(self):
+        result = list(process_imap(lambda _: os.getpid(), range(20),
+                                   n_workers=2, window=2))
+        self.assertThat(result, matchers.Not(matchers.Contains(os.getpid())))
+        self.assertThat(set(result), matchers.HasLength(2))
+
+    def test_process_imap_single_worker(self):
+        result = process_imap(lambda _: os.getpid(), range(4), n_workers=1)
+        self.assertThat(list(result), matchers.Equals([os.getpid()] * 4))
+
+    def test_process_imap_stopped_early(self):
+        result = process_imap(lambda num: num, range(100), n_workers=2,
+                              window=4)
+        self.assertThat(next(result), matchers.Equals(0))
+        result.close()
+
+    def test_process_imap_reraises(self):
+        def fail(num):
+            raise ValueError("failed on %d" % num)
+
+        self.assertRaises(ValueError, list,
+                          process_imap(fail, range(4), n_workers=2))
@@ -15,12 +15,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
+import itertools
 import os
 
+import fixtures
+import testtools
+
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs import formatter
 from jenkins_jobs import parser
 from jenkins_jobs import registry
+from jenkins_jobs import utils
+from jenkins_jobs import xml_config
 
 from tests import base
+from tests.base import mock
 
 
 class TestCaseModuleYamlInclude(base.SingleJobTestCase):
@@ -45,6 +55,53 @@ class TestYamlParserExceptions(base.BaseTestCase):
         self.assertIn("'NoneType' object is not iterable", str(e))
         self.assertIn("- branch: current\n  current: null", self.logger.output)
 
+    def test_jobs_glob_skips_formatting_unmatched_jobs(self):
+        self.conf_filename = None
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path,
+                              "jobs_glob_format_failure.yaml"))
+
+        reg = registry.ModuleRegistry(config)
+
+        # the unfiltered expansion fails on the 'stable' combination
+        self.assertRaises(Exception, yp.expandYaml, reg)
+
+        yp.jobs = []
+        jobs, _ = yp.expandYaml(reg, ['glob-master'])
+        self.assertEqual(['glob-master'], [job['name'] for job in jobs])
+        self.assertEqual([{'shell': 'make'}], jobs[0]['builders'])
+
+    def test_circular_parameter_references(self):
+        self.conf_filename = None
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path,
+                              "circular_parameter_references.yaml"))
+
+        reg = registry.ModuleRegistry(config)
+
+        e = self.assertRaises(JenkinsJobsException, yp.expandYaml, reg)
+        self.assertIn("Circular reference between parameters: ", str(e))
+        self.assertIn("release -> series -> codename -> release", str(e))
+        self.assertIn("Failure formatting params", self.logger.output)
+
+    def test_self_parameter_reference(self):
+        self.conf_filename = None
+        config = self._get_config()
+
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path,
+                              "self_parameter_reference.yaml"))
+
+        reg = registry.ModuleRegistry(config)
+
+        e = self.assertRaises(JenkinsJobsException, yp.expandYaml, reg)
+        self.assertIn("Circular reference between parameters: "
+                      "branch -> branch", str(e))
+
 
 class TestYamlParserFailureFormattingExceptions(base.BaseScenariosTestCase):
     fixtures_path = os.path.join(os.path.dirname(__file__), 'exceptions')
@@ -67,3 +124,478 @@ class TestYamlParserFailureFormattingExceptions(base.BaseScenariosTestCase):
         self.assertIn("Failure formatting {}".format(self.name),
                       self.logger.output)
         self.assertIn("Problem formatting with args", self.logger.output)
+
+
+class TestExpandCombinations(base.BaseTestCase):
+
+    dimensions = [
+        [('axe1', 'a1'), ('axe1', 'a2')],
+        [('axe2', 'b1'), ('axe2', {'b2': {'extra': 'x'}})],
+        [('axe3', 'c1'), ('axe3', 'c2'), ('axe3', '{axe1}')],
+    ]
+
+    def _expected(self, excludes):
+        expected = []
+        for values in itertools.product(*self.dimensions):
+            params = dict((k, next(iter(v)) if isinstance(v, dict) else v)
+                          for k, v in values)
+            if not parser.combination_matches(params, excludes):
+                expected.append(values)
+        return expected
+
+    def test_same_order_as_product(self):
+        self.assertEqual(list(itertools.product(*self.dimensions)),
+                         list(parser.expand_combinations(self.dimensions,
+                                                         [])))
+
+    def test_excluded_prefixes_are_pruned(self):
+        excludes = [{'axe1': 'a1'}, {'axe2': 'b2', 'axe3': 'c2'}]
+        self.assertEqual(
+            self._expected(excludes),
+            list(parser.expand_combinations(self.dimensions, excludes)))
+
+    def test_unformatted_values_are_not_pruned(self):
+        # '{axe1}' can only be compared once formatted, and 'other' is not
+        # a dimension at all, so these are left to combination_matches
+        excludes = [{'axe3': '{axe1}'}, {'axe1': 'a2', 'other': 'x'}]
+        self.assertEqual(
+            list(itertools.product(*self.dimensions)),
+            list(parser.expand_combinations(self.dimensions, excludes)))
+
+    def test_overridden_keys_are_not_pruned(self):
+        dimensions = self.dimensions + [[('extra', 'y')]]
+        excludes = [{'extra': 'y'}]
+        self.assertEqual(
+            list(itertools.product(*dimensions)),
+            list(parser.expand_combinations(dimensions, excludes)))
+
+
+class TestLayeredParams(base.BaseTestCase):
+
+    def test_first_layer_takes_precedence(self):
+        params = parser.LayeredParams({'a': 1}, {'a': 2, 'b': 2}, {'c': 3})
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dict(params))
+        self.assertEqual(['a', 'b'], list(parser.LayeredParams({'b': 1},
+                                                               {'a': 2})))
+
+    def test_changes_are_written_to_first_layer(self):
+        shared = {'a': [1, 2], 'b': 2}
+        params = parser.LayeredParams({}, shared)
+        child = params.new_child({'c': 3})
+
+        child['a'] = [3]
+        del child['b']
+        self.assertEqual({'a': [3], 'c': 3}, dict(child))
+        self.assertNotIn('b', child)
+        self.assertEqual({'a': [1, 2], 'b': 2}, shared)
+        self.assertEqual(shared, dict(params))
+        self.assertIs(shared['a'], params['a'])
+        self.assertRaises(KeyError, child.pop, 'b')
+
+
+class TestCustomFormatter(base.BaseTestCase):
+
+    params = {'a': 'x', 'b': ['list'], 'c': 3, 'name-with-dash': 'y'}
+    cases = [
+        ('', ''), ('plain', 'plain'), ('{a}', 'x'), ('{b}', ['list']),
+        ('{{a}}', '{a}'), ('{{{a}}}', 'x'), ('{a}\n', 'x'),
+        ('{obj:b}', ['list']), ('{a}-{c:03d}-{c!r}', 'x-003-3'),
+        ('{a|default}', 'x'), ('{missing|default}-{a}', 'default-x'),
+        ('{missing|}', ''), ('{a} {missing|d}', 'x d'),
+        ('{name-with-dash}', 'y'), ('{a.__class__.__name__}', 'str'),
+        ('{b[0]}', 'list'), ('{c:{c}}', '  3'), ('{0}', IndexError),
+        ('{}', IndexError), ('unbalanced }', ValueError),
+    ]
+
+    def _format(self, format_string, allow_empty=False):
+        try:
+            return formatter.CustomFormatter(allow_empty).vformat(
+                format_string, (), self.params)
+        except Exception as e:
+            return type(e)
+
+    def test_cached_formats_give_same_result(self):
+        formatter.CustomFormatter._compiled.clear()
+        for _ in range(2):
+            self.assertEqual(
+                [expected for _, expected in self.cases],
+                [self._format(format_string)
+                 for format_string, _ in self.cases])
+
+    def test_missing_keys(self):
+        self.assertEqual(KeyError, self._format('{missing} {a}'))
+        self.assertEqual(' x', self._format('{missing} {a}', True))
+
+    def test_cache_is_bounded(self):
+        cache = formatter._LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+
+
+class TestDeepFormat(base.BaseTestCase):
+
+    def test_unchanged_subtrees_are_shared(self):
+        unchanged = {'shell': 'make', 'env': ['A=1', {'B': 2}]}
+        data = {'builders': [unchanged, {'shell': 'make {target}'}],
+                'node': 'builder'}
+        formatted = formatter.deep_format(data, {'target': 'all'})
+        self.assertEqual({'builders': [unchanged, {'shell': 'make all'}],
+                          'node': 'builder'}, formatted)
+        self.assertIsNot(data, formatted)
+        self.assertIs(unchanged, formatted['builders'][0])
+        self.assertEqual('make {target}', data['builders'][1]['shell'])
+        self.assertIs(data, formatter.deep_format(data, {'target': 'all'},
+                                                  static=set([id(data)])))
+        self.assertIs(unchanged, formatter.deep_format(unchanged, {}))
+
+    def test_changed_keys(self):
+        data = {'{name}': ['x'], 'other': ['y']}
+        formatted = formatter.deep_format(data, {'name': 'foo'})
+        self.assertEqual({'foo': ['x'], 'other': ['y']}, formatted)
+        self.assertIs(data['other'], formatted['other'])
+
+    def test_deeply_nested_data(self):
+        data = inner = []
+        for _ in range(5000):
+            inner.append([])
+            inner = inner[0]
+        inner.append('{name}')
+        formatted = formatter.deep_format(data, {'name': 'foo'})
+        for _ in range(5000):
+            formatted = formatted[0]
+        self.assertEqual(['foo'], formatted)
+
+    def test_data_containing_itself(self):
+        data = {'list': ['{name}']}
+        data['list'].append(data)
+        self.assertRaises(JenkinsJobsException, formatter.deep_format,
+                          data, {'name': 'foo'})
+
+    def test_failures_are_reported_by_enclosing_dicts(self):
+        data = {'builders': [{'shell': '{missing}'}]}
+        self.assertRaises(JenkinsJobsException, formatter.deep_format,
+                          data, {})
+        self.assertEqual(2, self.logger.output.count(
+            "Problem formatting with args"))
+
+
+class TestRenderPlan(base.BaseTestCase):
+
+    def test_same_result_as_deep_format(self):
+        nested = inner = []
+        for _ in range(formatter._MAX_PLAN_DEPTH + 10):
+            inner.append([])
+            inner = inner[0]
+        inner.append('{name}')
+        data = {'name': '{name}-{os}',
+                '{os}-key': ['x', {'y': '{name}'}],
+                'static': {'shell': 'make', 'env': ['A=1']},
+                'escaped': '{{name}}',
+                'whole': '{obj}',
+                'nested': nested}
+        params = {'name': 'proj', 'os': 'xenial', 'obj': {'a': 1}}
+        plan = formatter.RenderPlan(data)
+        rendered = plan.render(params)
+        self.assertEqual(formatter.deep_format(data, params), rendered)
+        self.assertEqual(formatter.deep_format(data, params, True),
+                         plan.render(params, True))
+        self.assertEqual('{name}-{os}', data['name'])
+
+    def test_unchanged_subtrees_are_shared(self):
+        data = {'builders': [{'shell': 'make'}, {'shell': 'make {target}'}],
+                'node': 'builder'}
+        plan = formatter.RenderPlan(data)
+        rendered = plan.render({'target': 'all'})
+        self.assertIs(data['builders'][0], rendered['builders'][0])
+        self.assertEqual('make all', rendered['builders'][1]['shell'])
+        self.assertIs(data['builders'][0], formatter.RenderPlan(
+            data['builders'][0]).render({'target': 'all'}))
+
+    def test_dump(self):
+        plan = formatter.RenderPlan({'name': '{name}',
+                                     'node': 'builder',
+                                     'builders': [{'shell': 'make'}]})
+        dump = plan.dump()
+        self.assertIn("'name': format '{name}'", dump)
+        self.assertIn("'node': static 'builder'", dump)
+        self.assertIn("'builders': static list of 1 items", dump)
+        self.assertTrue(dump.startswith('dict'))
+
+    def test_failures_are_reported_like_deep_format(self):
+        plan = formatter.RenderPlan({'builders': [{'shell': '{missing}'}]})
+        self.assertRaises(JenkinsJobsException, plan.render, {})
+        self.assertEqual(2, self.logger.output.count(
+            "Problem formatting with args"))
+
+
+class TestStaticSubtrees(base.BaseTestCase):
+
+    def test_static_subtrees_are_not_copied(self):
+        static_list = ['make', {'shell': 'echo done', 'retries': 2}]
+        template = {'name': '{name}-job',
+                    'builders': static_list,
+                    'publishers': [{'email': '{name}@example.com'}]}
+        static, seen = set(), {}
+        formatter.find_static(template, static, seen)
+        self.assertIn(id(static_list), static)
+        self.assertIn(id(static_list[1]), static)
+        self.assertNotIn(id(template), static)
+        self.assertNotIn(id(template['publishers']), static)
+
+        expanded = formatter.deep_format(template, {'name': 'foo'},
+                                         static=static)
+        self.assertEqual({'name': 'foo-job',
+                          'builders': static_list,
+                          'publishers': [{'email': 'foo@example.com'}]},
+                         expanded)
+        self.assertIs(static_list, expanded['builders'])
+
+        copied = utils.copy_tree(expanded)
+        self.assertEqual(expanded, copied)
+        self.assertIsNot(static_list[1], copied['builders'][1])
+
+    def test_generating_xml_does_not_modify_templates(self):
+        self.conf_filename = None
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([io.BytesIO(b"""
+- project:
+    name: proj
+    branch: [master, stable]
+    jobs:
+      - '{name}-{branch}'
+- job-template:
+    name: '{name}-{branch}'
+    triggers:
+      - gerrit:
+          trigger-on-patchset-uploaded-event: true
+          projects: []
+""")])
+        reg = registry.ModuleRegistry(yp.jjb_config)
+        jobs, _ = yp.expandYaml(reg)
+        reg.set_parser_data(yp.data)
+        xml_generator = xml_config.XmlJobGenerator(reg)
+        xml_jobs = xml_generator.generateXML(jobs)
+        self.assertEqual(xml_jobs[0].output().replace(b'master', b'stable'),
+                         xml_jobs[1].output())
+        self.assertNotIn('trigger-on', jobs[0]['triggers'][0]['gerrit'])
+
+
+class TestTemplateRenders(base.BaseTestCase):
+
+    def test_renders_shared_by_combinations(self):
+        self.conf_filename = None
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([io.BytesIO(b"""
+- project:
+    name: proj
+    python: [py27, py36]
+    os: [trusty, xenial]
+    jobs:
+      - '{name}-{python}-{os}'
+- job-template:
+    name: '{name}-{python}-{os}'
+    node: '{os}'
+    publishers:
+      - email:
+          recipients: '{name}@example.com'
+""")])
+        reg = registry.ModuleRegistry(yp.jjb_config)
+        jobs, _ = yp.expandYaml(reg)
+
+        self.assertEqual(['proj-py27-trusty', 'proj-py27-xenial',
+                          'proj-py36-trusty', 'proj-py36-xenial'],
+                         [job['name'] for job in jobs])
+        self.assertEqual(['trusty', 'xenial', 'trusty', 'xenial'],
+                         [job['node'] for job in jobs])
+        self.assertEqual([{'email': {'recipients': 'proj@example.com'}}],
+                         jobs[0]['publishers'])
+        for job in jobs[1:]:
+            self.assertIs(jobs[0]['publishers'], job['publishers'])
+
+    def test_renders_kept_by_key(self):
+        template = {'name': '{name}-{os}', 'node': '{os}', 'other': 'x'}
+        plans = dict((key, formatter.RenderPlan({key: value}))
+                     for key, value in template.items())
+        renders = parser._TemplateRenders(template, False, plans)
+        for i in range(parser._RENDERS_PER_KEY + 1):
+            self.assertEqual(
+                {'name': 'proj-%d' % i, 'node': str(i), 'other': 'x'},
+                renders.render({'name': 'proj', 'os': str(i)}))
+        self.assertIsNone(renders.renders['node'])
+        self.assertEqual(1, len(renders.renders['other']))
+
+    def test_loader_params_not_shared(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        for name in ('trusty', 'xenial'):
+            with io.open(os.path.join(path, name + '.sh'), 'w',
+                         encoding='utf-8') as f:
+                f.write(u'%s script' % name)
+        with io.open(os.path.join(path, 'jobs.yaml'), 'w',
+                     encoding='utf-8') as f:
+            f.write(u"""
+- project:
+    name: proj
+    os: [trusty, xenial]
+    jobs:
+      - '{name}-{os}'
+- job-template:
+    name: '{name}-{os}'
+    script: !include-raw: '{os}.sh'
+    j: !j2: 'j2 {{ os }}'
+    builders:
+      - shell: '{script}'
+      - shell: '{j}'
+""")
+        self.conf_filename = None
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([os.path.join(path, 'jobs.yaml')])
+        jobs, _ = yp.expandYaml(registry.ModuleRegistry(yp.jjb_config))
+
+        self.assertEqual(
+            [[{'shell': 'trusty script'}, {'shell': 'j2 trusty'}],
+             [{'shell': 'xenial script'}, {'shell': 'j2 xenial'}]],
+            [job['builders'] for job in jobs])
+
+
+class TestDefaultsSets(base.BaseTestCase):
+
+    def _get_parser(self, yaml_string):
+        self.conf_filename = None
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([io.BytesIO(yaml_string.encode('utf-8'))])
+        return yp
+
+    def test_defaults_resolved_once(self):
+        yp = self._get_parser("""
+- defaults:
+    name: global
+    node: builder
+- job:
+    name: plain
+""")
+        defaults = yp._getDefaults({})
+        self.assertIs(defaults, yp._getDefaults({'name': 'other'}))
+        self.assertEqual('builder', defaults['node'])
+        self.assertFalse(hasattr(defaults, '__setitem__'))
+        overridden = yp._getDefaults({}, {'node': 'other', 'foo': 'bar'})
+        self.assertEqual('other', overridden['node'])
+        self.assertNotIn('foo', overridden)
+        self.assertEqual('builder', defaults['node'])
+
+    def test_plain_jobs_do_not_share_defaults(self):
+        yp = self._get_parser("""
+- defaults:
+    name: global
+    builders:
+      - shell: make
+- job:
+    name: first
+- job:
+    name: second
+""")
+        reg = registry.ModuleRegistry(yp.jjb_config)
+        jobs, _ = yp.expandYaml(reg)
+        jobs[0]['builders'].append({'shell': 'make install'})
+        self.assertEqual([{'shell': 'make'}], jobs[1]['builders'])
+        self.assertEqual([{'shell': 'make'}], yp._getDefaults({})['builders'])
+
+
+class TestJobHandles(base.BaseTestCase):
+    fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+    def _get_parser(self):
+        self.conf_filename = None
+        config = self._get_config()
+        yp = parser.YamlParser(config)
+        yp.parse(os.path.join(self.fixtures_path,
+                              'third_order_parameter_interpolation001.yaml'))
+        return yp, registry.ModuleRegistry(config)
+
+    def test_handles_do_not_expand(self):
+        yp, reg = self._get_parser()
+        with mock.patch.object(parser.YamlParser,
+                               '_expandTemplateJob') as expand_mock:
+            handles = yp.getJobHandles(reg)
+        self.assertFalse(expand_mock.called)
+        self.assertEqual(['build-1.0', 'build-2.0'],
+                         [handle.name for handle in handles])
+        self.assertEqual(set(['job']),
+                         set(handle.kind for handle in handles))
+
+    def test_handles_expand_on_demand(self):
+        yp, reg = self._get_parser()
+        expected, _ = self._get_parser()[0].expandYaml(reg)
+
+        handles = yp.getJobHandles(reg)
+        self.assertEqual(expected, [handle.expand() for handle in handles])
+        self.assertRaises(JenkinsJobsException, handles[0].expand)
+        self.assertEqual(expected, list(yp.expandHandles(
+            yp.getJobHandles(reg))))
+
+    def test_handles_only_format_naming_params(self):
+        self.conf_filename = None
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([io.BytesIO(b"""
+- project:
+    name: proj
+    branch: [master, stable]
+    exclude:
+      - branch: stable
+    script: 'make {missing}'
+    jobs:
+      - '{name}-{branch}'
+- job-template:
+    name: '{name}-{branch}'
+    builders:
+      - shell: '{script}'
+""")])
+        reg = registry.ModuleRegistry(yp.jjb_config)
+
+        handles = yp.getJobHandles(reg)
+        self.assertEqual(['proj-master'], [handle.name for handle in handles])
+        self.assertRaises(JenkinsJobsException, handles[0].expand)
+        self.assertIn("Failure formatting params", self.logger.output)
+
+
+class TestLoadFilesManifest(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestLoadFilesManifest, self).setUp()
+        self.conf_filename = None
+        self.path = os.path.realpath(
+            self.useFixture(fixtures.TempDir()).path)
+        for name in ('b.yaml', 'a.yml'):
+            with io.open(os.path.join(self.path, name), 'w',
+                         encoding='utf-8') as f:
+                f.write(u'- job:\n    name: %s\n' % name)
+
+    def test_manifest(self):
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([self.path])
+
+        filenames = [os.path.join(self.path, name)
+                     for name in ('a.yml', 'b.yaml')]
+        self.assertEqual(filenames, list(yp.manifest))
+        for filename in filenames:
+            self.assertEqual(utils.file_signature(filename),
+                             yp.manifest[filename].signature)
+        self.assertEqual(['a.yml', 'b.yaml'], list(yp.data['job']))
+
+    @testtools.skipUnless(hasattr(os, 'symlink'), "symlinks not supported")
+    def test_duplicates_ignored(self):
+        os.symlink(os.path.join(self.path, 'a.yml'),
+                   os.path.join(self.path, 'c.yaml'))
+        yp = parser.YamlParser(self._get_config())
+        yp.load_files([self.path, os.path.join(self.path, 'b.yaml')])
+
+        self.assertEqual([os.path.join(self.path, name)
+                          for name in ('a.yml', 'b.yaml')],
+                         list(yp.manifest))
+        self.assertEqual(['a.yml', 'b.yaml'], list(yp.data['job']))
+        self.assertIn("c.yaml' already added as", self.logger.output)
+        self.assertIn("b.yaml' already added as", self.logger.output)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Time the loading and expansion of a large, generated set of job
+definitions.
+
+The generated tree uses a defaults set carrying a long shell script and a
+large list, a job-template with four axes and many projects using it, which
+is the shape of definition that makes expansion slow. Run it before and
+after a change to the parser to compare::
+
+    python tools/benchmark-expansion.py --projects 200
+"""
+
+import argparse
+import io
+import logging
+import time
+
+from jenkins_jobs.config import JJBConfig
+from jenkins_jobs.parser import YamlParser
+from jenkins_jobs.registry import ModuleRegistry
+
+
+DEFAULTS = u"""
+- defaults:
+    name: global
+    description: 'Managed by Jenkins Job Builder'
+    label: builder
+    properties:
+      - build-discarder:
+          days-to-keep: 30
+    wrappers:
+      - timestamps
+    big-list: [{big_list}]
+    builders:
+      - shell: |
+{script}
+
+- job-template:
+    name: '{{name}}-{{python}}-{{os}}-{{stage}}'
+    node: '{{label}}-{{os}}'
+    parameters:
+      - string:
+          name: PROJECT
+          default: '{{name}}'
+    builders:
+      - shell: |
+{script}
+      - shell: 'tox -e {{python}} -- {{stage}}'
+    publishers:
+      - email:
+          recipients: '{{name}}@example.com'
+"""
+
+PROJECT = u"""
+- project:
+    name: project-{0}
+    python: [py27, py35, py36]
+    os: [trusty, xenial]
+    stage: [unit, functional, integration]
+    exclude:
+      - os: trusty
+        stage: integration
+    jobs:
+      - '{{name}}-{{python}}-{{os}}-{{stage}}'
+"""
+
+
+def generate(projects, script_lines):
+    script = u"\n".join(
+        u"          echo step {0} $STEP_{0} && make target-{0}".format(i)
+        for i in range(script_lines))
+    big_list = u", ".join(u"item{0}".format(i) for i in range(50))
+    content = [DEFAULTS.format(big_list=big_list, script=script)]
+    content.extend(PROJECT.format(i) for i in range(projects))
+    return u"".join(content).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--projects', type=int, default=200,
+                        help='number of projects to generate')
+    parser.add_argument('--script-lines', type=int, default=60,
+                        help='length of the generated shell scripts')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the best one is reported')
+    parser.add_argument('--glob', nargs='*', default=None,
+                        help='only expand the jobs matching these globs')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    content = generate(options.projects, options.script_lines)
+    jjb_config = JJBConfig()
+    registry = ModuleRegistry(jjb_config)
+
+    best_load = best_expand = None
+    for _ in range(options.repeat):
+        start = time.time()
+        yp = YamlParser(jjb_config)
+        yp.load_files([io.BytesIO(content)])
+        loaded = time.time()
+        jobs, views = yp.expandYaml(registry, options.glob)
+        expanded = time.time()
+
+        best_load = min(best_load or loaded - start, loaded - start)
+        best_expand = min(best_expand or expanded - loaded,
+                          expanded - loaded)
+
+    print("{0} jobs: load {1:.3f}s, expand {2:.3f}s".format(
+        len(jobs), best_load, best_expand))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Time the loading of the YAML files of the test fixtures with LocalLoader
+and with LocalCLoader, the loader built on libyaml.
+
+Files using ``!include:`` tags, which LocalCLoader leaves to LocalLoader,
+and the ones either loader fails to load are skipped. The data loaded by
+both loaders is checked to be the same, custom objects included. Run it
+from the top of the tree::
+
+    python tools/benchmark-yaml-loading.py
+"""
+
+import argparse
+import functools
+import glob
+import io
+import logging
+import os
+import sys
+import time
+
+from six.moves import cPickle as pickle
+import yaml
+
+from jenkins_jobs import local_yaml
+
+
+def load_all(loader, files):
+    results = []
+    for path, content in files:
+        local_yaml.LocalAnchorLoader.reset_anchors()
+        results.append(yaml.load(content, functools.partial(
+            loader, search_path=[os.path.dirname(path)])))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fixtures', default='tests/*/fixtures/*.yaml',
+                        help='glob of the files to load')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs, the best one is reported')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    if local_yaml.LocalCLoader is None:
+        sys.exit("PyYAML is built without libyaml, nothing to compare")
+
+    files = []
+    for path in sorted(glob.glob(options.fixtures)):
+        with io.open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        try:
+            # the custom objects are compared by their pickled state
+            same = (pickle.dumps(load_all(local_yaml.LocalLoader,
+                                          [(path, content)]), protocol=2) ==
+                    pickle.dumps(load_all(local_yaml.LocalCLoader,
+                                          [(path, content)]), protocol=2))
+        except Exception:
+            continue
+        if not same:
+            sys.exit("Loaders differ on '{0}'".format(path))
+        files.append((path, content))
+
+    timings = {}
+    for loader in (local_yaml.LocalLoader, local_yaml.LocalCLoader):
+        best = None
+        for _ in range(options.repeat):
+            start = time.time()
+            load_all(loader, files)
+            elapsed = time.time() - start
+            best = min(best or elapsed, elapsed)
+        timings[loader.__name__] = best
+        print("{0}: {1:.3f}s".format(loader.__name__, best))
+
+    print("{0} files, {1:.1f} times faster".format(
+        len(files), timings['LocalLoader'] / timings['LocalCLoader']))
+
+
+if __name__ == '__main__':
+    main()